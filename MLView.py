@@ -5,17 +5,19 @@ Qt Application for running MountainSort and visualizing sorted clusters.
 import os
 import sys
 import json
+import threading
+from collections import OrderedDict
 import numpy as np
 from mountainlab_pytools import mdaio
 from sklearn.preprocessing import normalize
 from sklearn.decomposition import PCA
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, lfilter, sosfiltfilt
 
 # Qt5 imports
 from PyQt5.QtWidgets import QMainWindow, QAction, qApp, QApplication, QDialog, QFileDialog, QMessageBox
 from PyQt5.QtWidgets import QPushButton, QSlider, QRadioButton, QLabel, QInputDialog
 from PyQt5.QtWidgets import QHBoxLayout, QVBoxLayout, QGridLayout, QComboBox
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, pyqtSignal
 
 # Matplotlib in Qt5
 from mpl_toolkits.mplot3d import Axes3D
@@ -31,11 +33,15 @@ from matplotlib.animation import FuncAnimation
 import MS4batch
 import MountainViewIO
 import QtHelperUtils
+import mda_stream
+from timestamp_index import load_timestamp_index
 
 MODULE_IDENTIFIER = "[MLView] "
 N_SPIKES_TO_PLOT = 3000
 DEFAULT_ACCESS_TIMESTAMPED_SPIKES = True
 DEFAULT_SHOW_GRID_ON_SPIKES = False
+DEFAULT_SHOW_DENSITY_IMAGES = False
+DENSITY_IMAGE_BINS = 256
 FIGURE_BACKGROUND = 'black'
 FIGURE_DPI = 1200.0
 FIRING_CLIP_SIZE = 32
@@ -47,6 +53,18 @@ SPIKE_MARKER_SIZE = 0.04
 SPIKE_TRANSPARENCY = 0.85
 N_CLUSTER_COLORS = 13   # Picking a prime number to get uniform coverage
 WHITEN_CLIP_DATA = False
+CLIP_EXTRACTION_CHUNK = 65536
+CLIP_FILTER_LOWCUT = 600
+CLIP_FILTER_HIGHCUT = 6000
+CLIP_FILTER_PAD = 1024              # Samples read on either side of a clip to absorb filter transients
+MAX_FILTER_RUN_LENGTH = 1048576     # Maximum number of samples filtered at a time
+TETRODE_CACHE_BYTES = 2 * 1024 * 1024 * 1024     # Memory budget for loaded tetrodes
+N_PREFETCH_NEIGHBOURS = 1           # Tetrodes prefetched on either side of the current one
+N_PREFETCH_WORKERS = 1
+CLIP_CACHE_EXTENSION = '.clips.cache.npy'
+AMPLITUDE_CACHE_EXTENSION = '.amplitudes.cache.npy'
+CLIP_CACHE_KEY_EXTENSION = '.clips.cache.json'
+CLIP_CACHE_VERSION = 1
 
 def butter_bandpass(lowcut, highcut, fs, order=5):
     nyq = 0.5 * fs
@@ -61,6 +79,499 @@ def butter_bandpass_filter(data, lowcut, highcut, fs, order=5):
     y = lfilter(b, a, data)
     return y
 
+def butter_bandpass_sos(lowcut, highcut, fs, order=5):
+    nyq = 0.5 * fs
+    return butter(order, [lowcut / nyq, highcut / nyq], btype='band', output='sos')
+
+def extract_clips(timeseries, spike_indices, pre_clip=FIRING_PRE_CLIP, clip_size=FIRING_CLIP_SIZE, \
+        chunk_size=CLIP_EXTRACTION_CHUNK):
+    """
+    Cut a (channels x clip_size) clip around every spike in a (channels x
+    samples) timeseries.
+
+    Clips are gathered chunk_size spikes at a time from a strided view that
+    has a window starting at every sample, so no per-spike Python work is done.
+
+    :returns: (spikes x channels x clip_size) clips and a mask of spikes for
+        which a complete clip was found. Clips for the others are left at 0.
+    """
+    spike_indices = np.asarray(spike_indices, dtype='int64')
+    n_channels, n_samples = timeseries.shape
+    clips = np.zeros((len(spike_indices), n_channels, clip_size), dtype=float)
+    clip_starts = spike_indices - pre_clip
+    clip_found = (clip_starts >= 0) & (clip_starts + clip_size <= n_samples)
+    if n_samples < clip_size:
+        return clips, clip_found
+
+    # windows[c, t, :] is timeseries[c, t:t+clip_size] (no data is copied)
+    windows = np.lib.stride_tricks.as_strided(timeseries, \
+            shape=(n_channels, n_samples - clip_size + 1, clip_size), \
+            strides=(timeseries.strides[0], timeseries.strides[1], timeseries.strides[1]), \
+            writeable=False)
+    found_spikes = np.flatnonzero(clip_found)
+    for chunk_start in range(0, len(found_spikes), chunk_size):
+        chunk_spikes = found_spikes[chunk_start:chunk_start+chunk_size]
+        clips[chunk_spikes] = windows[:, clip_starts[chunk_spikes], :].transpose(1, 0, 2)
+    return clips, clip_found
+
+def extract_filtered_clips(timeseries, spike_indices, lowcut, highcut, fs, pre_clip=FIRING_PRE_CLIP, \
+        clip_size=FIRING_CLIP_SIZE, pad=CLIP_FILTER_PAD, max_run_length=MAX_FILTER_RUN_LENGTH, \
+        progress_callback=None):
+    """
+    Cut band-pass filtered clips around every spike in a (channels x samples)
+    timeseries, without filtering (or reading) the whole recording.
+
+    Each clip is padded with pad samples of data on either side. Overlapping
+    padded windows are merged into runs of at most max_run_length samples,
+    and each run is read and filtered (zero-phase, with sosfiltfilt) on its
+    own. Memory use grows with the number of spikes, not with the length of
+    the recording, so timeseries can be a memory-mapped file.
+
+    :progress_callback: Called with the fraction of clips extracted after
+        every run.
+    :returns: Same as extract_clips.
+    """
+    spike_indices = np.asarray(spike_indices, dtype='int64')
+    n_channels, n_samples = timeseries.shape
+    clips = np.zeros((len(spike_indices), n_channels, clip_size), dtype=float)
+    clip_starts = spike_indices - pre_clip
+    clip_found = (clip_starts >= 0) & (clip_starts + clip_size <= n_samples)
+
+    found_spikes = np.flatnonzero(clip_found)
+    found_spikes = found_spikes[np.argsort(clip_starts[found_spikes], kind='stable')]
+    if len(found_spikes) == 0:
+        return clips, clip_found
+    window_starts = np.maximum(clip_starts[found_spikes] - pad, 0)
+    window_ends = np.minimum(clip_starts[found_spikes] + clip_size + pad, n_samples)
+    window_length = clip_size + 2 * pad
+
+    sos = butter_bandpass_sos(lowcut, highcut, fs)
+    default_padlen = 3 * (2 * len(sos) + 1)
+
+    # Windows are sorted by start and have (almost) the same length, so runs
+    # of overlapping windows break wherever a window starts after the
+    # previous one has ended.
+    gap_breaks = np.flatnonzero(window_starts[1:] > window_ends[:-1]) + 1
+    for segment_start, segment_end in zip(np.r_[0, gap_breaks], np.r_[gap_breaks, len(found_spikes)]):
+        run_first = segment_start
+        while run_first < segment_end:
+            # Split long stretches of overlapping windows into bounded runs
+            run_last = run_first + max(1, np.searchsorted(window_starts[run_first:segment_end], \
+                    window_starts[run_first] + max_run_length - window_length, side='right'))
+            run_start = window_starts[run_first]
+            run_end = window_ends[run_first:run_last].max()
+            run_data = np.asarray(timeseries[:, run_start:run_end], dtype=float)
+            run_data = sosfiltfilt(sos, run_data, axis=1, padlen=min(default_padlen, run_data.shape[1]-1))
+
+            run_spikes = found_spikes[run_first:run_last]
+            clips[run_spikes], _ = extract_clips(run_data, spike_indices[run_spikes] - run_start, \
+                    pre_clip, clip_size)
+            run_first = run_last
+            if progress_callback is not None:
+                progress_callback(float(run_first) / len(found_spikes))
+    return clips, clip_found
+
+def clip_peak_amplitudes(clips):
+    """
+    Get the amplitude on every channel at the peak of each clip.
+
+    The peak is the most negative sample across all the channels in a clip.
+    Raw data has negative spike amplitudes, so the amplitudes are sign-flipped.
+
+    :clips: (spikes x channels x clip_size) clips
+    :returns: (spikes x channels) amplitudes
+    """
+    n_spikes, n_channels, clip_size = clips.shape
+    peak_sample = np.argmin(clips.reshape(n_spikes, -1), axis=1) % clip_size
+    return -np.take_along_axis(clips, peak_sample[:, np.newaxis, np.newaxis], axis=2)[:, :, 0]
+
+def stratified_subsample(n_points, n_samples, seed=None):
+    """
+    Pick n_samples out of n_points (ordered) points by splitting them into
+    n_samples equal strata and picking a random point from each one.
+
+    :returns: Sorted indices of the picked points (all points if there are
+        fewer than n_samples).
+    """
+    if n_points <= n_samples:
+        return np.arange(n_points)
+    rng = np.random.RandomState(seed)
+    strata_edges = np.linspace(0, n_points, n_samples+1).astype('int64')
+    return strata_edges[:-1] + (rng.random_sample(n_samples) * np.diff(strata_edges)).astype('int64')
+
+def amplitude_bins(firing_amplitudes, limits, n_bins=DENSITY_IMAGE_BINS):
+    """
+    Bin the amplitudes on every channel into n_bins equal bins between limits.
+
+    :returns: (spikes x channels) bin indices, -1 for amplitudes out of limits.
+    """
+    bin_width = float(limits[1] - limits[0]) / n_bins
+    bins = np.floor((np.asarray(firing_amplitudes) - limits[0]) / bin_width)
+    bins[(bins < 0) | (bins >= n_bins)] = -1
+    return bins.astype('int32')
+
+def density_histogram(x_bins, y_bins, n_bins=DENSITY_IMAGE_BINS):
+    """
+    2D histogram (rows along y) of points binned with amplitude_bins.
+    """
+    in_limits = (x_bins >= 0) & (y_bins >= 0)
+    flat_bins = y_bins[in_limits].astype('int64') * n_bins + x_bins[in_limits]
+    return np.bincount(flat_bins, minlength=n_bins*n_bins).reshape(n_bins, n_bins)
+
+def composite_densities(densities, colors):
+    """
+    Blend density histograms of several clusters into a single RGBA image.
+    Each cluster is drawn in its own color with an opacity that grows with
+    (the log of) its spike density. Where clusters overlap, colors are
+    averaged, weighted by opacity.
+    """
+    image = np.zeros(densities[0].shape + (4,), dtype=float) if densities else \
+            np.zeros((DENSITY_IMAGE_BINS, DENSITY_IMAGE_BINS, 4), dtype=float)
+    total_opacity = np.zeros(image.shape[:2], dtype=float)
+    transparency = np.ones(image.shape[:2], dtype=float)
+    for density, color in zip(densities, colors):
+        peak_density = density.max()
+        if peak_density == 0:
+            continue
+        opacity = np.log1p(density) / np.log1p(peak_density)
+        image[:, :, :3] += opacity[:, :, np.newaxis] * np.asarray(color[:3])
+        total_opacity += opacity
+        transparency *= (1.0 - opacity)
+    covered = total_opacity > 0
+    image[covered, :3] /= total_opacity[covered, np.newaxis]
+    image[:, :, 3] = 1.0 - transparency
+    return image
+
+class ClusterIndex(object):
+
+    """
+    Spike indices grouped by cluster label. Indices for all clusters are kept
+    in a single array, ordered by label, so every cluster maps to a contiguous
+    slice of it.
+    """
+
+    def __init__(self, spike_labels):
+        self.labels, self.spike_order, self.offsets = MountainViewIO.groupSpikesByLabel(spike_labels)
+        self._label_positions = dict([(int(label), l_idx) for l_idx, label in enumerate(self.labels)])
+
+    def __getitem__(self, label):
+        l_idx = self._label_positions[int(label)]
+        return self.spike_order[self.offsets[l_idx]:self.offsets[l_idx+1]]
+
+    def __contains__(self, label):
+        return int(label) in self._label_positions
+
+    def __len__(self):
+        return len(self.labels)
+
+    def names(self):
+        return [int(label) for label in self.labels]
+
+def read_clip_source(clips_file):
+    """
+    Open the raw data for a tetrode to cut clips from.
+
+    :returns: Memory-mapped raw data (filtered when clips are extracted), or
+        the filtered and whitened recording if WHITEN_CLIP_DATA is set.
+    """
+    # raw_clip_data = normalize(mdaio.readmda(clips_file), axis=1)
+    # raw_clip_data = mdaio.readmda(clips_file)
+    if WHITEN_CLIP_DATA:
+        # Whitening needs statistics of the whole recording, so it
+        # still has to be read and filtered in its entirety.
+        filtered_clip_data = butter_bandpass_filter(mdaio.readmda(clips_file), CLIP_FILTER_LOWCUT, \
+                CLIP_FILTER_HIGHCUT, MountainViewIO.SPIKE_SAMPLING_RATE)
+        print(MODULE_IDENTIFIER + 'Filtered clip data...')
+        pca_filter = PCA(whiten=True)
+        whitened_clip_data = np.matmul(pca_filter.fit_transform(filtered_clip_data).T, filtered_clip_data)
+        print(MODULE_IDENTIFIER + 'Whitened clip data...')
+        return whitened_clip_data
+
+    # Only the parts of the recording around spikes are read (and filtered)
+    # from the memory-mapped file.
+    return mda_stream.memmap_mda(clips_file)
+
+def get_spike_indices(firing_data, timestamp_index, access_timestamped_firings):
+    """
+    Find the firing timepoint in the raw data file. If the firings data is raw
+    data from mountainsort, then you have the indices readily available to
+    you. Otherwise, need to search for clips in the raw data file by timestamp
+    (through the TimestampIndex of the raw data's timestamps).
+    """
+    if access_timestamped_firings:
+        spike_indices = timestamp_index.timestamps_to_samples(firing_data[1])
+        print(MODULE_IDENTIFIER + "Timestamped clips extracted")
+    else:
+        spike_indices = np.array(firing_data[1], dtype='int')
+        print(MODULE_IDENTIFIER + "Indexed clips extracted")
+    return spike_indices
+
+def compute_firing_clips(raw_clip_data, spike_indices, progress_callback=None):
+    """
+    Cut clips for all the spikes out of raw data opened with read_clip_source.
+
+    :returns: Firing clips and their peak amplitudes.
+    """
+    if WHITEN_CLIP_DATA:
+        firing_clips, clip_found = extract_clips(raw_clip_data, spike_indices)
+    else:
+        firing_clips, clip_found = extract_filtered_clips(raw_clip_data, spike_indices, \
+                CLIP_FILTER_LOWCUT, CLIP_FILTER_HIGHCUT, MountainViewIO.SPIKE_SAMPLING_RATE, \
+                progress_callback=progress_callback)
+        print(MODULE_IDENTIFIER + 'Filtered clip data...')
+    if not np.all(clip_found):
+        # Unable to get the complete clip for these spikes, might as well
+        # ignore them... This shouldn't be so common though!
+        print(MODULE_IDENTIFIER + 'WARNING: Unable to read %d spike clips in data'%np.sum(~clip_found))
+    return firing_clips, clip_peak_amplitudes(firing_clips)
+
+def clip_cache_paths(firings_file):
+    """
+    Sidecar files, next to the firings file, in which clips and amplitudes
+    for the firings are cached.
+    """
+    cache_prefix = os.path.splitext(firings_file)[0]
+    return cache_prefix + CLIP_CACHE_EXTENSION, cache_prefix + AMPLITUDE_CACHE_EXTENSION, \
+            cache_prefix + CLIP_CACHE_KEY_EXTENSION
+
+def _file_identity(path):
+    if (path is None) or (not os.path.exists(path)):
+        return None
+    file_stat = os.stat(path)
+    return [os.path.abspath(path), file_stat.st_size, file_stat.st_mtime_ns]
+
+def clip_cache_key(firings_file, clips_file, timestamp_file, access_timestamped_firings):
+    """
+    Describe everything that the clips for a firings file depend on. A cache
+    is only used if its key matches this exactly.
+
+    :timestamp_file: Timestamps used to locate timestamped firings in the
+        clips file (wherever they were found, or chosen by the user)
+    """
+    return {
+            'version': CLIP_CACHE_VERSION,
+            'firings': _file_identity(firings_file),
+            'raw': _file_identity(clips_file),
+            'timestamps': _file_identity(timestamp_file) if access_timestamped_firings else None,
+            'filter': [CLIP_FILTER_LOWCUT, CLIP_FILTER_HIGHCUT, MountainViewIO.SPIKE_SAMPLING_RATE],
+            'whiten': WHITEN_CLIP_DATA,
+            'clip': [FIRING_PRE_CLIP, FIRING_CLIP_SIZE]
+            }
+
+def load_cached_clips(firings_file, cache_key):
+    """
+    Memory-map cached clips and amplitudes for a firings file.
+
+    :returns: Clips and amplitudes, or None if there is no cache or the cache
+        is stale.
+    """
+    clips_cache, amplitudes_cache, key_file = clip_cache_paths(firings_file)
+    try:
+        with open(key_file, 'r') as f:
+            if json.load(f) != cache_key:
+                print(MODULE_IDENTIFIER + 'Stale clip cache for %s'%firings_file)
+                return
+        firing_clips = np.load(clips_cache, mmap_mode='r')
+        firing_amplitudes = np.load(amplitudes_cache, mmap_mode='r')
+    except (FileNotFoundError, IOError, ValueError):
+        return
+    return firing_clips, firing_amplitudes
+
+def save_cached_clips(firings_file, cache_key, firing_clips, firing_amplitudes):
+    """
+    Write clips and amplitudes for a firings file to its cache. The key is
+    removed first and written last, so a partially written cache is never
+    mistaken for a valid one.
+    """
+    clips_cache, amplitudes_cache, key_file = clip_cache_paths(firings_file)
+    try:
+        if os.path.exists(key_file):
+            os.remove(key_file)
+        for cache_file, cache_data in ((clips_cache, firing_clips), (amplitudes_cache, firing_amplitudes)):
+            with open(cache_file + '.tmp', 'wb') as f:
+                np.save(f, cache_data)
+            os.replace(cache_file + '.tmp', cache_file)
+        with open(key_file + '.tmp', 'w') as f:
+            json.dump(cache_key, f, indent=4, separators=(',', ': '))
+        os.replace(key_file + '.tmp', key_file)
+    except (IOError, OSError) as err:
+        print(MODULE_IDENTIFIER + 'Unable to write clip cache for %s'%firings_file)
+        print(err)
+
+def _in_memory_bytes(array):
+    # Memory-mapped arrays are paged in (and out) by the OS as needed
+    if isinstance(array, np.memmap):
+        return 0
+    return array.nbytes
+
+class TetrodeData(object):
+
+    """
+    Everything the viewer shows for a single tetrode. Built away from the GUI
+    thread and swapped into the viewer in one go.
+    """
+
+    def __init__(self, tetrode_id, firing_data, clusters, firing_clips, firing_amplitudes, \
+            timestamp_file, timestamp_index):
+        self.tetrode_id = tetrode_id
+        self.firing_data = firing_data
+        self.clusters = clusters
+        self.cluster_names = clusters.names()
+        self.firing_clips = firing_clips
+        self.firing_amplitudes = firing_amplitudes
+        self.timestamp_file = timestamp_file
+        self.timestamp_index = timestamp_index
+        self.cache_key = None
+
+        # Timestamps are shared by all the tetrodes in a recording, so they do
+        # not count towards the size of a single tetrode.
+        self.n_bytes = firing_data.nbytes + clusters.spike_order.nbytes + clusters.offsets.nbytes + \
+                clusters.labels.nbytes + _in_memory_bytes(firing_clips) + _in_memory_bytes(firing_amplitudes)
+
+class TetrodeCache(object):
+
+    """
+    Least-recently-used cache of loaded tetrodes, bounded by the total size of
+    their arrays.
+    """
+
+    def __init__(self, max_bytes=TETRODE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        tetrode_data = self._entries.get(key)
+        if tetrode_data is not None:
+            self._entries.move_to_end(key)
+        return tetrode_data
+
+    def put(self, key, tetrode_data):
+        self.pop(key)
+        if tetrode_data.n_bytes > self.max_bytes:
+            return
+        self._entries[key] = tetrode_data
+        self.n_bytes += tetrode_data.n_bytes
+        while self.n_bytes > self.max_bytes:
+            _, evicted_data = self._entries.popitem(last=False)
+            self.n_bytes -= evicted_data.n_bytes
+
+    def pop(self, key):
+        tetrode_data = self._entries.pop(key, None)
+        if tetrode_data is not None:
+            self.n_bytes -= tetrode_data.n_bytes
+        return tetrode_data
+
+    def clear(self):
+        self._entries.clear()
+        self.n_bytes = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+class LoadCancelled(Exception):
+
+    """
+    Raised inside a TetrodeLoader to abandon a load that has been cancelled.
+    """
+
+    pass
+
+class TetrodeLoaderSignals(QObject):
+
+    """
+    Signals emitted by a TetrodeLoader. Every signal carries the token of the
+    load it belongs to, so that results of superseded loads can be ignored.
+    """
+
+    progress = pyqtSignal(int, str)
+    finished = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+
+class TetrodeLoader(QRunnable):
+
+    """
+    Read firings, cluster them and extract clips for a tetrode on a worker
+    thread. All the files are located (asking the user if needed) on the GUI
+    thread before the loader is started.
+    """
+
+    def __init__(self, token, cache_key, tetrode_id, firings_file, clips_file, timestamp_file, \
+            timestamp_index, access_timestamped_firings):
+        QRunnable.__init__(self)
+        self.token = token
+        self.cache_key = cache_key
+        self.tetrode_id = tetrode_id
+        self.firings_file = firings_file
+        self.clips_file = clips_file
+        self.timestamp_file = timestamp_file
+        self.timestamp_index = timestamp_index
+        self.access_timestamped_firings = access_timestamped_firings
+        self.signals = TetrodeLoaderSignals()
+        self._cancel_event = threading.Event()
+        self._reported_percentage = -1
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def _report(self, message):
+        # Every progress report doubles up as a cancellation point.
+        if self._cancel_event.is_set():
+            raise LoadCancelled()
+        self.signals.progress.emit(self.token, 'Tetrode %s: %s'%(self.tetrode_id, message))
+
+    def _reportClipProgress(self, fraction):
+        percentage = int(100 * fraction)
+        if percentage == self._reported_percentage:
+            if self._cancel_event.is_set():
+                raise LoadCancelled()
+            return
+        self._reported_percentage = percentage
+        self._report('Extracting clips (%d%%)...'%percentage)
+
+    def run(self):
+        try:
+            self._report('Reading firings...')
+            firing_data = mdaio.readmda(self.firings_file)
+            self._report('Indexing clusters...')
+            clusters = ClusterIndex(firing_data[2])
+
+            timestamp_index = self.timestamp_index
+            if timestamp_index is None:
+                self._report('Indexing timestamps...')
+                timestamp_index = load_timestamp_index(self.timestamp_file)
+
+            clip_key = clip_cache_key(self.firings_file, self.clips_file, self.timestamp_file, \
+                    self.access_timestamped_firings)
+            cached_clips = load_cached_clips(self.firings_file, clip_key)
+            if cached_clips is not None:
+                self._report('Reading cached clips...')
+                firing_clips, firing_amplitudes = cached_clips
+            else:
+                self._report('Reading raw data...')
+                raw_clip_data = read_clip_source(self.clips_file)
+                spike_indices = get_spike_indices(firing_data, timestamp_index, self.access_timestamped_firings)
+                self._report('Extracting clips...')
+                firing_clips, firing_amplitudes = compute_firing_clips(raw_clip_data, spike_indices, \
+                        self._reportClipProgress)
+                del raw_clip_data
+                self._report('Caching clips...')
+                save_cached_clips(self.firings_file, clip_key, firing_clips, firing_amplitudes)
+            self._report('Done.')
+        except LoadCancelled:
+            print(MODULE_IDENTIFIER + 'Load cancelled for tetrode %s'%self.tetrode_id)
+            return
+        except Exception as err:
+            print(MODULE_IDENTIFIER + 'Unable to load tetrode %s'%self.tetrode_id)
+            print(err)
+            self.signals.failed.emit(self.token, str(err))
+            return
+
+        tetrode_data = TetrodeData(self.tetrode_id, firing_data, clusters, firing_clips, \
+                firing_amplitudes, self.timestamp_file, timestamp_index)
+        tetrode_data.cache_key = self.cache_key
+        self.signals.finished.emit(self.token, tetrode_data)
+
 class MLViewer(QMainWindow):
 
     """Docstring for MLViewer. """
@@ -74,6 +585,7 @@ class MLViewer(QMainWindow):
         # The menu item that controls our looking for timestamps in spike mda files.
         self.access_tstamped_selection = None
         self.show_grid_selection = None
+        self.show_density_selection = None
         self.setupMenus()
 
         # Tetrode info fields
@@ -99,6 +611,7 @@ class MLViewer(QMainWindow):
 
         self.access_timestamped_firings = DEFAULT_ACCESS_TIMESTAMPED_SPIKES
         self.show_grid_on_spikes = DEFAULT_SHOW_GRID_ON_SPIKES
+        self.show_density_images = DEFAULT_SHOW_DENSITY_IMAGES
 
         # Data entries
         self.firing_data = None
@@ -112,7 +625,22 @@ class MLViewer(QMainWindow):
         self.firing_limits = (-500, 3000)
         self.session_id = 1
         self.timestamp_file = None
-        self.timestamp_data = None
+        self.timestamp_index = None
+
+        # Tetrodes are loaded in the background. Only the results of the
+        # latest load (identified by its token) are ever shown. Neighbouring
+        # tetrodes are prefetched into the cache on a separate pool.
+        self.thread_pool = QThreadPool()
+        self.prefetch_pool = QThreadPool()
+        self.prefetch_pool.setMaxThreadCount(N_PREFETCH_WORKERS)
+        self.tetrode_loader = None
+        self.pending_loads = dict()
+        self.n_issued_tokens = 0
+        self.load_token = None
+        if args.tetrode_cache is not None:
+            self.tetrode_cache = TetrodeCache(int(args.tetrode_cache * 1024 * 1024 * 1024))
+        else:
+            self.tetrode_cache = TetrodeCache()
 
         # Graphical entities
         self.widget  = QDialog()
@@ -128,6 +656,20 @@ class MLViewer(QMainWindow):
         self._ax_ch2v4 = self.figure.add_subplot(plot_grid[4])
         self._ax_ch3v4 = self.figure.add_subplot(plot_grid[5])
 
+        # Axes along with the channels plotted on them
+        self.channel_pair_axes = [(self._ax_ch1v2, 0, 1), (self._ax_ch1v3, 0, 2), (self._ax_ch1v4, 0, 3), \
+                (self._ax_ch2v3, 1, 2), (self._ax_ch2v4, 1, 3), (self._ax_ch3v4, 2, 3)]
+        self.cluster_artists = dict()
+        self.plotted_clusters = set()
+        self.density_images = list()
+        self.cluster_densities = dict()
+        self.binned_amplitudes = None
+        self.plotted_amplitudes = None
+        self.figure_background = None
+        self.axes_stale = True
+        self.drawn_firing_limits = None
+        self.canvas.mpl_connect('draw_event', self.saveFigureBackground)
+
         self.unit_selection = QComboBox()
         self.unit_selection.activated.connect(self.refresh)
         # Add next and prev buttons to look at individual cells.
@@ -173,6 +715,17 @@ class MLViewer(QMainWindow):
         if not self.show_cluster_widget:
             return
 
+        # Clearing the axes removes all the cluster artists. Density images
+        # depend on the axis limits, so histograms are also recomputed.
+        self.cluster_artists.clear()
+        self.plotted_clusters.clear()
+        self.density_images = list()
+        self.cluster_densities.clear()
+        self.binned_amplitudes = None
+        self.figure_background = None
+        self.axes_stale = False
+        self.drawn_firing_limits = tuple(self.firing_limits)
+
         self._ax_ch1v2.cla()
         self._ax_ch1v2.set_facecolor(FIGURE_BACKGROUND)
         self._ax_ch1v2.grid(self.show_grid_on_spikes)
@@ -274,84 +827,164 @@ class MLViewer(QMainWindow):
     def refresh(self, _):
         """
         Redraw the axes with current firing data.
+
+        Every cluster has a persistent scatter artist on each axis. Artists
+        are animated, i.e., left out of full canvas draws, and blitted on top
+        of the saved (empty) axes instead, so changing the cluster selection
+        or the tetrode only updates artist offsets and visibility.
         """
-        self.clearAxes()
-        if (not self.show_cluster_widget) or  (self.firing_amplitudes is None):
+        if not self.show_cluster_widget:
             return
 
+        full_redraw = False
+        if self.axes_stale or (self.drawn_firing_limits != tuple(self.firing_limits)):
+            # Grid or axis limits changed, the axes have to be drawn again.
+            self.clearAxes()
+            full_redraw = True
+
+        if self.plotted_amplitudes is not self.firing_amplitudes:
+            # New firing data, every artist needs new offsets
+            self.plotted_amplitudes = self.firing_amplitudes
+            self.plotted_clusters.clear()
+            self.cluster_densities.clear()
+            self.binned_amplitudes = None
+
+        selected_clusters = list()
+        if (self.firing_amplitudes is not None) and (self.currently_selected_clusters is not None):
+            selected_clusters = [cl_id for cl_id in self.currently_selected_clusters if cl_id in self.clusters]
+
         taken_colors = list()
-        for cl_id in self.currently_selected_clusters:
-            spikes_in_cluster = self.clusters[cl_id]
-            if len(spikes_in_cluster) > N_SPIKES_TO_PLOT:
-                # Showing the last few spikes.
-                # TODO: This should be redone to show a random set of spikes
-                spikes_in_cluster = spikes_in_cluster[-N_SPIKES_TO_PLOT:]
+        for cl_id in selected_clusters:
+            cluster_color_identifier = int(cl_id) % N_CLUSTER_COLORS
+            if cluster_color_identifier in taken_colors:
+                print(MODULE_IDENTIFIER + "Warning: Color repeated while plotting spikes for cluster %s"%cl_id)
+            taken_colors.append(cluster_color_identifier)
+            if (not self.show_density_images) and (cl_id not in self.plotted_clusters):
+                self.plotCluster(cl_id)
+
+        for cl_id, cluster_artists in self.cluster_artists.items():
+            show_cluster = (not self.show_density_images) and (cl_id in selected_clusters)
+            for artist in cluster_artists:
+                artist.set_visible(show_cluster)
+
+        # There is nothing to bin before clips are extracted (or after the
+        # data has been cleared), so the density images are hidden then.
+        show_density_images = self.show_density_images and (self.firing_amplitudes is not None)
+        if show_density_images:
+            self.plotDensityImages(selected_clusters)
+        for density_image in self.density_images:
+            density_image.set_visible(show_density_images)
+
+        if full_redraw or (self.figure_background is None):
+            self.canvas.draw()
+        else:
+            self.blitClusterArtists()
 
+    def plotCluster(self, cl_id):
+        """
+        Point the artists for a cluster at a subsample of its spikes.
+        """
+        spikes_in_cluster = self.clusters[cl_id]
+        # Showing a stratified random sample of spikes from the entire
+        # recording (seeded by the cluster, so it does not change between redraws)
+        spikes_in_cluster = spikes_in_cluster[stratified_subsample(len(spikes_in_cluster), \
+                N_SPIKES_TO_PLOT, int(cl_id))]
+        cluster_amplitudes = np.asarray(self.firing_amplitudes[spikes_in_cluster])
+
+        if cl_id not in self.cluster_artists:
             cluster_color_identifier = int(cl_id) % N_CLUSTER_COLORS
             cluster_color = colormap.hsv(float(cluster_color_identifier)/N_CLUSTER_COLORS)
 
             # Normalize the cluster color to increase its brightness for the dark background
             # cluster_color = [c_val * 0.25 for c_val in cluster_color]
+            cluster_artists = list()
+            for ax, _, _ in self.channel_pair_axes:
+                cluster_artists.append(ax.scatter([], [], s=SPIKE_MARKER_SIZE, alpha=SPIKE_TRANSPARENCY, \
+                        color=cluster_color, marker='.', lw=SPIKE_MARKER_WIDTH, animated=True))
+            self.cluster_artists[cl_id] = cluster_artists
 
-            if cluster_color_identifier in taken_colors:
-                print(MODULE_IDENTIFIER + "Warning: Color repeated while plotting spikes for cluster %s"%cl_id)
-            taken_colors.append(cluster_color_identifier)
-            # print(spikes_in_cluster)
-
-            # These are the 2D plots
-            self._ax_ch1v2.scatter(self.firing_amplitudes[spikes_in_cluster,0], \
-                    self.firing_amplitudes[spikes_in_cluster,1], s=SPIKE_MARKER_SIZE, \
-                    alpha=SPIKE_TRANSPARENCY, color=cluster_color, marker='.', \
-                    lw=SPIKE_MARKER_WIDTH)
-            self._ax_ch1v3.scatter(self.firing_amplitudes[spikes_in_cluster,0], \
-                    self.firing_amplitudes[spikes_in_cluster,2], s=SPIKE_MARKER_SIZE, \
-                    alpha=SPIKE_TRANSPARENCY, color=cluster_color, marker='.', \
-                    lw=SPIKE_MARKER_WIDTH)
-            self._ax_ch1v4.scatter(self.firing_amplitudes[spikes_in_cluster,0], \
-                    self.firing_amplitudes[spikes_in_cluster,3], s=SPIKE_MARKER_SIZE, \
-                    alpha=SPIKE_TRANSPARENCY, color=cluster_color, marker='.', \
-                    lw=SPIKE_MARKER_WIDTH)
-            self._ax_ch2v3.scatter(self.firing_amplitudes[spikes_in_cluster,1], \
-                    self.firing_amplitudes[spikes_in_cluster,2], s=SPIKE_MARKER_SIZE, \
-                    alpha=SPIKE_TRANSPARENCY, color=cluster_color, marker='.', \
-                    lw=SPIKE_MARKER_WIDTH)
-            self._ax_ch2v4.scatter(self.firing_amplitudes[spikes_in_cluster,1], \
-                    self.firing_amplitudes[spikes_in_cluster,3], s=SPIKE_MARKER_SIZE, \
-                    alpha=SPIKE_TRANSPARENCY, color=cluster_color, marker='.', \
-                    lw=SPIKE_MARKER_WIDTH)
-            self._ax_ch3v4.scatter(self.firing_amplitudes[spikes_in_cluster,2], \
-                    self.firing_amplitudes[spikes_in_cluster,3], s=SPIKE_MARKER_SIZE, \
-                    alpha=SPIKE_TRANSPARENCY, color=cluster_color, marker='.', \
-                    lw=SPIKE_MARKER_WIDTH)
-        self.canvas.draw()
+        for artist, (_, x_channel, y_channel) in zip(self.cluster_artists[cl_id], self.channel_pair_axes):
+            artist.set_offsets(cluster_amplitudes[:, [x_channel, y_channel]])
+        self.plotted_clusters.add(cl_id)
 
-    def fetchTetrodeData(self, _):
+    def plotDensityImages(self, selected_clusters):
         """
-        Fetch spikes and clips/whitened data for the current tetrode and display it.
+        Show all the spikes of the selected clusters as one density image per
+        axis. Histograms are kept for every cluster, so only the compositing
+        has to be redone when the selection changes.
+        """
+        if self.binned_amplitudes is None:
+            self.binned_amplitudes = amplitude_bins(self.firing_amplitudes, self.firing_limits)
+
+        axes_densities = [list() for _ in self.channel_pair_axes]
+        cluster_colors = list()
+        for cl_id in selected_clusters:
+            if cl_id not in self.cluster_densities:
+                cluster_bins = self.binned_amplitudes[self.clusters[cl_id]]
+                self.cluster_densities[cl_id] = [density_histogram(cluster_bins[:, x_channel], \
+                        cluster_bins[:, y_channel]) for _, x_channel, y_channel in self.channel_pair_axes]
+            for ax_idx, density in enumerate(self.cluster_densities[cl_id]):
+                axes_densities[ax_idx].append(density)
+            cluster_colors.append(colormap.hsv(float(int(cl_id) % N_CLUSTER_COLORS)/N_CLUSTER_COLORS))
+
+        image_extent = (self.firing_limits[0], self.firing_limits[1], self.firing_limits[0], self.firing_limits[1])
+        for ax_idx, (ax, _, _) in enumerate(self.channel_pair_axes):
+            density_image = composite_densities(axes_densities[ax_idx], cluster_colors)
+            if ax_idx < len(self.density_images):
+                self.density_images[ax_idx].set_data(density_image)
+            else:
+                self.density_images.append(ax.imshow(density_image, extent=image_extent, origin='lower', \
+                        interpolation='nearest', aspect='auto', animated=True))
+
+    def drawClusterArtists(self):
+        for density_image in self.density_images:
+            if density_image.get_visible():
+                self.figure.draw_artist(density_image)
+        for cluster_artists in self.cluster_artists.values():
+            for artist in cluster_artists:
+                if artist.get_visible():
+                    self.figure.draw_artist(artist)
+
+    def setClusterArtistsAnimated(self, animated):
+        for density_image in self.density_images:
+            density_image.set_animated(animated)
+        for cluster_artists in self.cluster_artists.values():
+            for artist in cluster_artists:
+                artist.set_animated(animated)
+
+    def blitClusterArtists(self):
+        self.canvas.restore_region(self.figure_background)
+        self.drawClusterArtists()
+        self.canvas.blit(self.figure.bbox)
+
+    def saveFigureBackground(self, _):
+        """
+        Save the axes (without any spikes) after every full draw of the canvas,
+        and draw the spikes on top.
+        """
+        self.figure_background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.drawClusterArtists()
+
+    def locateTetrodeFiles(self, tetrode_id, interactive=True):
+        """
+        Find the firings and raw data files for a tetrode.
+
+        :interactive: Ask the user for anything that cannot be found. If
+            unset, missing files are quietly skipped (used for prefetching).
+        :returns: Paths of the firings and raw data files, or None.
         """
-        tetrode_id = self.tetrode_selection.currentText()
-        if self.output_dir is None:
-            self.output_dir = QtHelperUtils.get_directory(message="Choose firings data directory.")
         tetrode_dir = os.path.join(self.output_dir, 'nt' + tetrode_id)
-        if self.access_timestamped_firingS:
+        if self.access_timestamped_firings:
             firings_file = 'firings-' + str(self.session_id) + '.curated.mda'
         else:
             firings_file = 'firings.curated.mda'
         firings_file_path = os.path.join(tetrode_dir, firings_file)
 
         if not os.path.exists(firings_file_path):
-            QtHelperUtils.display_warning('Firings file not found for tetrode %s.'%tetrode_id)
+            if interactive:
+                QtHelperUtils.display_warning('Firings file not found for tetrode %s.'%tetrode_id)
             return
 
-        # Get the spike data
-        self.loadFirings(False, firings_file_path)
-        
-        # Get the clips data
-        # TODO: This approach only works for getting the raw data. For whitened
-        # data, other stuff might be needed.
-        if self.raw_data_location is None:
-            self.raw_data_location = QtHelperUtils.get_directory(message="Choose raw data location.")
-
         # Try to get the clips file first
         clips_file_path = None
         all_raw_files = os.listdir(self.raw_data_location)
@@ -359,10 +992,211 @@ class MLViewer(QMainWindow):
         for raw_file in all_raw_files:
             if tetrode_identifier in raw_file:
                 clips_file_path = os.path.join(self.raw_data_location, raw_file)
-                self.statusBar().showMessage('Found clips file: ' + clips_file_path)
+                if interactive:
+                    self.statusBar().showMessage('Found clips file: ' + clips_file_path)
                 break
-        self.extractClips(False, clips_file_path)
+
+        if (clips_file_path is None) and interactive:
+            clips_file_path = QtHelperUtils.get_open_file_name(data_dir=self.raw_data_location,\
+                    file_format='MDA (*.mda)', message='Choose raw file')
+        if not clips_file_path:
+            return
+        return firings_file_path, clips_file_path
+
+    def getCacheKey(self, firings_file_path, clips_file_path):
+        # Curation rewrites the firings file, which then has to be reloaded
+        return (firings_file_path, os.path.getmtime(firings_file_path), clips_file_path, \
+                self.access_timestamped_firings)
+
+    def startTetrodeLoader(self, tetrode_id, firings_file_path, clips_file_path, timestamp_file, \
+            cache_key, thread_pool):
+        self.n_issued_tokens += 1
+        tetrode_loader = TetrodeLoader(self.n_issued_tokens, cache_key, tetrode_id, firings_file_path, \
+                clips_file_path, timestamp_file, self.timestamp_index, self.access_timestamped_firings)
+        tetrode_loader.signals.progress.connect(self.showLoadProgress)
+        tetrode_loader.signals.finished.connect(self.receiveTetrodeData)
+        tetrode_loader.signals.failed.connect(self.showLoadFailure)
+        self.pending_loads[cache_key] = tetrode_loader
+        thread_pool.start(tetrode_loader)
+        return tetrode_loader
+
+    def fetchTetrodeData(self, _):
+        """
+        Fetch spikes and clips/whitened data for the current tetrode and
+        display it. Tetrodes in the cache are shown immediately, others are
+        loaded on a worker thread and shown once ready.
+        """
+        tetrode_id = self.tetrode_selection.currentText()
+        if self.output_dir is None:
+            self.output_dir = QtHelperUtils.get_directory(message="Choose firings data directory.")
+
+        # Get the clips data
+        # TODO: This approach only works for getting the raw data. For whitened
+        # data, other stuff might be needed.
+        if self.raw_data_location is None:
+            self.raw_data_location = QtHelperUtils.get_directory(message="Choose raw data location.")
+
+        tetrode_files = self.locateTetrodeFiles(tetrode_id)
+        if tetrode_files is None:
+            return
+        firings_file_path, clips_file_path = tetrode_files
+
+        # Nothing that is still loading should replace this tetrode. The load
+        # for the tetrode selected before is stopped, unless it is this one.
+        cache_key = self.getCacheKey(firings_file_path, clips_file_path)
+        if (self.tetrode_loader is not None) and (self.tetrode_loader.cache_key != cache_key):
+            self.stopTetrodeLoader()
+        self.tetrode_loader = None
+        self.load_token = None
+        cached_data = self.tetrode_cache.get(cache_key)
+        if cached_data is not None:
+            self.showTetrodeData(cached_data)
+            return
+
+        if cache_key in self.pending_loads:
+            # Already being prefetched, wait for that to finish
+            self.tetrode_loader = self.pending_loads[cache_key]
+            self.load_token = self.tetrode_loader.token
+            self.statusBar().showMessage('Loading tetrode %s...'%tetrode_id)
+            return
+
+        # Dialogs can only be shown from the GUI thread, so the timestamps
+        # file is located here, before the load starts.
+        timestamp_file = self.timestamp_file
+        if self.timestamp_index is None:
+            timestamp_file = self.findTimestampFile(clips_file_path)
+            if not timestamp_file:
+                return
+
+        self.tetrode_loader = self.startTetrodeLoader(tetrode_id, firings_file_path, clips_file_path, \
+                timestamp_file, cache_key, self.thread_pool)
+        self.load_token = self.tetrode_loader.token
+        self.statusBar().showMessage('Loading tetrode %s...'%tetrode_id)
+
+    def prefetchNeighbours(self):
+        """
+        Load the tetrodes next to the current one (in menu order) into the
+        cache, and stop prefetching tetrodes that are no longer neighbours.
+        """
+        current_tetrode_idx = self.tetrode_selection.currentIndex()
+        wanted_keys = set()
+        for offset in range(1, N_PREFETCH_NEIGHBOURS+1):
+            for tetrode_idx in (current_tetrode_idx + offset, current_tetrode_idx - offset):
+                if (tetrode_idx < 0) or (tetrode_idx >= self.tetrode_selection.count()):
+                    continue
+                tetrode_id = self.tetrode_selection.itemText(tetrode_idx)
+                tetrode_files = self.locateTetrodeFiles(tetrode_id, interactive=False)
+                if tetrode_files is None:
+                    continue
+                cache_key = self.getCacheKey(*tetrode_files)
+                wanted_keys.add(cache_key)
+                if (cache_key in self.tetrode_cache) or (cache_key in self.pending_loads):
+                    continue
+                self.startTetrodeLoader(tetrode_id, tetrode_files[0], tetrode_files[1], \
+                        self.timestamp_file, cache_key, self.prefetch_pool)
+
+        for cache_key, tetrode_loader in list(self.pending_loads.items()):
+            if (cache_key not in wanted_keys) and (tetrode_loader is not self.tetrode_loader):
+                tetrode_loader.cancel()
+                del self.pending_loads[cache_key]
+
+    def findTimestampFile(self, clips_file):
+        """
+        Try finding the timestamps in the same location... Usually, data file
+        is stored alongside the timestamp file.
+        """
+        timestamp_file = clips_file.split('.nt')[0] + '.timestamps.mda'
+        if not os.path.exists(timestamp_file):
+            timestamp_file = QtHelperUtils.get_open_file_name(data_dir=self.raw_data_location,\
+                    file_format='MDA (*.mda)', message='Choose timestamps file') 
+        return timestamp_file
+
+    def stopTetrodeLoader(self):
+        """
+        Stop the tetrode load in progress (if any).
+
+        :returns: True if a load was stopped.
+        """
+        if self.tetrode_loader is None:
+            return False
+        self.tetrode_loader.cancel()
+        self.pending_loads.pop(self.tetrode_loader.cache_key, None)
+        self.tetrode_loader = None
+        # Anything that the cancelled load still reports will be ignored
+        self.load_token = None
+        return True
+
+    def stopAllLoaders(self):
+        self.stopTetrodeLoader()
+        for tetrode_loader in self.pending_loads.values():
+            tetrode_loader.cancel()
+        self.pending_loads.clear()
+
+    def cancelLoad(self, _):
+        """
+        Cancel the tetrode load in progress, leaving the current display as is.
+        """
+        if self.stopTetrodeLoader():
+            self.statusBar().showMessage('Load cancelled.')
+
+    def showLoadProgress(self, token, message):
+        if token == self.load_token:
+            self.statusBar().showMessage(message)
+
+    def showLoadFailure(self, token, message):
+        for cache_key, tetrode_loader in list(self.pending_loads.items()):
+            if tetrode_loader.token == token:
+                del self.pending_loads[cache_key]
+
+        if token != self.load_token:
+            # Failed prefetches are retried if the tetrode is selected
+            return
+        self.tetrode_loader = None
+        self.load_token = None
+        self.statusBar().showMessage('Unable to load tetrode.')
+        QtHelperUtils.display_warning('Unable to load tetrode data. ' + message)
+
+    def receiveTetrodeData(self, token, tetrode_data):
+        """
+        Cache a tetrode that has finished loading, and show it if it is the
+        one currently selected.
+        """
+        tetrode_loader = self.pending_loads.get(tetrode_data.cache_key)
+        if (tetrode_loader is not None) and (tetrode_loader.token == token):
+            del self.pending_loads[tetrode_data.cache_key]
+        self.tetrode_cache.put(tetrode_data.cache_key, tetrode_data)
+        if self.timestamp_index is None:
+            self.timestamp_file = tetrode_data.timestamp_file
+            self.timestamp_index = tetrode_data.timestamp_index
+
+        if token != self.load_token:
+            # Prefetched, or superseded by a later load
+            return
+        self.tetrode_loader = None
+        self.load_token = None
+        self.showTetrodeData(tetrode_data)
+
+    def showTetrodeData(self, tetrode_data):
+        """
+        Swap in the data for a loaded tetrode.
+        """
+        self.firing_data = tetrode_data.firing_data
+        self.clusters = tetrode_data.clusters
+        self.cluster_names = tetrode_data.cluster_names
+        self.firing_clips = tetrode_data.firing_clips
+        self.firing_amplitudes = tetrode_data.firing_amplitudes
+        self.timestamp_file = tetrode_data.timestamp_file
+        self.timestamp_index = tetrode_data.timestamp_index
+        self.firing_limits = [-100, 2000]
+
+        self.getCurrentClusterSelection()
+        self.populateUnitMenu()
+        if not self.show_cluster_widget:
+            self.showCluterWidget()
+        self.statusBar().showMessage(str(len(self.firing_data[1])) + ' firing clips loaded for tetrode ' + \
+                str(tetrode_data.tetrode_id))
         self.refresh(False)
+        self.prefetchNeighbours()
 
     def extractWhitened(self, _, clips_file=None):
         """
@@ -394,75 +1228,23 @@ class MLViewer(QMainWindow):
                     file_format='MDA (*.mda)', message='Choose raw file')
 
         try:
-            # raw_clip_data = normalize(mdaio.readmda(clips_file), axis=1)
-            # raw_clip_data = mdaio.readmda(clips_file)
-            filtered_clip_data = butter_bandpass_filter(mdaio.readmda(clips_file), 600, 6000, \
-                    MountainViewIO.SPIKE_SAMPLING_RATE)
-            print(MODULE_IDENTIFIER + 'Filtered clip data...')
-            if WHITEN_CLIP_DATA:
-                pca_filter = PCA(whiten=True)
-                raw_clip_data = np.matmul(pca_filter.fit_transform(filtered_clip_data).T, filtered_clip_data)
-                print(MODULE_IDENTIFIER + 'Whitened clip data...')
-            else:
-                raw_clip_data = filtered_clip_data
-        except (FileNotFoundError, IOError) as err:
+            raw_clip_data = read_clip_source(clips_file)
+        except (FileNotFoundError, IOError, ValueError) as err:
             QtHelperUtils.display_warning('Unable to read MDA file.')
             return
 
-        # Try reading the timestamps from the same location... Usually, data
-        # file is stored alongside the timestamp file.
-        if self.timestamp_data is None:
-            timestamp_file = clips_file.split('.nt')[0] + '.timestamps.mda'
-            if not os.path.exists(timestamp_file):
-                timestamp_file = QtHelperUtils.get_open_file_name(data_dir=self.raw_data_location,\
-                        file_format='MDA (*.mda)', message='Choose timestamps file') 
-
+        if self.timestamp_index is None:
+            timestamp_file = self.findTimestampFile(clips_file)
             try:
-                self.timestamp_data = mdaio.readmda(timestamp_file)
-            except (FileNotFoundError, IOError) as err:
+                self.timestamp_index = load_timestamp_index(timestamp_file)
+                self.timestamp_file = timestamp_file
+            except (FileNotFoundError, IOError, ValueError) as err:
                 QtHelperUtils.display_warning('Unable to read timestamps file.')
                 return
 
         n_spikes = len(self.firing_data[1])
-        self.firing_clips = np.empty((n_spikes, N_ELECTRODE_CHANNELS, \
-                FIRING_CLIP_SIZE), dtype=float)
-        self.firing_amplitudes = np.empty((n_spikes, N_ELECTRODE_CHANNELS), \
-                dtype=float)
-
-        # Find the firing timepoint in the raw data file. If the firings data
-        # is raw data from mountainsort, then you have the indices readily
-        # available to you. Otherwise, need to search for clips in the raw data
-        # file by timestamp.
-
-        # spike_indices = np.searchsorted(self.timestamp_data, self.firing_data[1])
-        if self.access_timestamped_firings:
-            spike_indices = np.searchsorted(self.timestamp_data, self.firing_data[1])
-            print(self.timestamp_data)
-            print(spike_indices)
-            print(MODULE_IDENTIFIER + "Timestamped clips extracted")
-        else:
-            spike_indices = np.array(self.firing_data[1], dtype='int')
-            print(MODULE_IDENTIFIER + "Indexed clips extracted")
-            # print(spike_indices)
-
-
-        for spk_idx in range(n_spikes):
-            if (spike_indices[spk_idx] < FIRING_PRE_CLIP) or (spike_indices[spk_idx]+FIRING_POST_CLIP>len(self.timestamp_data)):
-                # Unable to get the complete clip for this spike, might as well
-                # ignore it... This shouldn't be so common though!
-                self.firing_clips[spk_idx, :, :] = 0.0
-                self.firing_amplitudes[spk_idx, :] = 0.0
-                print(MODULE_IDENTIFIER + 'WARNING: Unable to read spike clip in data')
-                continue
-            self.firing_clips[spk_idx, :, :] = raw_clip_data[:,spike_indices[spk_idx]-FIRING_PRE_CLIP:spike_indices[spk_idx]+FIRING_POST_CLIP]
-            # Raw data has negative spike amplitudes which need to be corrected.
-            # self.firing_amplitudes = np.max(self.firing_clips, axis=2)
-
-            # The index we get here will be for the spike peak in the entrie
-            # 4 x clip data. We need to convert it into a (channel,sample_value)
-            peak_amplitude_idx = np.argmin(self.firing_clips[spk_idx,:,:])
-            peak_sample_loc    = np.unravel_index(peak_amplitude_idx, (N_ELECTRODE_CHANNELS, FIRING_CLIP_SIZE))
-            self.firing_amplitudes[spk_idx,:] = -self.firing_clips[spk_idx,:,peak_sample_loc[1]]
+        spike_indices = get_spike_indices(self.firing_data, self.timestamp_index, self.access_timestamped_firings)
+        self.firing_clips, self.firing_amplitudes = compute_firing_clips(raw_clip_data, spike_indices)
 
         print(self.firing_amplitudes.shape)
         # self.firing_limits = (max(-500,np.min(self.firing_amplitudes)), \
@@ -499,12 +1281,17 @@ class MLViewer(QMainWindow):
         # save_file_name = QtHelperUtils.get_save_file_name(data_dir=self.output_dir, file_format='Image File (*.jpg)', message="Choose a screenshot name")
         save_file_name = time.strftime("T" + str(self.tetrode_selection.currentText()) + "U" + str(self.unit_selection.currentText()) + "_%Y%m%d_%H%M%S.png") 
         save_success = False
+        # Animated (blitted) artists are left out of saved figures unless they
+        # are temporarily made regular artists.
+        self.setClusterArtistsAnimated(False)
         try:
             self.figure.savefig(save_file_name)
             save_success = True
         except Exception as err:
             print(MODULE_IDENTIFIER + "Unable to save current display.")
             print(err)
+        finally:
+            self.setClusterArtistsAnimated(True)
 
         if save_success:
             self.statusBar().showMessage("Screenshot saved to %s"%save_file_name)
@@ -580,13 +1367,8 @@ class MLViewer(QMainWindow):
             self.populateTetrodeMenu(current_tetrode)
         try:
             self.firing_data = mdaio.readmda(firings_filename)
-            self.cluster_names = list()
-            self.clusters = dict()
-            for spike_idx, spike_data in enumerate(np.array(self.firing_data[2], dtype='int')):
-                if spike_data not in self.clusters:
-                    self.cluster_names.append(spike_data)
-                    self.clusters[spike_data] = list()
-                self.clusters[spike_data].append(spike_idx)
+            self.clusters = ClusterIndex(self.firing_data[2])
+            self.cluster_names = self.clusters.names()
 
             # Assign unique color to each cluster so that the values do not
             # change as you add or remove them
@@ -607,9 +1389,15 @@ class MLViewer(QMainWindow):
         self.access_tstamped_selection.setChecked(state)
         self.access_timestamped_firings = state
 
+    def toggleDensityImages(self, state):
+        self.show_density_selection.setChecked(state)
+        self.show_density_images = state
+        self.refresh(False)
+
     def toggleShowGrids(self, state):
         self.show_grid_selection.setChecked(state)
         self.show_grid_on_spikes = state
+        self.axes_stale = True
         self.refresh(False)
 
     def loadClusterFile(self, _):
@@ -697,6 +1485,8 @@ class MLViewer(QMainWindow):
         QtHelperUtils.display_warning('Function not implemented!')
 
     def clearData(self):
+        self.stopAllLoaders()
+        self.tetrode_cache.clear()
         self.firing_data = None
         self.firing_clips = None
         self.firing_amplitudes = None
@@ -708,7 +1498,7 @@ class MLViewer(QMainWindow):
         self.firing_limits = (-500, 3000)
         self.session_id = 1
         self.timestamp_file = None
-        self.timestamp_data = None
+        self.timestamp_index = None
 
     def selectOutputDirectory(self):
         """
@@ -748,6 +1538,12 @@ class MLViewer(QMainWindow):
         clear_action.setStatusTip('Clear/Reset all the data saved in the application')
         clear_action.triggered.connect(self.clearData)
 
+        # Stop loading the current tetrode
+        cancel_load_action = file_menu.addAction('Cancel &Load')
+        cancel_load_action.setShortcut('Ctrl+K')
+        cancel_load_action.setStatusTip('Stop loading the current tetrode')
+        cancel_load_action.triggered.connect(self.cancelLoad)
+
         # =============== SAVE MENU =============== 
         save_menu = file_menu.addMenu('&Save')
         save_screenshot_menu = save_menu.addAction('&Screenshot')
@@ -809,7 +1605,13 @@ class MLViewer(QMainWindow):
         self.show_grid_selection.triggered.connect(self.toggleShowGrids)
 
         preferences_menu.addAction(self.access_tstamped_selection)
+        self.show_density_selection = QAction('Show &density', self, checkable=True)
+        self.show_density_selection.setStatusTip('Show all spikes as density images instead of scatter plots')
+        self.show_density_selection.setChecked(DEFAULT_SHOW_DENSITY_IMAGES)
+        self.show_density_selection.triggered.connect(self.toggleDensityImages)
+
         preferences_menu.addAction(self.show_grid_selection)
+        preferences_menu.addAction(self.show_density_selection)
 
         directories_menu = preferences_menu.addMenu('&Directories')
         output_dir_selection = directories_menu.addAction('&Output directory')
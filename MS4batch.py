@@ -10,7 +10,9 @@ import ms4_franklab_pyplines as pyp
 import ms4_franklab_proc2py as p2p
 from distutils.dir_util import copy_tree
 from shutil import move
-from tkinter import Tk, filedialog
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ms4_pipeline_graph import PipelineGraph, STAGE_DONE, STAGE_FAILED, STAGE_BLOCKED
 
 MODULE_IDENTIFIER = '[MS4Pipeline] '
 MDA_UTIL_FILENAME = 'mda_util.py'
@@ -20,6 +22,11 @@ RAW_DIR_NAME      = '/raw'
 MOUNTAIN_DIR_NAME = '/mountain'
 ML_PRV_CREATOR    = 'ml-prv-create'
 ML_TMP_DIR        = '/tmp/mountainlab-tmp'
+TETRODE_LOG_FILENAME = '/ms4batch.log'
+N_STAGE_WORKERS   = 2
+PREPROCESS_FREQ_MIN = 300
+PREPROCESS_FREQ_MAX = 6000
+SORT_PARAMS = {'adjacency_radius': -1, 'detect_threshold': 3, 'detect_sign': -1}
 
 def setup_NT_links(working_dir):
     """
@@ -62,10 +69,234 @@ def setup_NT_links(working_dir):
             output_file_path = destlink + '/' + mda_file_name + '.raw.mda.prv'
             subprocess.call([ML_PRV_CREATOR, mda_file_path, output_file_path])
 
-def run_pipeline(source_dirs, results_dir, tetrode_range, do_mask_artifacts=True, clear_files=False):
+def _preprocess_tetrode(nt_out_dir, mountainlab_tmp_path, do_mask_artifacts, clear_files):
+    """
+    Filter, mask out artifacts and whiten the concatenated epochs. Intermediate
+    RAW and MASK files are cleared, or moved out of the output directory.
+    """
+    pyp.filt_mask_whiten(dataset_dir=nt_out_dir,output_dir=nt_out_dir, freq_min=PREPROCESS_FREQ_MIN, \
+            freq_max=PREPROCESS_FREQ_MAX, mask_artifacts=do_mask_artifacts,opts={})
+    if clear_files:
+        print(MODULE_IDENTIFIER + "Cleaning RAW, FILT, MASK files.")
+        mda_util.clear_mda(nt_out_dir + pyp.CONCATENATED_EPOCHS_FILE + '.prv')
+        # Keeping FILT Files for later use.
+        # mda_util.clear_mda(nt_out_dir + pyp.FILT_FILENAME)
+        if do_mask_artifacts:
+            mda_util.clear_mda(nt_out_dir + pyp.MASK_FILENAME)
+    else:
+        # mda_util.relocate_mda(nt_out_dir + pyp.FILT_FILENAME, mountainlab_tmp_path)
+        if do_mask_artifacts:
+            mda_util.relocate_mda(nt_out_dir + pyp.MASK_FILENAME, mountainlab_tmp_path)
+
+def _sort_preprocessed_tetrode(source_dirs, nt_src_dir, nt_out_dir):
+    """
+    Run the sort (and compute raw cluster metrics) on preprocessed data.
+    """
+    if len(source_dirs) > 1:
+        #Caitlin added dir_names as input
+        pyp.ms4_sort_on_segs(dirnames=source_dirs, dataset_dir=nt_src_dir,output_dir=nt_out_dir, opts={}, **SORT_PARAMS)
+    else:
+        pyp.ms4_sort_full(dataset_dir=nt_src_dir,output_dir=nt_out_dir, opts={}, **SORT_PARAMS)
+
+def sort_tetrode(nt, source_dirs, mountain_src_path, mountain_res_path, mountainlab_tmp_path, \
+        do_mask_artifacts=True, clear_files=False, adopt_existing=False):
+    """
+    Run concatenation, filtering/masking/whitening, sorting, metrics and
+    template generation for a single tetrode. Steps are run through a
+    PipelineGraph, so only the ones whose inputs or parameters have changed
+    since they were last run (or whose outputs are missing) are rerun.
+
+    :nt: Tetrode index
+    :adopt_existing: Treat outputs of earlier runs (made before stages were
+        being tracked) as current.
+    :returns: True if the tetrode was sorted, False otherwise.
+    """
+
+    nt_src_dir = mountain_src_path+'/nt'+str(nt)
+    nt_out_dir = mountain_res_path+'/nt'+str(nt)
+    mda_util.make_sure_path_exists(nt_out_dir)
+
+    # 12/8/21: Caitlin Mallory: IMPORTANT BUG FIX!! the prv_list was being generated in a random order, instead of the order in which the epochs were specified.
+    # This resulted in epochs sometimes being concatentated in the wrong order. Changed mda_utils.get_prv_files_in to take the source_dirs as an input and ensure 
+    # that prv files are returned in the specified order.
+    prv_list=mda_util.get_prv_files_in(nt_src_dir,source_dirs)
+    epoch_prv_files = [nt_src_dir + '/' + prv_file for prv_file in prv_list]
+
+    graph = PipelineGraph(nt_out_dir, n_workers=N_STAGE_WORKERS)
+
+    # concatenate all eps, since ms4 no longer takes a list of mdas; save as raw.mda
+    # save this to the output dir; it serves as src for subsequent steps
+    graph.add_stage('concat', 'mda_stream.concat_timeseries', \
+            partial(pyp.concat_eps, dataset_dir=nt_src_dir, output_dir=nt_out_dir, prv_list=prv_list, \
+            mode=pyp.CONCAT_MODE_STREAM), outputs=[nt_out_dir + pyp.CONCATENATED_EPOCHS_FILE], \
+            inputs=epoch_prv_files, params={'epochs': prv_list}, intermediate=True)
+
+    # preprocessing: filter, mask out artifacts whiten
+    graph.add_stage('preprocess', 'pyp.filt_mask_whiten', \
+            partial(_preprocess_tetrode, nt_out_dir, mountainlab_tmp_path, do_mask_artifacts, clear_files), \
+            outputs=[nt_out_dir + pyp.FILT_FILENAME, nt_out_dir + pyp.PRE_FILENAME], depends_on=['concat'], \
+            params={'freq_min': PREPROCESS_FREQ_MIN, 'freq_max': PREPROCESS_FREQ_MAX, \
+            'mask_artifacts': do_mask_artifacts})
+
+    # run the actual sort
+    sort_params = dict(SORT_PARAMS)
+    sort_params['sort_on_segments'] = (len(source_dirs) > 1)
+    graph.add_stage('sort', 'ms4alg.sort', \
+            partial(_sort_preprocessed_tetrode, source_dirs, nt_src_dir, nt_out_dir), \
+            outputs=[nt_out_dir + pyp.FIRINGS_FILENAME, nt_out_dir + pyp.RAW_METRICS_FILE], \
+            depends_on=['preprocess'], params=sort_params)
+
+    # 2020-02-21: There seems to be some issue with the metrics tagging step
+    # at the moment. Since we are going to do this in as automated a way as
+    # possible, might as well just go from raw metrics to cleaned metrics,
+    # skipping the metrics tagging step in between.
+    graph.add_stage('cleanup_metrics', 'pyp.cleanup_metrics', \
+            partial(pyp.cleanup_metrics, metrics_file=nt_out_dir+'/metrics_raw.json', \
+            metrics_out=nt_out_dir+'/metrics_cleaned.json'), \
+            outputs=[nt_out_dir + '/metrics_cleaned.json'], depends_on=['sort'])
+
+    # Generate templates for MountainView - Use the filt file for generating
+    # templates. This only needs the firings, so it can run alongside the
+    # metrics cleanup.
+    graph.add_stage('templates', 'mv.mv_compute_templates', \
+            partial(pyp.generate_templates, dataset_dir=nt_out_dir, output_dir=nt_out_dir, opts={}), \
+            outputs=[nt_out_dir + pyp.TEMPLATES_FILE, nt_out_dir + pyp.TEMPLATE_STDS_FILE], \
+            depends_on=['preprocess', 'sort'])
+
+    if (os.path.isfile(nt_out_dir + '/hand_curated.json')):
+        graph.add_stage('hand_curation', 'pyms.add_curation_tags', \
+                partial(pyp.add_curation_tags, dataset_dir=nt_out_dir, output_dir=nt_out_dir, hand_curation=True), \
+                outputs=[nt_out_dir + '/metrics_curated.json'], \
+                inputs=[nt_out_dir + '/hand_curated.json', nt_out_dir + '/hand_curated.mv2'], \
+                depends_on=['sort'])
+
+    stage_status = graph.run(adopt_existing=adopt_existing)
+
+    if stage_status['preprocess'] == STAGE_DONE:
+        mda_util.relocate_mda(nt_out_dir + pyp.PRE_FILENAME, mountainlab_tmp_path)
+        mda_util.relocate_mda(nt_out_dir + pyp.FILT_FILENAME, mountainlab_tmp_path)
+
+    failed_stages = [stage_name for stage_name in graph.stage_order \
+            if stage_status[stage_name] in (STAGE_FAILED, STAGE_BLOCKED)]
+    if failed_stages:
+        print('ERROR: Unable to sort T%d. Stages not completed: %s'%(nt, ', '.join(failed_stages)))
+        return False
+    return True
+
+def _get_worker_count(n_workers, worker_memory, n_tetrodes):
+    """
+    Limit the number of sorting workers by the number of tetrodes and, if a
+    per-worker memory budget is specified, by the physical memory available.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = min(n_workers, n_tetrodes)
+
+    if worker_memory:
+        try:
+            physical_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+            memory_bound_workers = max(1, int(physical_memory // worker_memory))
+            if memory_bound_workers < n_workers:
+                print(MODULE_IDENTIFIER + 'Memory budget allows only %d workers.'%memory_bound_workers)
+                n_workers = memory_bound_workers
+        except (ValueError, OSError) as err:
+            print(MODULE_IDENTIFIER + 'Unable to read physical memory size.')
+            print(err)
+    return max(1, n_workers)
+
+def _init_sort_worker(worker_memory):
+    """
+    Initializer for sorting worker processes. The memory budget limits the
+    data segment (heap and private writable mappings) of the worker, and of
+    each MountainSort processor it launches, which inherit the limit. Address
+    space (RLIMIT_AS) is not limited: reserved but unused virtual memory
+    (thread stacks, memory-mapped inputs) would count against it, and every
+    child would have to fit in the whole budget on top of that.
+    """
+    if worker_memory:
+        import resource
+        resource.setrlimit(resource.RLIMIT_DATA, (int(worker_memory), int(worker_memory)))
+
+def _sort_tetrode_in_worker(nt, sort_args):
+    """
+    Sort a single tetrode in a worker process, writing everything that it
+    prints (including the output of MountainSort processors) to a log file in
+    the tetrode's output directory.
+    """
+    nt_out_dir = sort_args[2] + '/nt' + str(nt)
+    mda_util.make_sure_path_exists(nt_out_dir)
+    log_filename = nt_out_dir + TETRODE_LOG_FILENAME
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout = os.dup(1)
+    saved_stderr = os.dup(2)
+    try:
+        with open(log_filename, 'a') as log_file:
+            os.dup2(log_file.fileno(), 1)
+            os.dup2(log_file.fileno(), 2)
+            try:
+                return sort_tetrode(nt, *sort_args)
+            except Exception as err:
+                print(err)
+                print('ERROR: Unable to sort T%d.'%nt)
+                return False
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+    finally:
+        os.dup2(saved_stdout, 1)
+        os.dup2(saved_stderr, 2)
+        os.close(saved_stdout)
+        os.close(saved_stderr)
+
+def run_parallel_sort(tetrode_range, sort_args, n_workers, worker_memory=None):
+    """
+    Sort several tetrodes at once using a pool of worker processes.
+
+    :tetrode_range: Tetrodes to be sorted
+    :sort_args: Arguments (following the tetrode index) for sort_tetrode
+    :n_workers: Number of tetrodes to be sorted simultaneously
+    :worker_memory: Memory budget (in bytes) for each worker
+    :returns: List of tetrodes that could not be sorted.
+    """
+
+    print(MODULE_IDENTIFIER + 'Sorting %d tetrodes with %d workers.'%(len(tetrode_range), n_workers))
+    failed_tetrodes = list()
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_sort_worker, \
+            initargs=(worker_memory,)) as executor:
+        sort_jobs = dict()
+        for nt in tetrode_range:
+            sort_jobs[executor.submit(_sort_tetrode_in_worker, nt, sort_args)] = nt
+
+        for job in as_completed(sort_jobs):
+            nt = sort_jobs[job]
+            try:
+                sorted_successfully = job.result()
+            except Exception as err:
+                # Worker died (for example, by running out of its memory budget)
+                print(err)
+                sorted_successfully = False
+
+            if sorted_successfully:
+                print(MODULE_IDENTIFIER + 'Finished T%d.'%nt)
+            else:
+                print(MODULE_IDENTIFIER + 'ERROR: Unable to sort T%d. See %s for details.'%(nt, \
+                        sort_args[2] + '/nt' + str(nt) + TETRODE_LOG_FILENAME))
+                failed_tetrodes.append(nt)
+    return sorted(failed_tetrodes)
+
+def run_pipeline(source_dirs, results_dir, tetrode_range, do_mask_artifacts=True, clear_files=False, \
+        n_workers=1, worker_memory=None, adopt_existing=False):
     # Get the path for this file -> And then the directory in which this file
     # is located. We do expect mda_utils to be in the same location as this
 
+    # n_workers tetrodes are sorted simultaneously, each in its own process
+    # with (optionally) worker_memory bytes of memory available to it. The
+    # budget sizes the pool and limits the data segment of each process.
+    # adopt_existing marks outputs from runs made before pipeline stages were
+    # tracked as current (see sort_tetrode).
+
     n_epochs_to_sort = len(source_dirs)
     print(MODULE_IDENTIFIER + 'Merging/sorting %d epochs.'%n_epochs_to_sort)
     current_file_dir = os.path.dirname(os.path.abspath(__file__))
@@ -112,108 +343,19 @@ def run_pipeline(source_dirs, results_dir, tetrode_range, do_mask_artifacts=True
     if not os.path.exists(templates_directory):
         os.mkdir(templates_directory)
 
-    for nt in tetrode_range:
-        nt_src_dir = mountain_src_path+'/nt'+str(nt)
-        nt_out_dir = mountain_res_path+'/nt'+str(nt)
-        mda_util.make_sure_path_exists(nt_out_dir)
-
-        move_filt_mask_whiten_files = False
-        if (not os.path.isfile(nt_out_dir + pyp.PRE_FILENAME)) or (not os.path.isfile(nt_out_dir + pyp.FILT_FILENAME)):
-            # concatenate all eps, since ms4 no longer takes a list of mdas; save as raw.mda
-            # save this to the output dir; it serves as src for subsequent steps
-
-
-            # 12/8/21: Caitlin Mallory: IMPORTANT BUG FIX!! the prv_list was being generated in a random order, instead of the order in which the epochs were specified.
-            # This resulted in epochs sometimes being concatentated in the wrong order. Changed mda_utils.get_prv_files_in to take the source_dirs as an input and ensure 
-            # that prv files are returned in the specified order.
-
-            prv_list=mda_util.get_prv_files_in(nt_src_dir,source_dirs)
-
-
-            print('Concatenating Epochs: ' + ', '.join(prv_list))
+    n_workers = _get_worker_count(n_workers, worker_memory, len(tetrode_range))
+    sort_args = (source_dirs, mountain_src_path, mountain_res_path, mountainlab_tmp_path, \
+            do_mask_artifacts, clear_files, adopt_existing)
+    if n_workers < 2:
+        failed_tetrodes = list()
+        for nt in tetrode_range:
+            if not sort_tetrode(nt, *sort_args):
+                failed_tetrodes.append(nt)
+    else:
+        failed_tetrodes = run_parallel_sort(tetrode_range, sort_args, n_workers, worker_memory)
 
-            if not os.path.isfile(nt_out_dir + pyp.CONCATENATED_EPOCHS_FILE):
-                pyp.concat_eps(dataset_dir=nt_src_dir, output_dir=nt_out_dir, prv_list=prv_list)
-            else:
-                print(MODULE_IDENTIFIER + "Raw file with concatenated epochs found. Using file!")
-            
-            # preprocessing: filter, mask out artifacts whiten
-            if not os.path.isfile(nt_out_dir + pyp.FILT_FILENAME):
-                pyp.filt_mask_whiten(dataset_dir=nt_out_dir,output_dir=nt_out_dir, freq_min=300,freq_max=6000, \
-                        mask_artifacts=do_mask_artifacts,opts={})
-                if clear_files:
-                    print(MODULE_IDENTIFIER + "Cleaning RAW, FILT, MASK files.")
-                    mda_util.clear_mda(nt_out_dir + pyp.CONCATENATED_EPOCHS_FILE + '.prv')
-                    # Keeping FILT Files for later use.
-                    # mda_util.clear_mda(nt_out_dir + pyp.FILT_FILENAME)
-                    if do_mask_artifacts:
-                        mda_util.clear_mda(nt_out_dir + pyp.MASK_FILENAME)
-                else:
-                    # mda_util.relocate_mda(nt_out_dir + pyp.FILT_FILENAME, mountainlab_tmp_path)
-                    if do_mask_artifacts:
-                        mda_util.relocate_mda(nt_out_dir + pyp.MASK_FILENAME, mountainlab_tmp_path)
-                move_filt_mask_whiten_files = True
-            else:
-                print(MODULE_IDENTIFIER + "Filt, Mask, Pre files with concatenated epochs found. Using file!")
-        else:
-            print(MODULE_IDENTIFIER + "PRE file with concatenated epochs found. Using file!")
-        
-        # If sorting has already happened, move on...
-        if (os.path.isfile(nt_out_dir + pyp.FIRINGS_FILENAME) and os.path.isfile(nt_out_dir + pyp.TAGGED_METRICS_FILE)):
-            print(MODULE_IDENTIFIER + 'Tetrode %d seems to have been sorted. Continuing...'%nt)
-        else:
-            # run the actual sort
-            if not (os.path.isfile(nt_out_dir + pyp.FIRINGS_FILENAME) and os.path.isfile(nt_out_dir + pyp.RAW_METRICS_FILE)):
-                try:
-                    if n_epochs_to_sort > 1:
-                        #Caitlin added dir_names as input
-                        pyp.ms4_sort_on_segs(dirnames=source_dirs, dataset_dir=nt_src_dir,output_dir=nt_out_dir, adjacency_radius=-1,detect_threshold=3, detect_sign=-1, opts={})
-                    else:
-                        pyp.ms4_sort_full(dataset_dir=nt_src_dir,output_dir=nt_out_dir, adjacency_radius=-1,detect_threshold=3, detect_sign=-1, opts={})
-                except Exception as err:
-                    print(err)
-                    print('ERROR: Unable to sort T%d.'%nt)
-
-                    if move_filt_mask_whiten_files:
-                        mda_util.relocate_mda(nt_out_dir + pyp.PRE_FILENAME, mountainlab_tmp_path)
-                        mda_util.relocate_mda(nt_out_dir + pyp.FILT_FILENAME, mountainlab_tmp_path)
-                    continue
-            else:
-                print(MODULE_IDENTIFIER + "Firings and raw cluster metrics file with concatenated epochs found. Using file!")
-
-        """
-        if not os.path.isfile(nt_out_dir + pyp.TAGGED_METRICS_FILE):
-            pyp.add_curation_tags(dataset_dir=nt_out_dir,output_dir=nt_out_dir,opts={})
-        else:
-            print(MODULE_IDENTIFIER + "Tagged cluster metrics file with concatenated epochs found. Using file!")
-        """
-
-        # 2020-02-21: There seems to be some issue with this step at the
-        # moment. Since we are going to do this in as automated a way as
-        # possible, might as well just go from raw metrics to cleaned metrics,
-        # skipping the metrics tagging step in between.
-        """
-        if not os.path.isfile(nt_out_dir + pyp.CLIPS_FILE):
-            pyp.extract_marks(dataset_dir=nt_out_dir,output_dir=nt_out_dir,opts={})
-        else:
-            print(MODULE_IDENTIFIER + "Clips file with concatenated epochs found. Using file!")
-
-        pyp.cleanup_metrics(metrics_file=nt_out_dir+'/metrics_tagged.json', metrics_out=nt_out_dir+'/metrics_cleaned.json')
-        """
-        pyp.cleanup_metrics(metrics_file=nt_out_dir+'/metrics_raw.json', metrics_out=nt_out_dir+'/metrics_cleaned.json')
-        # Generate templates for MountainView - Use the filt file for generating templates.
-        if not (os.path.isfile(nt_out_dir + pyp.TEMPLATES_FILE) and\
-                os.path.isfile(nt_out_dir + pyp.TEMPLATE_STDS_FILE)):
-            pyp.generate_templates(dataset_dir=nt_out_dir, output_dir=nt_out_dir, metrics_file=nt_out_dir+'/metrics_cleaned.json', opts={})
-        else:
-            print(MODULE_IDENTIFIER + "Templates file found. Using file!")
-
-        if (os.path.isfile(nt_out_dir + '/hand_curated.json')):
-            pyp.add_curation_tags(dataset_dir=nt_out_dir,output_dir=nt_out_dir, hand_curation=True)
-
-        if move_filt_mask_whiten_files:
-            mda_util.relocate_mda(nt_out_dir + pyp.PRE_FILENAME, mountainlab_tmp_path)
-            mda_util.relocate_mda(nt_out_dir + pyp.FILT_FILENAME, mountainlab_tmp_path)
+    if failed_tetrodes:
+        print(MODULE_IDENTIFIER + 'Unable to sort tetrode(s) ' + ', '.join([str(nt) for nt in failed_tetrodes]))
     print(MODULE_IDENTIFIER + "Sorting Complete!")
 
 if __name__ == "__main__":
@@ -222,7 +364,9 @@ if __name__ == "__main__":
         print(MODULE_IDENTIFIER + "Using working directory for storing sorted spikes and softlinks.")
         commandline_args.output_dir = os.getcwd() + '/' + commandline_args.animal + str(commandline_args.date)
 
-    # Get source directories using file dialogs.
+    # Get source directories using file dialogs. tkinter is only needed here,
+    # so it is not imported by the workers that run the pipeline.
+    from tkinter import Tk, filedialog
     gui_root = Tk()
     gui_root.wm_withdraw()
     mda_list = list()
@@ -255,6 +399,18 @@ if __name__ == "__main__":
 
     tetrode_range = range(tetrode_begin, tetrode_end+1)
 
+    n_workers = 1
+    if commandline_args.n_workers:
+        n_workers = commandline_args.n_workers
+
+    worker_memory = None
+    if commandline_args.worker_memory:
+        worker_memory = int(commandline_args.worker_memory * 1024**3)
+
+    adopt_existing = False
+    if commandline_args.adopt_existing:
+        adopt_existing = commandline_args.adopt_existing
+
     while True:
         new_mda_dir = filedialog.askdirectory(initialdir=initial_directory, \
                 title="Select MDA Files")
@@ -263,4 +419,5 @@ if __name__ == "__main__":
         mda_list.append(new_mda_dir)
         print("Added %s."%new_mda_dir)
     gui_root.destroy()
-    run_pipeline(mda_list, commandline_args.output_dir, tetrode_range, do_mask_artifacts, clear_files)
+    run_pipeline(mda_list, commandline_args.output_dir, tetrode_range, do_mask_artifacts, clear_files, \
+            n_workers, worker_memory, adopt_existing)
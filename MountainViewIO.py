@@ -5,18 +5,18 @@ Utility for reading clustered data from MountainSort. Also extended to perform I
 import os
 import sys
 import json
-import errno
 import numpy as np
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
 from mountainlab_pytools import mdaio
-from tkinter import Tk, filedialog
-
-# Qt5 imports
-from PyQt5.QtWidgets import QMainWindow, QAction, qApp, QApplication, QDialog, QFileDialog, QMessageBox
 
 # Local imports
-import QtHelperUtils
+# NOTE: GUI modules (QtHelperUtils, and with it PyQt5 and tkinter) are only
+# imported inside the functions that open dialogs, so that batch tools using
+# this module start quickly and run on machines without a display.
+import array_store
 import readTrodesExtractedDataFile3
+import separateCuratedSpikes
+import timestamp_index
 
 # TODO: These constants have been duplicated. Need to put all of these togther.
 MDA_FILE_EXTENSION = '.mda'
@@ -29,6 +29,10 @@ DECODED_DATA_EXTENSION = '.bayesian.npz'
 SPIKE_SAMPLING_RATE = 30000.0
 LFP_SAMPLING_RATE = 1500.0
 DECIMATION_FACTOR = 20
+LFP_CHUNK_SAMPLES = 1048576
+LFP_ANTIALIAS_ORDER = 8
+LFP_ANTIALIAS_CUTOFF = 0.8      # Fraction of the decimated Nyquist frequency
+LFP_ANTIALIAS_SETTLING = 1e-9   # Decay of edge transients in chunked filtering
 TIMESTAMP_LABEL = 'timestamp'
 TIMESTAMP_DTYPE = 'uint32'
 X_LOC1_LABEL = 'x1'
@@ -36,19 +40,34 @@ X_LOC2_LABEL = 'x2'
 Y_LOC1_LABEL = 'y1'
 Y_LOC2_LABEL = 'y2'
 POSITION_DTYPE = 'uint16'
+# Trodes names for the fields in a tracking file, and the labels used here
+POSITION_FIELD_LABELS = {'time': TIMESTAMP_LABEL, 'xloc': X_LOC1_LABEL, 'yloc': Y_LOC1_LABEL,
+        'xloc2': X_LOC2_LABEL, 'yloc2': Y_LOC2_LABEL}
+LEGACY_POSITION_HEADER_LINES = 8
+UNIT_LABEL = 'unit'
+SPEED_LABEL = 'speed'
+SPIKE_LOCATION_DTYPE = [(UNIT_LABEL, 'int32'), (TIMESTAMP_LABEL, TIMESTAMP_DTYPE),
+        (X_LOC1_LABEL, 'float32'), (Y_LOC1_LABEL, 'float32'), (SPEED_LABEL, 'float32')]
+LOCATION_LOOKUP_NEAREST = 'nearest'
+LOCATION_LOOKUP_LINEAR = 'linear'
+N_LOADING_WORKERS = 8
 
 # Module identifier
 MODULE_IDENTIFIER = "[MountainViewIO] "
 
-def savePlaceFieldData(field_data, place_field_filename='fielddata', data_dir=None):
+def savePlaceFieldData(field_data, place_field_filename='fielddata', data_dir=None, compressed=False):
     """
-    Take place field data as a numpy array and save it to an MDA file.
+    Take place field data as a numpy array and save it to an array store
+    (see array_store).
     :field_data: Place field data to be saved
     :place_field_filename: Either the name of the file, or the complete path to
         be used (in the latter case, data_dir should be set to None)
     :data_dir: Location where place field should be saved (in this case, place
         field filename is the name of the file used.)
+    :compressed: Save a compressed .npz container instead of a directory of
+        memory-mappable arrays.
     """
+    import QtHelperUtils
     if data_dir is None:
         output_filename = place_field_filename
     else:
@@ -57,7 +76,7 @@ def savePlaceFieldData(field_data, place_field_filename='fielddata', data_dir=No
                 file_format=NPZ_FILE_FORMAT)
 
     try:
-        np.savez(output_filename, field_data)
+        output_filename = array_store.save_arrays(output_filename, [('field_data', field_data)], compressed)
         QtHelperUtils.display_information('Place field data written to ' + output_filename)
     except Exception as err:
         QtHelperUtils.display_warning('Unable to write place field data.')
@@ -69,17 +88,20 @@ def loadPlaceFieldData(place_field_file=None, data_dir=None):
     SEE ALSO:
         savePlaceFieldData
     """
+    import QtHelperUtils
     if place_field_file is None:
-        place_field_file = QtHelperUtils.get_open_file_name(data_dir, file_format='Place Fields (*.npz)', \
+        place_field_file = QtHelperUtils.get_open_file_name(data_dir, \
+            file_format='Place Fields (*.npz ' + array_store.MANIFEST_FILENAME + ')', \
             message='Select place field file')
     try:
-        place_field_data = np.load(place_field_file)
-    except (FileNotFoundError, IOError) as err:
-        QtHelperUtils.display_warning('Unable to read place field data. ' + err)
+        place_field_data = array_store.open_arrays(place_field_file)
+    except (FileNotFoundError, IOError, ValueError) as err:
+        QtHelperUtils.display_warning('Unable to read place field data. ' + str(err))
         return
-    return place_field_data['arr_0']
+    return place_field_data[place_field_data.fields[0]]
 
-def saveBayesianDecoding(posterior, map_estimate, peak_posterior, decoding_filename='decoded_data', data_dir=None):
+def saveBayesianDecoding(posterior, map_estimate, peak_posterior, decoding_filename='decoded_data', data_dir=None, \
+        compressed=False):
     """
     Take Bayesian decoding as a set of 3 numpy arrays (overall posterior, MAP
     estimate and the peak posterior values) for the corresponding MAP estimates
@@ -93,7 +115,10 @@ def saveBayesianDecoding(posterior, map_estimate, peak_posterior, decoding_filen
         description, decoding window and window slide for example.)
     :data_dir: Location where decoded data should be saved (in this case,
         decoding_filename is the name of the file used.)
+    :compressed: Save a compressed .npz container instead of a directory of
+        memory-mappable arrays.
     """
+    import QtHelperUtils
     if data_dir is None:
         output_filename = decoding_filename
     else:
@@ -102,10 +127,11 @@ def saveBayesianDecoding(posterior, map_estimate, peak_posterior, decoding_filen
                 file_format=NPZ_FILE_FORMAT)
 
     try:
-        np.savez(output_filename, posterior, map_estimate, peak_posterior)
+        output_filename = array_store.save_arrays(output_filename, [('posterior', posterior), \
+                ('map_estimate', map_estimate), ('peak_posterior', peak_posterior)], compressed)
         QtHelperUtils.display_information('Decoded data written to ' + output_filename)
     except Exception as err:
-        QtHelperUtils.display_warning('Unable to write decoded data. ' + err)
+        QtHelperUtils.display_warning('Unable to write decoded data. ' + str(err))
 
 def loadBayesianDecoding(decoding_filename=None, data_dir=None):
     """
@@ -121,23 +147,29 @@ def loadBayesianDecoding(decoding_filename=None, data_dir=None):
     :posterior: Decoded posterior for each time bin, at each position bin
     :map_estimate: Decoding time-points and final decoded locations.
     :peak_posterior: The value of the posterio at the map_estimate values.
+
+    Arrays saved uncompressed are memory-mapped, so they are only read from
+    disk as they are used.
     """
-    if (decoding_filename is None) or (not os.path.exists(decoding_filename)):
-        decoding_filename = QtHelperUtils.get_open_file_name(data_dir, file_format='Bayesian Decoding (*.npz)', \
+    import QtHelperUtils
+    if (decoding_filename is None) or (array_store.find_arrays(decoding_filename) is None):
+        decoding_filename = QtHelperUtils.get_open_file_name(data_dir, \
+            file_format='Bayesian Decoding (*.npz ' + array_store.MANIFEST_FILENAME + ')', \
             message='Select decoded data file.')
 
     try:
-        bayesian_data = np.load(decoding_filename)
+        bayesian_data = array_store.open_arrays(decoding_filename)
         QtHelperUtils.display_information('Decoded data loaded from ' + decoding_filename)
-        assert(len(bayesian_data.files) == 3)
+        assert(len(bayesian_data) == 3)
     except Exception as err:
         QtHelperUtils.display_warning('Unable to read decoded data.')
         print(err)
         return
 
-    return bayesian_data['arr_0'], bayesian_data['arr_1'], bayesian_data['arr_2']
+    return tuple([bayesian_data[field] for field in bayesian_data.fields])
 
-def saveRawData(clips, position, spikes, sp_locations, raw_filename='decoded_data', data_dir=None):
+def saveRawData(clips, position, spikes, sp_locations, raw_filename='decoded_data', data_dir=None, \
+        compressed=False):
     """
     Take processed recording as a set of 4 numpy arrays (clips, position,
     spike times and spike locations) and save this is in a file.
@@ -151,7 +183,10 @@ def saveRawData(clips, position, spikes, sp_locations, raw_filename='decoded_dat
         description, decoding window and window slide for example.)
     :data_dir: Location where raw data should be saved (in this case,
         decoding_filename is the name of the file used.)
+    :compressed: Save a compressed .npz container instead of a directory of
+        memory-mappable arrays.
     """
+    import QtHelperUtils
     if data_dir is None:
         output_filename = raw_filename
     else:
@@ -160,10 +195,11 @@ def saveRawData(clips, position, spikes, sp_locations, raw_filename='decoded_dat
                 file_format=NPZ_FILE_FORMAT)
 
     try:
-        np.savez(output_filename, clips, position, spikes, sp_locations)
+        output_filename = array_store.save_arrays(output_filename, [('clips', clips), ('position', position), \
+                ('spikes', spikes), ('spike_locations', sp_locations)], compressed)
         QtHelperUtils.display_information('Raw data written to ' + output_filename)
     except Exception as err:
-        QtHelperUtils.display_warning('Unable to write raw data. ' + err)
+        QtHelperUtils.display_warning('Unable to write raw data. ' + str(err))
 
 def loadRawData(data_filename=None, data_dir=None):
     """
@@ -181,56 +217,46 @@ def loadRawData(data_filename=None, data_dir=None):
     :valid_spikes: Spike times and cluster indices
     :spike_locations: Spike information for each cluster
     """
-    if (data_filename is None) or (not os.path.exists(data_filename)):
-        data_filename = QtHelperUtils.get_open_file_name(data_dir, file_format='Raw Data (*.npz)', \
+    import QtHelperUtils
+    if (data_filename is None) or (array_store.find_arrays(data_filename) is None):
+        data_filename = QtHelperUtils.get_open_file_name(data_dir, \
+            file_format='Raw Data (*.npz ' + array_store.MANIFEST_FILENAME + ')', \
             message='Select raw data file.')
 
     try:
-        raw_data = np.load(data_filename)
+        raw_data = array_store.open_arrays(data_filename)
         QtHelperUtils.display_information('Raw data loaded from ' + data_filename)
-        assert(len(raw_data.files) == 4)
+        assert(len(raw_data) == 4)
     except Exception as err:
         QtHelperUtils.display_warning('Unable to read raw data.')
         print(err)
         return
 
-    return raw_data['arr_0'], raw_data['arr_1'], raw_data['arr_2'], raw_data['arr_3']
+    return tuple([raw_data[field] for field in raw_data.fields])
 
-def separateSpikesInEpochs(data_dir=None, firings_file='firings.curated.mda', timestamp_files=None, write_separated_spikes=True):
+def separateSpikesInEpochs(data_dir=None, firings_file='firings.curated.mda', timestamp_files=None, \
+        write_separated_spikes=True, n_workers=N_LOADING_WORKERS):
     """
     Takes curated spikes from MountainSort and combines this information with spike timestamps to create separate curated spikes for each epoch
 
+    Inputs that are not supplied are asked for through dialogs. For batch
+    use, call separateCuratedSpikes.separateSpikesInEpochs directly.
+
     :firings_file: Curated firings file
     :timestamp_files: Spike timestamps file list
     :write_separated_spikes: If the separated spikes should be written back to the data directory.
+    :n_workers: Number of files read/written simultaneously
     :returns: List of spikes for each epoch
     """
     
     if data_dir is None:
+        import QtHelperUtils
         # Get the firings file
         data_dir = QtHelperUtils.get_directory(message="Select Curated firings location")
 
-    separated_tetrodes = []
-    curated_firings = []
-    merged_curated_firings = []
-    tetrode_list = os.listdir(data_dir)
-    for tt_dir in tetrode_list:
-        try:
-            if firings_file in os.listdir(data_dir+'/'+tt_dir):
-                curated_firings.append([])
-                separated_tetrodes.append(tt_dir)
-                firings_file_location = '/'.join([data_dir, tt_dir, firings_file])
-                merged_curated_firings.append(mdaio.readmda(firings_file_location))
-                print(MODULE_IDENTIFIER + 'Read merged firings file for tetrode %s!'%tt_dir)
-            else:
-                print(MODULE_IDENTIFIER + 'Merged firings %s not  found for tetrode %s!'%(firings_file, tt_dir))
-        except (FileNotFoundError, IOError) as err:
-            print(MODULE_IDENTIFIER + 'Unable to read merged firings file for tetrode %s!'%tt_dir)
-            print(err)
-
     # TODO: Change this to also use Qt instead of Tk! Using both libraries seems to make no sense.
-    timestamp_headers = []
     if timestamp_files is None:
+        import QtHelperUtils
         timestamp_files = list()
         # Read all the timestamp files
         while True:
@@ -240,79 +266,8 @@ def separateSpikesInEpochs(data_dir=None, firings_file='firings.curated.mda', ti
                 break
             timestamp_files.append(new_timestamp_file)
 
-    for ts_file in timestamp_files:
-        timestamp_headers.append(mdaio.readmda_header(ts_file))
-
-    # Now that we have both the timestamp headers and the timestamp files, we
-    # can separate spikes out.  It is important here for the timestamp files to
-    # be in the same order as the curated firings as that is the only way for
-    # us to tell that the firings are being split up correctly.
-
-    print(MODULE_IDENTIFIER + 'Looking at spike timestamps in order')
-    print(timestamp_files)
-
-    # First splice up curated spikes into indiviual epochs
-    for tt_idx, tt_firings in enumerate(merged_curated_firings):
-        for ep_idx, ts_header in enumerate(timestamp_headers):
-            if tt_firings is None:
-                curated_firings[tt_idx].append(None)
-                continue
-
-            n_data_points = ts_header.dims[0]
-            print(MODULE_IDENTIFIER + 'Epoch ' + str(ep_idx) + ': ' + str(n_data_points) + ' samples.')
-            last_spike_from_epoch = np.searchsorted(tt_firings[1], n_data_points, side='left')-1
-
-            # If there are no spikes in this epoch, there might still be some in future epochs!
-            if last_spike_from_epoch < 0:
-                tt_firings[1] = tt_firings[1] - float(n_data_points)
-                curated_firings[tt_idx].append(None)
-                continue
-
-            last_spike_sample_number = tt_firings[1][last_spike_from_epoch]
-            print(MODULE_IDENTIFIER + separated_tetrodes[tt_idx] + ': First spike ' + str(tt_firings[1][0])\
-                    + ', Last spike ' + str(last_spike_sample_number))
-            epoch_spikes = tt_firings[:, :last_spike_from_epoch]
-            curated_firings[tt_idx].append(epoch_spikes)
-
-            if last_spike_from_epoch < (len(tt_firings[1]) - 1):
-                # Slice the merged curated firing to only have the remaining spikes
-                tt_firings = tt_firings[:,last_spike_from_epoch+1:]
-                print(MODULE_IDENTIFIER + 'Trimming curated spikes. Aggregate sample start ' + str(tt_firings[1][0]))
-                tt_firings[1] = tt_firings[1] - float(n_data_points)
-                print(MODULE_IDENTIFIER + 'Sample number trimmed to ' + str(tt_firings[1][0]))
-            else:
-                print(MODULE_IDENTIFIER + separated_tetrodes[tt_idx] + ', Reached end of curated firings at Epoch ' + str(ep_idx))
-                tt_firings = None
-
-    print(MODULE_IDENTIFIER + 'Spikes separated in epochs. Substituting timestamps!')
-    # For each epoch replace the sample numbers with the corresponding
-    # timestamps. We are going through multiple revisions for this so that we
-    # only have to load one timestamp file at a time
-    for ep_idx, ts_file in enumerate(timestamp_files):
-        epoch_timestamps = mdaio.readmda(ts_file)
-        print(MODULE_IDENTIFIER + 'Epoch ' + str(ep_idx))
-        for tt_idx, tt_curated_firings in enumerate(curated_firings):
-            if tt_curated_firings[ep_idx] is None:
-                continue
-            # Need to use the original array because changes to tt_curated_firings do not get copied back
-            curated_firings[tt_idx][ep_idx][1] = epoch_timestamps[np.array(tt_curated_firings[ep_idx][1], dtype=int)]
-            print(MODULE_IDENTIFIER + separated_tetrodes[tt_idx] + ': Samples (' + \
-                    str(tt_curated_firings[ep_idx][1][0]) + ', ' + str(tt_curated_firings[ep_idx][1][-1]), ')')
-
-    if write_separated_spikes:
-        try:
-            for tt_idx, tet in enumerate(separated_tetrodes):
-                for ep_idx in range(len(timestamp_files)):
-                    if curated_firings[tt_idx][ep_idx] is not None:
-                        ep_firings_file_name = data_dir + '/' + tet + '/firings-' + \
-                                str(ep_idx+1) + '.curated.mda'
-                        mdaio.writemda64(curated_firings[tt_idx][ep_idx], ep_firings_file_name)
-        except OSError as exception:
-            if exception.errno != errno.EEXIST:
-                print(MODULE_IDENTIFIER + 'Unable to write timestamped firings!')
-                print(exception)
-        
-    return curated_firings
+    return separateCuratedSpikes.separateSpikesInEpochs(data_dir, timestamp_files, firings_file=firings_file, \
+            write_separated_spikes=write_separated_spikes, n_workers=n_workers)
 
 def loadSpikeTimestamps(data_file=None):
     """
@@ -321,6 +276,7 @@ def loadSpikeTimestamps(data_file=None):
     """
     
     if data_file is None:
+        import QtHelperUtils
         ts_file = QtHelperUtils.get_open_file_name(\
                 message="Select Timestamp MDA Files", file_format="LFP Data (.dat)")
 
@@ -334,76 +290,233 @@ def loadSpikeTimestamps(data_file=None):
     finally:
         return timestamps
 
+def groupSpikesByLabel(spike_labels):
+    """
+    Group spikes by their cluster label in a single pass.
+
+    :spike_labels: Cluster label for each spike
+    :returns: Sorted unique labels, spike indices ordered by label (spikes with
+        the same label stay in their original order) and offsets such that the
+        spikes with labels[i] are spike_order[offsets[i]:offsets[i+1]].
+    """
+    spike_labels = np.asarray(spike_labels, dtype='int64')
+    spike_order = np.argsort(spike_labels, kind='stable')
+    sorted_labels = spike_labels[spike_order]
+    label_starts = np.flatnonzero(np.diff(sorted_labels)) + 1
+    offsets = np.concatenate(([0], label_starts, [len(sorted_labels)])).astype('int64')
+    if len(sorted_labels) == 0:
+        return sorted_labels, spike_order, offsets[:1]
+    return sorted_labels[offsets[:-1]], spike_order, offsets
+
+class ClusteredSpikes(object):
+
+    """
+    Spike times for a set of units, stored as a single flat array. Spikes for
+    unit i are spike_times[unit_offsets[i]:unit_offsets[i+1]].
+    """
+
+    def __init__(self, spike_times, unit_offsets, unit_ids):
+        """
+        :spike_times: Spike times for all the units, one unit after another
+        :unit_offsets: Start of each unit's spikes in spike_times (with an
+            additional entry for the end of the last unit)
+        :unit_ids: (Tetrode, Cluster) identity for each unit
+        """
+        self.spike_times = spike_times
+        self.unit_offsets = unit_offsets
+        self.unit_ids = unit_ids
+
+    def __len__(self):
+        return len(self.unit_ids)
+
+    def unit(self, unit_idx):
+        return self.spike_times[self.unit_offsets[unit_idx]:self.unit_offsets[unit_idx+1]]
+
+    def as_list(self):
+        """
+        List of spike times for each unit (None for units without spikes).
+        """
+        unit_list = list()
+        for unit_idx in range(len(self)):
+            unit_spikes = self.unit(unit_idx)
+            unit_list.append(unit_spikes if len(unit_spikes) > 0 else None)
+        return unit_list
+
+def _tetrodeSortKey(tt_dir):
+    tt_idx = tt_dir.split('nt')[-1]
+    return (0, int(tt_idx), tt_dir) if tt_idx.isdigit() else (1, 0, tt_dir)
+
+def _loadTetrodeClusters(tt_dir_path, tt_dir, firings_file, helper_file, time_limits):
+    """
+    Read the firings for a tetrode and group its spikes by cluster.
+
+    :returns: Spike times grouped by cluster, start of each of the tetrode's
+        clusters in these spike times, and the (Tetrode, Cluster) identities.
+        None if the tetrode could not be read.
+    """
+    if firings_file not in os.listdir(tt_dir_path):
+        print('Tetrode ' + tt_dir + ': Firings file not found!')
+        return
+
+    tt_idx = tt_dir.split('nt')[1]
+    firings_file_path = os.path.join(tt_dir_path, firings_file) 
+    curation_file_path = os.path.join(tt_dir_path, helper_file)
+    try:
+        # Read the firings file
+        firing_data = mdaio.readmda(firings_file_path)
+    except Exception as err:
+        print('Tetrode ' + tt_dir + 'Unable to read firings file!')
+        print(err)
+        return
+
+    try:
+        # Read the curation file for info on spike clusters
+        with open(curation_file_path, 'r') as f:
+            curation_file = json.load(f)
+        # Get all cluster IDs. This includes noise, mua, everything!
+        cluster_ids = [int(cl) for cl in curation_file['cluster_attributes'].keys()]
+    except (FileNotFoundError, IOError) as err:
+        print('Tetrode ' + tt_dir + 'Unable to read curation file.')
+        return
+
+    # Read off spikes for individual clusters
+    if time_limits is not None:
+        firing_times = (firing_data[1] - firing_data[1][0])/SPIKE_SAMPLING_RATE
+        time_limit_start_idx = np.searchsorted(firing_times, time_limits[0], side='left')
+        time_limit_finish_idx = np.searchsorted(firing_times, time_limits[1], side='right')
+        firing_data = firing_data[:,time_limit_start_idx:time_limit_finish_idx]
+
+    # Group all the spikes by cluster at once, then pick the clusters out
+    labels, spike_order, label_offsets = groupSpikesByLabel(firing_data[2])
+    label_positions = np.searchsorted(labels, cluster_ids)
+    spike_pieces = list()
+    unit_lengths = list()
+    n_clusters = 0
+    for unit_id, l_idx in zip(cluster_ids, label_positions):
+        if (l_idx < len(labels)) and (labels[l_idx] == unit_id):
+            spike_pieces.append(spike_order[label_offsets[l_idx]:label_offsets[l_idx+1]])
+            n_clusters += 1
+        else:
+            spike_pieces.append(spike_order[:0])
+        unit_lengths.append(len(spike_pieces[-1]))
+
+    n_spikes = len(firing_data[1])
+    print('Tetrode %s loaded %d spikes from %d clusters.' %(tt_dir, n_spikes, n_clusters))
+    unit_spikes = firing_data[1][np.concatenate(spike_pieces)] if spike_pieces else firing_data[1][:0]
+    unit_starts = np.concatenate(([0], np.cumsum(unit_lengths)))[:len(unit_lengths)].astype('int64')
+    return unit_spikes, unit_starts, [(tt_idx, unit_id) for unit_id in cluster_ids]
+
 def loadClusteredData(data_location=None, firings_file='firings.curated.mda', 
-        helper_file='hand_curated.mv2', time_limits=None):
+        helper_file='hand_curated.mv2', time_limits=None, n_workers=N_LOADING_WORKERS, as_list=False):
     """
     Load up clustered data and pool it.
 
     :data_location: Directory which has clustered data from all the tetrodes.
     :time_limits: (Floating Point) Real time limits within which the data should be extracted.
+    :n_workers: Number of tetrodes read simultaneously.
+    :as_list: Return a list of spike times for each unit (None for units
+        without spikes) instead of a ClusteredSpikes object.
     :returns: Spike data, separated into containers for individual units.
     """
 
     if data_location is None:
+        import QtHelperUtils
         # Get the location using a file dialog
         data_location = QtHelperUtils.get_directory("Select data location.")
 
-    clustered_spikes = []
-    tt_cl_to_unique_cluster_id = {}
-    unique_cluster_id = 0
-    tetrode_list = os.listdir(data_location)
-    for tt_dir in tetrode_list:
-        tt_dir_path = os.path.join(data_location, tt_dir)
-        if not os.path.isdir(tt_dir_path):
+    tetrode_list = sorted(os.listdir(data_location), key=_tetrodeSortKey)
+    tetrode_dirs = [tt_dir for tt_dir in tetrode_list if os.path.isdir(os.path.join(data_location, tt_dir))]
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        tetrode_clusters = list(executor.map(lambda tt_dir: _loadTetrodeClusters(os.path.join(data_location, \
+                tt_dir), tt_dir, firings_file, helper_file, time_limits), tetrode_dirs))
+
+    spike_pieces = list()
+    unit_starts = list()
+    unit_ids = list()
+    n_spikes = 0
+    for loaded_tetrode in tetrode_clusters:
+        if loaded_tetrode is None:
             continue
+        tt_spikes, tt_unit_starts, tt_unit_ids = loaded_tetrode
+        spike_pieces.append(tt_spikes)
+        unit_starts.append(tt_unit_starts + n_spikes)
+        unit_ids.extend(tt_unit_ids)
+        n_spikes += len(tt_spikes)
+
+    spike_times = np.concatenate(spike_pieces) if spike_pieces else np.empty(0)
+    unit_offsets = np.concatenate(unit_starts + [[n_spikes]]).astype('int64')
+    clustered_spikes = ClusteredSpikes(spike_times, unit_offsets, unit_ids)
+    if as_list:
+        return clustered_spikes.as_list()
+    return clustered_spikes
 
-        if firings_file in os.listdir(tt_dir_path):
-            tt_idx = tt_dir.split('nt')[1]
-            firings_file_path = os.path.join(tt_dir_path, firings_file) 
-            curation_file_path = os.path.join(tt_dir_path, helper_file)
-            try:
-                # Read the firings file
-                firing_data = mdaio.readmda(firings_file_path)
-            except Exception as err:
-                print('Tetrode ' + tt_dir + 'Unable to read firings file!')
-                print(err)
-                continue
-
-            try:
-                # Read the curation file for info on spike clusters
-                with open(curation_file_path, 'r') as f:
-                    curation_file = json.load(f)
-                # Get all cluster IDs. This includes noise, mua, everything!
-                cluster_ids = [int(cl) for cl in curation_file['cluster_attributes'].keys()]
-            except (FileNotFoundError, IOError) as err:
-                print('Tetrode ' + tt_dir + 'Unable to read curation file.')
-                continue
-
-            # Read off spikes for individual clusters and assign unique cluster IDs to them
-            if time_limits is not None:
-                firing_times = (firing_data[1] - firing_data[1][0])/SPIKE_SAMPLING_RATE
-                time_limit_start_idx = np.searchsorted(firing_times, time_limits[0], side='left')
-                time_limit_finish_idx = np.searchsorted(firing_times, time_limits[1], side='right')
-                firing_data = firing_data[:,time_limit_start_idx:time_limit_finish_idx]
-            firing_clusters = firing_data[2]
-
-            n_clusters = 0
-            for unit_id in cluster_ids:
-                unit_spikes = firing_data[1][firing_clusters == unit_id]
-                if len(unit_spikes > 0):
-                    tt_cl_to_unique_cluster_id[(tt_idx, unit_id)] = unique_cluster_id
-                    n_clusters += 1
-                    unique_cluster_id += 1
-                    clustered_spikes.append(unit_spikes)
-                else:
-                    clustered_spikes.append(None)
-
-            n_spikes = len(firing_data[1])
-            print('Tetrode %s loaded %d spikes from %d clusters.' %(tt_dir, n_spikes, n_clusters))
-        else:
-            print('Tetrode ' + tt_dir + ': Firings file not found!')
+def _readLegacyPositionHeader(data_file):
+    """
+    Skip the header of a tracking file that does not start with a Trodes
+    settings block. These files have a fixed 8-line header followed by the
+    position records.
 
-    return clustered_spikes
+    :returns: Byte offset of the records, and their data type.
+    """
+    position_data_type = np.dtype([(TIMESTAMP_LABEL, TIMESTAMP_DTYPE), 
+            (X_LOC1_LABEL, POSITION_DTYPE), (Y_LOC1_LABEL, POSITION_DTYPE),
+            (X_LOC2_LABEL, POSITION_DTYPE), (Y_LOC2_LABEL, POSITION_DTYPE)])
+    with open(data_file, 'rb') as position_data_file:
+        for _ in range(LEGACY_POSITION_HEADER_LINES):
+            settings_line = position_data_file.readline()
+            if __debug__:
+                print(settings_line)
+        data_offset = position_data_file.tell()
+    return data_offset, position_data_type
+
+def _openPositionData(data_file):
+    """
+    Memory-map the position records in a tracking file. The record layout is
+    taken from the Trodes settings header, with the tracking fields renamed to
+    the labels used in this module.
+    """
+    with open(data_file, 'rb') as position_data_file:
+        has_settings_header = position_data_file.readline().strip() == b'<Start settings>'
+        if has_settings_header:
+            position_data_file.seek(0)
+            settings, position_data_type = readTrodesExtractedDataFile3.readTrodesExtractedDataHeader(position_data_file)
+            data_offset = settings['data_offset']
+
+    if has_settings_header:
+        # parseFields gives every field a repeat count, so single values come
+        # out as arrays of length 1. These are stored as plain values instead.
+        field_formats = list()
+        for field in position_data_type.names:
+            field_type = position_data_type.fields[field][0]
+            field_formats.append(field_type.base if field_type.shape == (1,) else field_type)
+        position_data_type = np.dtype({
+            'names': [POSITION_FIELD_LABELS.get(field, field) for field in position_data_type.names],
+            'formats': field_formats,
+            'offsets': [position_data_type.fields[field][1] for field in position_data_type.names],
+            'itemsize': position_data_type.itemsize
+            })
+    else:
+        print(MODULE_IDENTIFIER + 'No settings header in %s, assuming legacy format.'%data_file)
+        data_offset, position_data_type = _readLegacyPositionHeader(data_file)
+
+    n_records = (os.path.getsize(data_file) - data_offset) // position_data_type.itemsize
+    return np.memmap(data_file, dtype=position_data_type, mode='r', offset=data_offset, shape=(n_records,))
+
+def _searchPositionTime(position_timestamps, first_position_timestamp, time_limit, side):
+    """
+    Binary search for a (relative, real) time in the timestamps of a
+    memory-mapped tracking file. Unlike np.searchsorted, only the records
+    visited by the search are read from disk.
+    """
+    lo, hi = 0, len(position_timestamps)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        mid_time = float(int(position_timestamps[mid]) - first_position_timestamp)/SPIKE_SAMPLING_RATE
+        if (mid_time < time_limit) or ((side == 'right') and (mid_time == time_limit)):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
 
 def loadPositionData(data_file=None, reset_time=False, time_limits=None):
     """
@@ -411,41 +524,32 @@ def loadPositionData(data_file=None, reset_time=False, time_limits=None):
 
     :data_file: VideoTracking file that contains the position data.
     :time_limits: (Floating Point) Real time limits within which the data should be extracted.
+        Only the records within these limits are read from disk.
     :returns: Timestamped position data
     """
-    position_data_type = [(TIMESTAMP_LABEL, TIMESTAMP_DTYPE), 
-            (X_LOC1_LABEL, POSITION_DTYPE), (Y_LOC1_LABEL, POSITION_DTYPE),
-            (X_LOC2_LABEL, POSITION_DTYPE), (Y_LOC2_LABEL, POSITION_DTYPE)]
-
     if data_file is None:
+        import QtHelperUtils
         data_file = QtHelperUtils.get_open_file_name(data_dir=DEFAULT_SEARCH_PATH, message="Select Tracking File", \
             file_format="Camera Tracking (*.videoPositionTracking)")
     try:
-        position_data_file = open(data_file, 'rb')
-    except (FileNotFoundError, IOError) as err:
+        position_records = _openPositionData(data_file)
+    except Exception as err:
         print(err)
         return
 
-    for _ in range(8):
-        # TODO: Could use the file header to process the information. Right now we will just believe that 
-        settings_line = position_data_file.readline()
-        if __debug__:
-            print(settings_line)
-
-    try:
-        position_data = np.fromfile(position_data_file, dtype=position_data_type)
-    except Exception as err:
-        print(err)
+    if len(position_records) == 0:
+        print(MODULE_IDENTIFIER + 'No position data in %s.'%data_file)
         return
 
-    first_position_timestamp = position_data[TIMESTAMP_LABEL][0]
+    position_timestamps = position_records[TIMESTAMP_LABEL]
+    first_position_timestamp = int(position_timestamps[0])
 
+    first_record, last_record = 0, len(position_records)
     if time_limits is not None:
-        position_timestamps = np.array(position_data[TIMESTAMP_LABEL]-first_position_timestamp,\
-                dtype=float)/SPIKE_SAMPLING_RATE
-        time_limit_start_idx = np.searchsorted(position_timestamps, time_limits[0], side='left')
-        time_limit_finish_idx = np.searchsorted(position_timestamps, time_limits[1], side='right')
-        position_data = position_data[time_limit_start_idx:time_limit_finish_idx]
+        first_record = _searchPositionTime(position_timestamps, first_position_timestamp, time_limits[0], 'left')
+        last_record = _searchPositionTime(position_timestamps, first_position_timestamp, time_limits[1], 'right')
+    position_data = np.array(position_records[first_record:last_record])
+    del position_timestamps, position_records
 
     if reset_time:
         position_data[TIMESTAMP_LABEL] = (position_data[TIMESTAMP_LABEL] -
@@ -462,7 +566,98 @@ def cleanPositionData(position_data):
 
     raise NotImplementedError()
 
-def getSpikeLocations(spikes, position, speed, speed_threshold=20.0):
+def _flattenUnitSpikes(spikes):
+    """
+    Concatenate the spike times of all units.
+
+    :spikes: ClusteredSpikes, or a list of spike-timestamp arrays (None for
+        units without spikes)
+    :returns: Spike times, unit index for each spike, and the number of units.
+    """
+    if isinstance(spikes, ClusteredSpikes):
+        unit_lengths = np.diff(spikes.unit_offsets)
+        return np.asarray(spikes.spike_times), np.repeat(np.arange(len(spikes)), unit_lengths), len(spikes)
+
+    unit_pieces = [np.empty(0) if unit is None else np.asarray(unit) for unit in spikes]
+    unit_lengths = [len(unit) for unit in unit_pieces]
+    spike_times = np.concatenate(unit_pieces) if unit_pieces else np.empty(0)
+    return spike_times, np.repeat(np.arange(len(unit_pieces)), unit_lengths), len(unit_pieces)
+
+def _locateSpikes(spikes, position, speed, speed_threshold, lookup):
+    """
+    Look up the position of every spike from all units.
+
+    :returns: Unit index of the spikes that pass the speed threshold, and
+        their timestamp, X/Y position and running speed (N x 4, float64).
+    """
+    position_timestamps = position[TIMESTAMP_LABEL]
+    if not (np.diff(position_timestamps) > 0.0).all():
+        raise ValueError('Position timestamps have negative jumps!')
+    if lookup not in (LOCATION_LOOKUP_NEAREST, LOCATION_LOOKUP_LINEAR):
+        raise ValueError('Unknown position lookup %s.'%lookup)
+
+    assert(len(position) == len(speed))
+    spike_times, spike_units, _ = _flattenUnitSpikes(spikes)
+    spikes_in_range = np.logical_and(spike_times > position_timestamps[0], spike_times < position_timestamps[-1])
+    spike_times = spike_times[spikes_in_range]
+    spike_units = spike_units[spikes_in_range]
+
+    # Spikes are strictly inside the tracked period, so every spike has a
+    # position sample on either side of it.
+    next_sample = np.searchsorted(position_timestamps, spike_times)
+    prev_sample = next_sample - 1
+    time_after_prev = spike_times - position_timestamps[prev_sample].astype(float)
+    time_before_next = position_timestamps[next_sample].astype(float) - spike_times
+    if lookup == LOCATION_LOOKUP_NEAREST:
+        nearest_sample = np.where(time_after_prev < time_before_next, prev_sample, next_sample)
+        spike_x_pos = position[X_LOC1_LABEL][nearest_sample]
+        spike_y_pos = position[Y_LOC1_LABEL][nearest_sample]
+        spike_speed = np.asarray(speed)[nearest_sample]
+    else:
+        # Positions are unsigned, so they are converted before taking differences.
+        weight_next = time_after_prev / (time_after_prev + time_before_next)
+        def interpolate(samples):
+            prev_value = samples[prev_sample].astype(float)
+            return prev_value + weight_next * (samples[next_sample] - prev_value)
+        spike_x_pos = interpolate(position[X_LOC1_LABEL])
+        spike_y_pos = interpolate(position[Y_LOC1_LABEL])
+        spike_speed = interpolate(np.asarray(speed))
+    spikes_passing_threshold = (spike_speed > speed_threshold)
+
+    located_spikes = np.empty((np.count_nonzero(spikes_passing_threshold), 4), dtype=float)
+    located_spikes[:,0] = spike_times[spikes_passing_threshold]
+    located_spikes[:,1] = spike_x_pos[spikes_passing_threshold]
+    located_spikes[:,2] = spike_y_pos[spikes_passing_threshold]
+    located_spikes[:,3] = spike_speed[spikes_passing_threshold]
+    return spike_units[spikes_passing_threshold], located_spikes
+
+def mapSpikesToPosition(spikes, position, speed, speed_threshold=20.0, lookup=LOCATION_LOOKUP_NEAREST):
+    """
+    Map the spikes from all units to recorded position data at once.
+    INPUTS:
+    :spikes: ClusteredSpikes, or raw spike-timestamp arrays separated by unit IDs
+    :position: Raw positon data (should have strictly increasing position timestamps)
+    :speed: Speed data (corresponding to the position timestamps)
+    :speed_threshold: Lowest speed (in cm/s) for which spike's location should be reported.
+    :lookup: LOCATION_LOOKUP_NEAREST to use the position sample closest to
+        each spike, or LOCATION_LOOKUP_LINEAR to interpolate position and
+        speed between the samples on either side of it.
+    RETURNS:
+    :spike_locations: Structured array (SPIKE_LOCATION_DTYPE) with the unit
+        index, timestamp, X/Y position and running speed of every spike that
+        passes the speed threshold, grouped by unit.
+    """
+
+    located_units, located_spikes = _locateSpikes(spikes, position, speed, speed_threshold, lookup)
+    spike_locations = np.empty(len(located_units), dtype=SPIKE_LOCATION_DTYPE)
+    spike_locations[UNIT_LABEL] = located_units
+    spike_locations[TIMESTAMP_LABEL] = located_spikes[:,0]
+    spike_locations[X_LOC1_LABEL] = located_spikes[:,1]
+    spike_locations[Y_LOC1_LABEL] = located_spikes[:,2]
+    spike_locations[SPEED_LABEL] = located_spikes[:,3]
+    return spike_locations
+
+def getSpikeLocations(spikes, position, speed, speed_threshold=20.0, lookup=LOCATION_LOOKUP_NEAREST):
     """
     Map spikes to recorded position data.
     INPUTS:
@@ -470,6 +665,7 @@ def getSpikeLocations(spikes, position, speed, speed_threshold=20.0):
     :position: Raw positon data (should have strictly increasing position timestamps)
     :speed: Speed data (corresponding to the position timestamps)
     :speed_threshold: Lowest speed (in cm/s) for which spike's location should be reported.
+    :lookup: Position lookup for each spike (see mapSpikesToPosition)
     RETURNS:
     :spike_locations: list of spike locations for each cluster passing the speed threshold.
         Each list entry describes the following fields:
@@ -481,53 +677,202 @@ def getSpikeLocations(spikes, position, speed, speed_threshold=20.0):
                 |           |          |          |         |
                 ---------------------------------------------
 
+    SEE ALSO:
+        mapSpikesToPosition, which returns the locations for all units in a
+        single structured array.
     """
 
-    if not (np.diff(position[TIMESTAMP_LABEL]) > 0.0).all():
-        raise ValueError('Position timestamps have negative jumps!')
+    # Built from the full-precision lookup rather than the compact structured
+    # array, so that the values are the same as they have always been.
+    located_units, located_spikes = _locateSpikes(spikes, position, speed, speed_threshold, lookup)
+    if isinstance(spikes, ClusteredSpikes):
+        empty_units = [len(spikes.unit(unit_idx)) == 0 for unit_idx in range(len(spikes))]
+    else:
+        empty_units = [unit is None for unit in spikes]
 
-    assert(len(position) == len(speed))
+    # Located spikes are grouped by unit, so each unit is a contiguous block.
+    unit_bounds = np.searchsorted(located_units, np.arange(len(empty_units)+1))
     spike_locations = []
-    for unit in spikes:
-        if unit is None:
+    for unit_idx, unit_is_empty in enumerate(empty_units):
+        if unit_is_empty:
             spike_locations.append(None)
             continue
-
-        spike_indices_in_range = np.logical_and(unit > position[TIMESTAMP_LABEL][0], unit < position[TIMESTAMP_LABEL][-1])
-        spikes_in_range = unit[spike_indices_in_range]
-
-        # Get the nearest position-value for each spike.
-        nearest_position_data = np.searchsorted(position[TIMESTAMP_LABEL], spikes_in_range)
-        spike_x_pos = position[X_LOC1_LABEL][nearest_position_data]
-        spike_y_pos = position[Y_LOC1_LABEL][nearest_position_data]
-        spike_speed = speed[nearest_position_data]
-        spikes_passing_threshold = (spike_speed > speed_threshold)
-
-        # Put all the data in a numpy ndarray
-        n_spikes_passing_threshold = np.sum(spikes_passing_threshold)
-        unit_spike_locations = np.ndarray((n_spikes_passing_threshold, 4), dtype=float)
-        unit_spike_locations[:,0] = spikes_in_range[spikes_passing_threshold]
-        unit_spike_locations[:,1] = spike_x_pos[spikes_passing_threshold]
-        unit_spike_locations[:,2] = spike_y_pos[spikes_passing_threshold]
-        unit_spike_locations[:,3] = spike_speed[spikes_passing_threshold]
-        spike_locations.append(unit_spike_locations)
+        spike_locations.append(located_spikes[unit_bounds[unit_idx]:unit_bounds[unit_idx+1]])
     return spike_locations
 
-def loadLFP(data_file=None):
+def _lfpTimestampsFile(data_file):
+    # Trodes writes the LFP timestamps next to the per-channel LFP files.
+    return data_file.split('.LFP_')[0] + '.timestamps.dat'
+
+def _recordColumn(records, field):
+    # parseFields gives every field a repeat count, so single values come out
+    # as (N x 1) columns.
+    column = records[field]
+    if (column.ndim == 2) and (column.shape[1] == 1):
+        return column[:, 0]
+    return column
+
+class LazyLFP(object):
+
+    """
+    Memory-mapped access to a Trodes extracted LFP file and its timestamps.
+    Nothing is read from disk until a time window is requested. Decimation
+    goes through the file one chunk at a time, and timestamps are looked up
+    (and gaps found) through a TimestampIndex.
+    """
+
+    def __init__(self, data_file, timestamps_file=None):
+        """
+        :data_file: Trodes extracted LFP (.dat) file
+        :timestamps_file: Matching timestamps file. By default, this is looked
+            for next to the LFP file.
+        """
+        self.data_file = data_file
+        lfp_data_dict = readTrodesExtractedDataFile3.readTrodesExtractedDataFile(data_file, use_mmap=True)
+        self.records = lfp_data_dict['data']
+        self.voltage = self.records[self.records.dtype.names[0]]
+        if self.voltage.ndim == 1:
+            self.voltage = self.voltage[:, np.newaxis]
+        self.n_channels = self.voltage.shape[1]
+
+        self.timestamps = None
+        if timestamps_file is None:
+            timestamps_file = _lfpTimestampsFile(data_file)
+        self.timestamps_file = timestamps_file
+        try:
+            lfp_tstamp_dict = readTrodesExtractedDataFile3.readTrodesExtractedDataFile(timestamps_file, use_mmap=True)
+            lfp_tstamps = _recordColumn(lfp_tstamp_dict['data'], lfp_tstamp_dict['data'].dtype.names[0])
+            if len(lfp_tstamps) == len(self.records):
+                self.timestamps = lfp_tstamps
+            else:
+                print(MODULE_IDENTIFIER + 'LFP Timestamps differ from LFP values in size!')
+        except (FileNotFoundError, IOError) as err:
+            print(MODULE_IDENTIFIER + 'UNABLE TO READ timestamps file. Using uniformly spaced timestamps!')
+        self._timestamp_index = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def read(self, start=0, stop=None, channels=None):
+        """
+        Read samples [start, stop) into memory.
+
+        :channels: Channels to be read (all by default)
+        :returns: LFP values (samples x channels)
+        """
+        if channels is None:
+            return np.array(self.voltage[start:stop])
+        return np.array(self.voltage[start:stop, channels])
+
+    def _read_columns(self, start, stop, channels):
+        samples = self.read(start, stop, channels).astype(float)
+        if samples.ndim == 1:
+            samples = samples[:, np.newaxis]
+        return samples
+
+    def read_timestamps(self, start=0, stop=None):
+        """
+        Read the timestamps for samples [start, stop). Without a timestamps
+        file, these are uniformly spaced sample numbers.
+        """
+        if self.timestamps is None:
+            return np.arange(len(self))[start:stop]
+        return np.array(self.timestamps[start:stop])
+
+    def get_timestamp_index(self):
+        """
+        Run-length index of the timestamps (see timestamp_index). Built on
+        first use, or read from next to the timestamps file.
+        """
+        if (self._timestamp_index is None) and (self.timestamps is not None):
+            self._timestamp_index = timestamp_index.load_timestamp_index(self.timestamps_file)
+        return self._timestamp_index
+
+    def timestamp_gaps(self):
+        """
+        :returns: Indices of the samples that follow a gap in the timestamps.
+        """
+        if self.timestamps is None:
+            return np.empty(0, dtype='int64')
+        gap_samples, _ = self.get_timestamp_index().gaps()
+        return gap_samples
+
+    def find_samples(self, timestamps):
+        """
+        Samples at (or right after) the given timestamps, without reading the
+        timestamps from disk.
+        """
+        if self.timestamps is None:
+            return np.asarray(timestamps, dtype='int64')
+        return self.get_timestamp_index().timestamps_to_samples(timestamps)
+
+    def is_uniformly_spaced(self):
+        return len(self.timestamp_gaps()) == 0
+
+    def decimate(self, factor=DECIMATION_FACTOR, channels=None, chunk_size=LFP_CHUNK_SAMPLES):
+        """
+        Low-pass filter and downsample the LFP, one chunk at a time. The
+        anti-aliasing filter is run forwards and backwards (zero-phase), so
+        the decimated LFP stays aligned with its timestamps. Each chunk is
+        filtered with enough of its neighbours on either side for the edge
+        transients to die out, and only the samples in the chunk are kept, so
+        the result does not depend on the chunk size.
+
+        :factor: Decimation factor
+        :channels: Channels to be decimated (all by default)
+        :returns: Timestamps and LFP values (samples x channels) for every
+            factor-th sample.
+        """
+        from scipy.signal import butter, sosfiltfilt, sos2zpk
+
+        antialias_sos = butter(LFP_ANTIALIAS_ORDER, LFP_ANTIALIAS_CUTOFF / factor, output='sos')
+        # Samples it takes the slowest pole of the filter to settle
+        _, filter_poles, _ = sos2zpk(antialias_sos)
+        chunk_padding = int(np.ceil(np.log(LFP_ANTIALIAS_SETTLING) / np.log(np.max(np.abs(filter_poles)))))
+
+        n_samples = len(self)
+        decimated_pieces = [self._read_columns(0, 0, channels)]
+        for chunk_start in range(0, n_samples, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, n_samples)
+            padded_start = max(0, chunk_start - chunk_padding)
+            padded_chunk = self._read_columns(padded_start, min(chunk_stop + chunk_padding, n_samples), channels)
+            filtered_chunk = sosfiltfilt(antialias_sos, padded_chunk, axis=0)
+            # Keep every factor-th sample of the recording (not of the chunk)
+            first_kept = (chunk_start - padded_start) + (-chunk_start) % factor
+            decimated_pieces.append(filtered_chunk[first_kept:chunk_stop-padded_start:factor])
+        decimated_lfp = np.concatenate(decimated_pieces)
+
+        if self.timestamps is None:
+            decimated_timestamps = np.arange(0, len(self), factor)
+        else:
+            decimated_timestamps = np.array(self.timestamps[::factor])
+        return decimated_timestamps, decimated_lfp
+
+def loadLFP(data_file=None, lazy=False):
     """
     Load LFP data, test for timestamp jumps.
 
     :data_file: Location of the LFP data file. Trodes extracted LFP is a .dat file
+    :lazy: Return a LazyLFP, which reads the data only when it is accessed.
     :returns: LFP data as a Nx2 array containing LFP timestamps and values
     """
 
     if data_file is None:
+        import QtHelperUtils
+        from tkinter import Tk
         gui_root = Tk()
         gui_root.wm_withdraw()
         data_file = QtHelperUtils.get_open_file_name(data_dir=DEFAULT_SEARCH_PATH, message="Select LFP data File", \
             file_format="LFP Data (.dat)")
         gui_root.destroy()
 
+    if lazy:
+        try:
+            return LazyLFP(data_file)
+        except (FileNotFoundError, IOError) as err:
+            print(err)
+            return
+
     try:
         lfp_data_dict = readTrodesExtractedDataFile3.readTrodesExtractedDataFile(data_file)
         lfp_data = lfp_data_dict['data']
@@ -536,16 +881,21 @@ def loadLFP(data_file=None):
         return
 
     # Look for spike timestamps in the same directory
-    timestamps_file = data_file.split('.LFP_')[0] + '.timestamps.dat'
+    timestamps_file = _lfpTimestampsFile(data_file)
     try:
         lfp_tstamp_dict = readTrodesExtractedDataFile3.readTrodesExtractedDataFile(timestamps_file)
         lfp_tstamps = lfp_tstamp_dict['data']
 
         if len(lfp_tstamps) == len(lfp_data):
             # Check that the timestamps are uniformly spaced
-            tstamp_spacing = np.diff(lfp_tstamps)
-            if (tstamp_spacing == tstamp_spacing[0]).all():
+            lfp_timestamp_index = timestamp_index.load_timestamp_index(timestamps_file)
+            gap_samples, gap_durations = lfp_timestamp_index.gaps()
+            if len(gap_samples) == 0:
                 print(MODULE_IDENTIFIER + 'LFP Timestamps uniformly spaced!')
+            else:
+                # Gap durations are in clock ticks, LFP samples are step ticks apart.
+                print(MODULE_IDENTIFIER + 'LFP Timestamps have %d gaps (%d timestamps missing)!'%(len(gap_samples), \
+                        np.sum(gap_durations) // lfp_timestamp_index.step))
         else:
             print(MODULE_IDENTIFIER + 'LFP Timestamps differ from LFP values in size!')
             lfp_tstamps = None
@@ -556,6 +906,8 @@ def loadLFP(data_file=None):
         return [lfp_tstamps, lfp_data]
 
 if __name__ == "__main__":
+    from PyQt5.QtWidgets import QApplication
+
     # By default, extract firings into epochs.
     qt_args = list()
     qt_args.append(sys.argv[0])
@@ -154,6 +154,7 @@ def parseQtCommandlineArgs(args):
     parser.add_argument('--raw', metavar='<[npz] raw-data>', help='Raw data to be imported as a numpy archive.')
     parser.add_argument('--bayesian', metavar='<[npz] decoded-data>', help='Decoded data to be imported as a numpy archive.')
     parser.add_argument('--output-dir', metavar='<output-directory>', help='Output directory where sorted spike data should be stored')
+    parser.add_argument('--tetrode-cache', metavar='<tetrode-cache>', help='Memory budget (GB) for tetrodes kept loaded in the viewer', type=float)
     args = parser.parse_args()
     # print(args)
     return args
@@ -0,0 +1,226 @@
+"""
+Storage for named numpy arrays (processed recordings, place fields, decoded
+data) that can be reopened without reading everything back into memory.
+
+Arrays are stored either as a directory with one .npy file per field and a
+JSON manifest, in which case each field is memory-mapped when it is first
+accessed, or as a compressed .npz container, in which case each field is
+decompressed when it is first accessed. Plain .npz archives written by
+np.savez can be opened the same way.
+"""
+
+import os
+import json
+import uuid
+import numpy as np
+
+MODULE_IDENTIFIER = "[ArrayStore] "
+MANIFEST_FILENAME = 'manifest.json'
+ARRAY_STORE_VERSION = 1
+NPZ_EXTENSION = '.npz'
+NPY_EXTENSION = '.npy'
+STORE_EXTENSION = '.arrays'
+
+def _as_array(value):
+    """
+    Convert a field to a numpy array. Lists of arrays with different lengths
+    (spikes or spike locations for each unit, for example) are stored as
+    object arrays.
+    """
+    if isinstance(value, np.ndarray):
+        return value
+    try:
+        return np.asarray(value)
+    except ValueError:
+        object_array = np.empty(len(value), dtype=object)
+        for v_idx, element in enumerate(value):
+            object_array[v_idx] = element
+        return object_array
+
+def _check_field_names(field_names):
+    for field_name in field_names:
+        if (not field_name) or (os.path.basename(field_name) != field_name) or field_name.startswith('.'):
+            raise ValueError(MODULE_IDENTIFIER + 'Invalid field name %s.'%field_name)
+    if len(set(field_names)) != len(field_names):
+        raise ValueError(MODULE_IDENTIFIER + 'Duplicate field names.')
+
+def _unique_name(name, extension):
+    # New files never take the place of (or clash with) existing ones.
+    return '%s.%s%s'%(name, uuid.uuid4().hex, extension)
+
+def store_path(path, compressed=False):
+    """
+    Path at which arrays saved as path are stored. Compressed stores are .npz
+    files. Directory stores get their own extension (replacing a trailing
+    .npz, which save dialogs add), so they never take the place of an archive.
+    """
+    if compressed:
+        return path if path.endswith(NPZ_EXTENSION) else path + NPZ_EXTENSION
+    if path.endswith(NPZ_EXTENSION):
+        path = path[:-len(NPZ_EXTENSION)]
+    return path if path.endswith(STORE_EXTENSION) else path + STORE_EXTENSION
+
+def find_arrays(path):
+    """
+    Find saved arrays: path itself (a store directory, its manifest or an
+    .npz file), or the directory store that arrays saved as path went to.
+
+    :returns: Existing path, or None if nothing was saved there.
+    """
+    if os.path.exists(path):
+        return path
+    if os.path.isdir(store_path(path)):
+        return store_path(path)
+    return None
+
+def save_arrays(path, fields, compressed=False):
+    """
+    Save named arrays.
+
+    :path: Output location (see store_path for the directory or .npz file
+        actually written)
+    :fields: List of (name, array) pairs, in the order in which they should
+        be returned when the store is read back.
+    :compressed: Write a compressed .npz container instead of a directory of
+        memory-mappable .npy files. Otherwise, an .npz archive at path is
+        replaced by the directory.
+    :returns: Path of the written store.
+    """
+    field_names = [field_name for field_name, _ in fields]
+    _check_field_names(field_names)
+    field_arrays = [_as_array(field_value) for _, field_value in fields]
+
+    requested_path = path
+    path = store_path(path, compressed)
+    if compressed:
+        np.savez_compressed(path, **dict(zip(field_names, field_arrays)))
+        return path
+
+    if os.path.exists(path) and not os.path.isdir(path):
+        raise IOError(MODULE_IDENTIFIER + '%s exists and is not an array store directory.'%path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    # The manifest decides what the store holds. Fields are written to new
+    # files, and the manifest is only replaced once all of them are complete,
+    # so an interrupted save leaves the previous store intact. Files of the
+    # previous store may still be memory-mapped (when saving arrays read from
+    # it), which is why they are never written over.
+    manifest_file = os.path.join(path, MANIFEST_FILENAME)
+    replaced_files = list()
+    if os.path.exists(manifest_file):
+        try:
+            with open(manifest_file, 'r') as f:
+                replaced_files = [field['file'] for field in json.load(f)['fields']]
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    manifest = {'version': ARRAY_STORE_VERSION, 'fields': list()}
+    written_files = list()
+    try:
+        for field_name, field_array in zip(field_names, field_arrays):
+            field_file = _unique_name(field_name, NPY_EXTENSION)
+            written_files.append(os.path.join(path, field_file))
+            with open(written_files[-1], 'xb') as f:
+                np.save(f, field_array, allow_pickle=(field_array.dtype.hasobject))
+            manifest['fields'].append({
+                'name': field_name,
+                'file': field_file,
+                'dtype': str(field_array.dtype),
+                'shape': list(field_array.shape)
+                })
+
+        tmp_manifest_file = os.path.join(path, _unique_name(MANIFEST_FILENAME, '.tmp'))
+        written_files.append(tmp_manifest_file)
+        with open(tmp_manifest_file, 'x') as f:
+            json.dump(manifest, f, indent=4, separators=(',', ': '))
+        os.replace(tmp_manifest_file, manifest_file)
+    except BaseException:
+        for written_file in written_files:
+            if os.path.exists(written_file):
+                os.remove(written_file)
+        raise
+
+    # Readers that already opened the previous fields keep them (on POSIX
+    # systems) until they are done with them.
+    for replaced_file in set(replaced_files) - set(field['file'] for field in manifest['fields']):
+        try:
+            os.remove(os.path.join(path, replaced_file))
+        except OSError as err:
+            print(MODULE_IDENTIFIER + 'Unable to remove replaced field file %s.'%replaced_file)
+            print(err)
+
+    # Saving over an archive (the save dialog already asked before
+    # overwriting it) replaces it, so that opening it finds the new store.
+    if requested_path.endswith(NPZ_EXTENSION) and os.path.isfile(requested_path):
+        os.remove(requested_path)
+    return path
+
+class ArrayStore(object):
+
+    """
+    Read-only access to saved arrays. Fields are only read when they are
+    accessed.
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        """
+        :path: Store directory (or its manifest), or an .npz file
+        :mmap_mode: Memory-mapping mode for fields in a store directory (None
+            to read fields into memory)
+        """
+        if os.path.basename(path) == MANIFEST_FILENAME:
+            path = os.path.dirname(path)
+        elif not os.path.exists(path):
+            path = find_arrays(path) or path
+        self.path = path
+        self.mmap_mode = mmap_mode
+        self._arrays = dict()
+        self._npz_file = None
+
+        if os.path.isdir(path):
+            with open(os.path.join(path, MANIFEST_FILENAME), 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('version') != ARRAY_STORE_VERSION:
+                raise ValueError(MODULE_IDENTIFIER + 'Unsupported store version in %s.'%path)
+            self._field_info = dict([(field['name'], field) for field in manifest['fields']])
+            self.fields = [field['name'] for field in manifest['fields']]
+        else:
+            # Compressed stores and archives written by np.savez. NpzFile
+            # already reads fields on access.
+            self._npz_file = np.load(path, allow_pickle=True)
+            self.fields = list(self._npz_file.files)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __contains__(self, field_name):
+        return field_name in self.fields
+
+    def __getitem__(self, field_name):
+        if field_name not in self._arrays:
+            if field_name not in self.fields:
+                raise KeyError(field_name)
+            if self._npz_file is not None:
+                self._arrays[field_name] = self._npz_file[field_name]
+            else:
+                field_info = self._field_info[field_name]
+                # Object arrays are pickled and cannot be memory-mapped.
+                has_objects = (field_info['dtype'] == 'object')
+                self._arrays[field_name] = np.load(os.path.join(self.path, field_info['file']), \
+                        mmap_mode=None if has_objects else self.mmap_mode, allow_pickle=has_objects)
+        return self._arrays[field_name]
+
+    def keys(self):
+        return list(self.fields)
+
+    def close(self):
+        if self._npz_file is not None:
+            self._npz_file.close()
+            self._npz_file = None
+
+def open_arrays(path, mmap_mode='r'):
+    """
+    Open saved arrays for reading (see ArrayStore).
+    """
+    return ArrayStore(path, mmap_mode)
@@ -0,0 +1,79 @@
+"""
+Import-time benchmark for the batch (non-GUI) modules. Each module is imported
+in a fresh interpreter, the fastest of several imports is compared against
+the startup budget, and the modules that pulled in a GUI toolkit are flagged.
+Exits with a non-zero status if any module fails either check:
+
+    python3 check_import_time.py [--budget <seconds>] [--repeats <n>]
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+MODULE_IDENTIFIER = "[ImportTime] "
+BATCH_MODULES = ['mda_stream', 'ms4_pipeline_graph', 'separateCuratedSpikes', 'MountainViewIO', \
+        'extractCuratedSpikes', 'MS4batch']
+GUI_MODULES = ['PyQt5', 'tkinter', 'matplotlib', 'QtHelperUtils']
+IMPORT_TIME_BUDGET = 1.0
+N_IMPORT_REPEATS = 5
+
+# Run in a fresh interpreter so that nothing is already cached in sys.modules
+IMPORT_TIMER_SOURCE = """
+import sys, json, time, importlib
+t_start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+t_import = time.perf_counter() - t_start
+gui_modules = [m for m in sys.argv[2:] if m in sys.modules]
+print(json.dumps({'time': t_import, 'gui_modules': gui_modules}))
+"""
+
+def measureImportTime(module_name, n_repeats=N_IMPORT_REPEATS):
+    """
+    Import a module in fresh interpreters.
+
+    :returns: Fastest import time (seconds) and the GUI modules that were
+        loaded along with the module.
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    import_times = list()
+    gui_modules = list()
+    for _ in range(n_repeats):
+        result = subprocess.run([sys.executable, '-c', IMPORT_TIMER_SOURCE, module_name] + GUI_MODULES, \
+                cwd=package_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, \
+                check=True)
+        import_stats = json.loads(result.stdout.strip().splitlines()[-1])
+        import_times.append(import_stats['time'])
+        gui_modules = import_stats['gui_modules']
+    return min(import_times), gui_modules
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import-time benchmark for batch modules.')
+    parser.add_argument('--budget', metavar='<seconds>', help='Maximum import time for each module', \
+            type=float, default=IMPORT_TIME_BUDGET)
+    parser.add_argument('--repeats', metavar='<repeats>', help='Number of times each module is imported', \
+            type=int, default=N_IMPORT_REPEATS)
+    args = parser.parse_args()
+
+    n_failures = 0
+    for module_name in BATCH_MODULES:
+        try:
+            import_time, gui_modules = measureImportTime(module_name, max(1, args.repeats))
+        except subprocess.CalledProcessError as err:
+            print(MODULE_IDENTIFIER + 'FAILED %s: Unable to import.'%module_name)
+            print(err.stderr)
+            n_failures += 1
+            continue
+
+        status = 'OK'
+        if gui_modules:
+            status = 'FAILED (loads %s)'%', '.join(gui_modules)
+        elif import_time > args.budget:
+            status = 'FAILED (over %.2fs budget)'%args.budget
+        if status != 'OK':
+            n_failures += 1
+        print(MODULE_IDENTIFIER + '%-24s %7.3fs  %s'%(module_name, import_time, status))
+
+    sys.exit(1 if n_failures else 0)
@@ -18,8 +18,15 @@ def parse_commandline_arguments():
     parser.add_argument('--clear-files', metavar='<clear-files>', help='Clear additional files', type=bool)
     parser.add_argument('--tetrode-begin', metavar='<tetrode-begin>', help='First tetrode to sort', type=int)
     parser.add_argument('--tetrode-end', metavar='<tetrode-end>', help='Last tetrode to sort', type=int)
+    parser.add_argument('--n-workers', metavar='<n-workers>', help='Number of tetrodes to sort simultaneously', type=int)
+    parser.add_argument('--worker-memory', metavar='<worker-memory>', help='Memory budget (GB) for each sorting worker, used to size the worker pool and enforced as a data segment limit (RLIMIT_DATA) on each sorting process', type=float)
+    parser.add_argument('--adopt-existing', metavar='<adopt-existing>', help='Treat outputs of untracked earlier runs as current', type=bool)
+    parser.add_argument('--chunk-size', metavar='<chunk-size>', help='Spikes processed at a time during autocuration', type=int)
     parser.add_argument('--date', metavar='YYYYMMDD', help='Experiment date', type=int)
     parser.add_argument('--data-dir', metavar='<[MDA] data-directory>', help='Data directory from which MDA files should be read.')
+    parser.add_argument('--timestamp-files', metavar='<timestamp-files>', help='Spike timestamp files, in epoch order', nargs='+')
+    parser.add_argument('--timestamp-dir', metavar='<timestamp-directory>', help='Directory searched for spike timestamp files')
+    parser.add_argument('--firings-file', metavar='<firings-file>', help='Curated firings file to be split into epochs')
     parser.add_argument('--output-dir', metavar='<output-directory>', help='Output directory where sorted spike data should be stored')
     args = parser.parse_args()
     # print(args)
@@ -1,14 +1,16 @@
 import os
 import sys
 import json
+import time
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Mountainlab tools
 from mountainlab_pytools import mdaio
 
 # Local imports
-import QtHelperUtils
-import MountainViewIO
+import commandline
+import mda_stream
 
 # Parameter definitions. Tweak to get your desired cluster selection
 PEAK_AMPLITUDE_LO_CUTOFF = 5.0      # MIN value of peak amplitude
@@ -20,20 +22,15 @@ MODULE_IDENTIFIER        = "[AutoCuration] "
 FIRINGS_FILENAME         = 'firings_raw.mda'
 METRICS_FILENAME         = 'metrics_cleaned.json'
 OUTPUT_FILENAME          = 'firings_autocurated.mda'
-def autocurate(firings_file, metrics_file, output_file):
-    """
-    Load raw firings from file and use metrics to automatically curate them.
+TETRODE_DIR_PREFIX       = 'nt'
+
+def getAcceptedClusters(metrics):
     """
+    Use cluster metrics to decide which clusters should be retained.
 
-    # Load the metrics file and identify the clusters that need to be retained
-    print(MODULE_IDENTIFIER + "Reading metrics file")
-    try:
-        with open(metrics_file, 'r') as f:
-            metrics = json.load(f)
-    except (FileNotFoundError, IOError) as err:
-        print('ERROR: Unable to read metrics file. Aborting.')
-        print(err)
-        return
+    :metrics: Cluster metrics (as read from the metrics JSON file)
+    :returns: Dictionary mapping each cluster label to its accept/reject decision.
+    """
 
     accepted_clusters = dict()
     for cluster in metrics['clusters']:
@@ -53,27 +50,167 @@ def autocurate(firings_file, metrics_file, output_file):
 
         # If none of the stuff above eats through the metrics, the cluster is accepted
         accepted_clusters[cluster['label']] = True
+    return accepted_clusters
 
+def getAcceptanceTable(accepted_clusters):
+    """
+    Build a lookup table, indexed by cluster label, that is True for accepted
+    clusters.
+    """
+    max_label = max([int(label) for label in accepted_clusters.keys()] + [0])
+    acceptance_table = np.zeros(max_label+1, dtype='bool')
+    for label, accepted in accepted_clusters.items():
+        acceptance_table[int(label)] = accepted
+    return acceptance_table
+
+def acceptSpikes(spike_labels, acceptance_table):
+    """
+    Get a mask of spikes that belong to accepted clusters. Labels that are not
+    in the table (clusters without metrics) are rejected.
+    """
+    spike_labels = np.asarray(spike_labels).astype('int64')
+    labels_in_table = (spike_labels >= 0) & (spike_labels < len(acceptance_table))
+    acceptance_mask = np.zeros(len(spike_labels), dtype='bool')
+    acceptance_mask[labels_in_table] = acceptance_table[spike_labels[labels_in_table]]
+    return acceptance_mask
+
+def autocurate(firings_file, metrics_file, output_file, chunk_size=None):
+    """
+    Load raw firings from file and use metrics to automatically curate them.
+
+    :chunk_size: If set, firings are streamed from the raw file chunk_size
+        spikes at a time and accepted spikes are written out as they are found,
+        so memory use does not grow with the size of the firings file.
+    :returns: Number of spikes read and number of spikes accepted (None if
+        curation failed).
+    """
+
+    # Load the metrics file and identify the clusters that need to be retained
+    print(MODULE_IDENTIFIER + "Reading metrics file")
+    try:
+        with open(metrics_file, 'r') as f:
+            metrics = json.load(f)
+    except (FileNotFoundError, IOError) as err:
+        print('ERROR: Unable to read metrics file. Aborting.')
+        print(err)
+        return
+
+    accepted_clusters = getAcceptedClusters(metrics)
     print(MODULE_IDENTIFIER + "Processed clusters. Accept/Reject decisions...")
     print(accepted_clusters)
+    acceptance_table = getAcceptanceTable(accepted_clusters)
 
     try:
-        firing_data = mdaio.readmda(firings_file)
-        n_spikes = firing_data.shape[1]
-        acceptance_mask = np.zeros(n_spikes, dtype='bool')
-        for spk_idx in range(n_spikes):
-            acceptance_mask[spk_idx] = accepted_clusters[firing_data[2,spk_idx]]
-
-        mdaio.writemda64(firing_data[:, acceptance_mask], output_file)
+        if chunk_size is None:
+            firing_data = mdaio.readmda(firings_file)
+            n_spikes = firing_data.shape[1]
+            acceptance_mask = acceptSpikes(firing_data[2], acceptance_table)
+            n_accepted = int(np.sum(acceptance_mask))
+            mdaio.writemda64(firing_data[:, acceptance_mask], output_file)
+        else:
+            firing_data = mda_stream.memmap_mda(firings_file)
+            n_spikes = firing_data.shape[1]
+            with mda_stream.MdaColumnWriter(output_file, firing_data.shape[0], 'float64', \
+                    max_columns=n_spikes) as firings_writer:
+                for chunk_start in range(0, n_spikes, chunk_size):
+                    firing_chunk = np.asarray(firing_data[:, chunk_start:chunk_start+chunk_size])
+                    acceptance_mask = acceptSpikes(firing_chunk[2], acceptance_table)
+                    firings_writer.write(firing_chunk[:, acceptance_mask])
+                n_accepted = firings_writer.n_columns
         print(MODULE_IDENTIFIER + "Read %d spikes in raw file."%n_spikes)
-        print(MODULE_IDENTIFIER + "%d accepted spikes written to %s."%(np.sum(acceptance_mask), output_file))
+        print(MODULE_IDENTIFIER + "%d accepted spikes written to %s."%(n_accepted, output_file))
     except (FileNotFoundError, IOError) as err:
-        QtHelperUtils.display_warning('Unable to read/write MDA file.')
+        print('ERROR: Unable to read/write MDA file.')
         print(err)
         return
+    return n_spikes, n_accepted
+
+def findTetrodeDirectories(data_dir):
+    """
+    Get all the tetrode (nt*) directories in data_dir, ordered by tetrode index.
+    """
+    tetrode_dirs = list()
+    for nt_dir in os.listdir(data_dir):
+        if nt_dir.startswith(TETRODE_DIR_PREFIX) and os.path.isdir(os.path.join(data_dir, nt_dir)):
+            tetrode_dirs.append(nt_dir)
+
+    def tetrodeIndex(nt_dir):
+        nt_idx = nt_dir[len(TETRODE_DIR_PREFIX):]
+        return (0, int(nt_idx), nt_dir) if nt_idx.isdigit() else (1, 0, nt_dir)
+    return sorted(tetrode_dirs, key=tetrodeIndex)
+
+def _autocurateTetrode(data_dir, output_dir, nt_dir, chunk_size):
+    """
+    Curate a single tetrode directory, timing the curation.
+    """
+    start_time = time.time()
+    out_nt_dir = os.path.join(output_dir, nt_dir)
+    # Check if the output directory does not exist.
+    if not os.path.exists(out_nt_dir):
+        print(MODULE_IDENTIFIER + "Output directory %s not found. Creating..."%out_nt_dir)
+        os.makedirs(out_nt_dir, exist_ok=True)
+    curation_result = autocurate(os.path.join(data_dir, nt_dir, FIRINGS_FILENAME), \
+            os.path.join(data_dir, nt_dir, METRICS_FILENAME), \
+            os.path.join(out_nt_dir, OUTPUT_FILENAME), chunk_size)
+    return curation_result, time.time() - start_time
+
+def autocurateTetrodes(data_dir, output_dir=None, n_workers=1, chunk_size=None):
+    """
+    Curate all the tetrode directories in data_dir, n_workers tetrodes at a time.
+
+    :data_dir: Directory containing the sorted tetrode directories
+    :output_dir: Directory in which curated firings are written (data_dir by default)
+    :n_workers: Number of worker processes
+    :chunk_size: Passed on to autocurate
+    :returns: Dictionary of (spikes read, spikes accepted, time taken) for each
+        tetrode. Spike counts are None for tetrodes that could not be curated.
+    """
+    if output_dir is None:
+        output_dir = data_dir
+
+    tetrode_dirs = findTetrodeDirectories(data_dir)
+    print(MODULE_IDENTIFIER + "Curating %d tetrodes with %d workers."%(len(tetrode_dirs), n_workers))
+    curation_summary = dict()
+    with ProcessPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        curation_jobs = dict()
+        for nt_dir in tetrode_dirs:
+            curation_jobs[executor.submit(_autocurateTetrode, data_dir, output_dir, nt_dir, chunk_size)] = nt_dir
+
+        for job in as_completed(curation_jobs):
+            nt_dir = curation_jobs[job]
+            try:
+                curation_result, time_taken = job.result()
+            except Exception as err:
+                print(err)
+                curation_result, time_taken = None, 0.0
+            if curation_result is None:
+                curation_result = (None, None)
+            curation_summary[nt_dir] = (curation_result[0], curation_result[1], time_taken)
+            print(MODULE_IDENTIFIER + "Finished %s"%nt_dir)
+
+    printCurationSummary(curation_summary, tetrode_dirs)
+    return curation_summary
+
+def printCurationSummary(curation_summary, tetrode_dirs):
+    """
+    Print a table of per-tetrode spike counts and timing.
+    """
+    print(MODULE_IDENTIFIER + "Curation summary")
+    print('%-10s %12s %12s %10s'%('Tetrode', 'Spikes', 'Accepted', 'Time (s)'))
+    total_spikes = 0
+    total_accepted = 0
+    for nt_dir in tetrode_dirs:
+        n_spikes, n_accepted, time_taken = curation_summary[nt_dir]
+        if n_spikes is None:
+            print('%-10s %12s %12s %10.1f'%(nt_dir, 'FAILED', '-', time_taken))
+            continue
+        total_spikes += n_spikes
+        total_accepted += n_accepted
+        print('%-10s %12d %12d %10.1f'%(nt_dir, n_spikes, n_accepted, time_taken))
+    print('%-10s %12d %12d'%('Total', total_spikes, total_accepted))
 
 if __name__ == "__main__":
-    parsed_arguments = QtHelperUtils.parseQtCommandlineArgs(sys.argv)
+    parsed_arguments = commandline.parse_commandline_arguments()
     data_dir = os.getcwd()
     if parsed_arguments.data_dir:
         data_dir = parsed_arguments.data_dir
@@ -82,15 +219,8 @@ if __name__ == "__main__":
     if parsed_arguments.output_dir:
         output_dir = parsed_arguments.output_dir
 
-    # Get a list of all the tetrode directories
-    for nt_dir in os.listdir(data_dir):
-        # Check if the output directory does not exist.
-        out_nt_dir = os.path.join(output_dir, nt_dir)
-        if not os.path.exists(out_nt_dir):
-            print(MODULE_IDENTIFIER + "Output directory %s not found. Creating...")
-            os.mkdir(out_nt_dir)
-        autocurate(os.path.join(data_dir, nt_dir, FIRINGS_FILENAME), \
-                os.path.join(data_dir, nt_dir, METRICS_FILENAME), \
-                os.path.join(output_dir, nt_dir, OUTPUT_FILENAME))
-        print(MODULE_IDENTIFIER + "Finished %s"%nt_dir)
+    n_workers = 1
+    if parsed_arguments.n_workers:
+        n_workers = parsed_arguments.n_workers
 
+    autocurateTetrodes(data_dir, output_dir, n_workers, parsed_arguments.chunk_size)
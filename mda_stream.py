@@ -0,0 +1,327 @@
+"""
+Streaming access to MDA files that does not go through mountainlab processors.
+
+MDA files store data in column-major order, so for a (channels x samples)
+timeseries, every sample is a contiguous block of bytes and timeseries can be
+concatenated along time by appending their data blocks one after the other.
+"""
+
+import os
+import json
+import struct
+import numpy as np
+
+MODULE_IDENTIFIER = "[MDAStream] "
+COPY_CHUNK_BYTES = 64 * 1024 * 1024
+VIRTUAL_CONCAT_EXTENSION = '.concat.json'
+
+# MDA data type codes (see mountainlab_pytools.mdaio)
+MDA_DTYPE_CODES = {
+        -2: 'uint8',
+        -3: 'float32',
+        -4: 'int16',
+        -5: 'int32',
+        -6: 'uint16',
+        -7: 'float64',
+        -8: 'uint32'
+        }
+MDA_CODES_FROM_DTYPE = dict([(dt, code) for code, dt in MDA_DTYPE_CODES.items()])
+MAX_32BIT_DIM = 2000000000
+
+class MdaHeader(object):
+
+    """
+    Header information for an MDA file.
+    """
+
+    def __init__(self, dtype, dims, header_size):
+        self.dtype = dtype
+        self.dims = list(dims)
+        self.header_size = header_size
+        self.bytes_per_entry = np.dtype(dtype).itemsize
+
+    def n_entries(self):
+        n_entries = 1
+        for dim in self.dims:
+            n_entries *= dim
+        return n_entries
+
+    def data_bytes(self):
+        return self.n_entries() * self.bytes_per_entry
+
+def _read_header_from(f):
+    dt_code, _, n_dims = struct.unpack('<iii', f.read(12))
+    if dt_code not in MDA_DTYPE_CODES:
+        raise IOError(MODULE_IDENTIFIER + 'Invalid data type code %d.'%dt_code)
+
+    uses_64bit_dims = (n_dims < 0)
+    n_dims = abs(n_dims)
+    if (n_dims < 1) or (n_dims > 6):
+        raise IOError(MODULE_IDENTIFIER + 'Invalid number of dimensions %d.'%n_dims)
+
+    if uses_64bit_dims:
+        dims = struct.unpack('<' + 'q' * n_dims, f.read(8 * n_dims))
+        header_size = 12 + 8 * n_dims
+    else:
+        dims = struct.unpack('<' + 'i' * n_dims, f.read(4 * n_dims))
+        header_size = 12 + 4 * n_dims
+    return MdaHeader(MDA_DTYPE_CODES[dt_code], dims, header_size)
+
+def read_header(path):
+    """
+    Read the header of an MDA file.
+
+    :path: MDA file
+    :returns: MdaHeader with the data type, dimensions and header size.
+    """
+    with open(path, 'rb') as f:
+        return _read_header_from(f)
+
+def write_header(f, dtype, dims, uses_64bit_dims=None):
+    """
+    Write an MDA header at the current position of an open file.
+
+    :uses_64bit_dims: Store dimensions as 64-bit integers. By default, this is
+        only done if one of the dimensions is too large for 32 bits.
+    :returns: Size of the header in bytes.
+    """
+    dtype = np.dtype(dtype).name
+    dims = [int(dim) for dim in dims]
+    if uses_64bit_dims is None:
+        uses_64bit_dims = (max(dims) > MAX_32BIT_DIM)
+    f.write(struct.pack('<ii', MDA_CODES_FROM_DTYPE[dtype], np.dtype(dtype).itemsize))
+    if uses_64bit_dims:
+        f.write(struct.pack('<i', -len(dims)))
+        f.write(struct.pack('<' + 'q' * len(dims), *dims))
+        return 12 + 8 * len(dims)
+    f.write(struct.pack('<i', len(dims)))
+    f.write(struct.pack('<' + 'i' * len(dims), *dims))
+    return 12 + 4 * len(dims)
+
+def memmap_mda(path, mode='r'):
+    """
+    Memory-map the data in an MDA file. Only the parts of the file that are
+    accessed are read from disk.
+
+    :returns: numpy.memmap with the dimensions of the MDA.
+    """
+    header = read_header(path)
+    return np.memmap(path, dtype=header.dtype, mode=mode, offset=header.header_size, \
+            shape=tuple(header.dims), order='F')
+
+class MdaColumnWriter(object):
+
+    """
+    Write a 2D MDA one block of columns at a time, for outputs whose final
+    number of columns is not known in advance. The header is completed when
+    the writer is closed.
+    """
+
+    def __init__(self, path, n_rows, dtype='float64', max_columns=MAX_32BIT_DIM):
+        """
+        :path: Output MDA file
+        :n_rows: Number of rows in every column
+        :max_columns: Upper bound on the number of columns (decides the size of
+            the header)
+        """
+        self.path = path
+        self.n_rows = n_rows
+        self.dtype = np.dtype(dtype)
+        self.n_columns = 0
+        self._uses_64bit_dims = (max(n_rows, max_columns) > MAX_32BIT_DIM)
+        self._tmp_path = path + '.tmp'
+        self._file = open(self._tmp_path, 'wb')
+        write_header(self._file, self.dtype, [n_rows, 0], self._uses_64bit_dims)
+
+    def write(self, columns):
+        """
+        Append a (n_rows x n) block of columns.
+        """
+        if columns.shape[0] != self.n_rows:
+            raise ValueError(MODULE_IDENTIFIER + 'Expected %d rows, got %d.'%(self.n_rows, columns.shape[0]))
+        # Column-major order: the transpose, written in row-major order.
+        np.ascontiguousarray(columns.T, dtype=self.dtype).tofile(self._file)
+        self.n_columns += columns.shape[1]
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.seek(0)
+        write_header(self._file, self.dtype, [self.n_rows, self.n_columns], self._uses_64bit_dims)
+        self._file.close()
+        self._file = None
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def _read_timeseries_headers(input_files):
+    headers = list()
+    for input_file in input_files:
+        header = read_header(input_file)
+        if len(header.dims) != 2:
+            raise ValueError(MODULE_IDENTIFIER + '%s is not a timeseries.'%input_file)
+        if headers and ((header.dims[0] != headers[0].dims[0]) or (header.dtype != headers[0].dtype)):
+            raise ValueError(MODULE_IDENTIFIER + '%s does not match the channels/data type of %s.'%(input_file, \
+                    input_files[0]))
+        headers.append(header)
+    if not headers:
+        raise ValueError(MODULE_IDENTIFIER + 'No timeseries to concatenate.')
+    return headers
+
+def concat_timeseries(input_files, output_file, chunk_bytes=COPY_CHUNK_BYTES):
+    """
+    Concatenate (channels x samples) MDA timeseries along time. Data is copied
+    in chunks of (at most) chunk_bytes, aligned to whole samples, so memory use
+    does not depend on the size of the inputs.
+
+    :input_files: Timeseries to be concatenated, in order
+    :output_file: Concatenated timeseries
+    :returns: Sample offsets of the individual inputs in the output.
+    """
+    headers = _read_timeseries_headers(input_files)
+    n_channels = headers[0].dims[0]
+    sample_bytes = n_channels * headers[0].bytes_per_entry
+    chunk_bytes = max(sample_bytes, (chunk_bytes // sample_bytes) * sample_bytes)
+    copy_buffer = memoryview(bytearray(chunk_bytes))
+
+    sample_offsets = list()
+    n_samples = 0
+    for header in headers:
+        sample_offsets.append(n_samples)
+        n_samples += header.dims[1]
+
+    # Write to a temporary file so that an interrupted concatenation never
+    # leaves a truncated output behind.
+    tmp_output_file = output_file + '.tmp'
+    with open(tmp_output_file, 'wb') as f_out:
+        write_header(f_out, headers[0].dtype, [n_channels, n_samples])
+        for input_file, header in zip(input_files, headers):
+            print(MODULE_IDENTIFIER + 'Appending %s (%d samples)'%(input_file, header.dims[1]))
+            bytes_left = header.data_bytes()
+            with open(input_file, 'rb') as f_in:
+                f_in.seek(header.header_size)
+                while bytes_left > 0:
+                    n_read = f_in.readinto(copy_buffer[:min(chunk_bytes, bytes_left)])
+                    if not n_read:
+                        raise IOError(MODULE_IDENTIFIER + '%s is shorter than its header says.'%input_file)
+                    f_out.write(copy_buffer[:n_read])
+                    bytes_left -= n_read
+    os.replace(tmp_output_file, output_file)
+    return sample_offsets
+
+def write_virtual_concat(input_files, manifest_file):
+    """
+    Describe the concatenation of (channels x samples) MDA timeseries without
+    copying any data. The manifest lists the (file, byte offset, length) of
+    each input and can be read with VirtualConcatMda.
+
+    :input_files: Timeseries to be concatenated, in order
+    :manifest_file: Output manifest (JSON)
+    :returns: Sample offsets of the individual inputs in the concatenation.
+    """
+    headers = _read_timeseries_headers(input_files)
+    segments = list()
+    n_samples = 0
+    for input_file, header in zip(input_files, headers):
+        segments.append({
+            'path': os.path.abspath(input_file),
+            'offset': header.header_size,
+            'length': header.dims[1],
+            'sample_offset': n_samples
+            })
+        n_samples += header.dims[1]
+
+    manifest = {
+            'dtype': headers[0].dtype,
+            'n_channels': headers[0].dims[0],
+            'n_samples': n_samples,
+            'segments': segments
+            }
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=4, separators=(',', ': '))
+    return [segment['sample_offset'] for segment in segments]
+
+class VirtualConcatMda(object):
+
+    """
+    Reader for a virtual concatenation manifest. Behaves like a single
+    (channels x samples) timeseries, with an interface similar to
+    mountainlab_pytools.mdaio.DiskReadMda.
+    """
+
+    def __init__(self, manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        self.dtype = manifest['dtype']
+        self.n_channels = manifest['n_channels']
+        self.n_samples = manifest['n_samples']
+        self.segments = manifest['segments']
+        self._segment_starts = np.array([segment['sample_offset'] for segment in self.segments])
+        self._segment_data = [None] * len(self.segments)
+
+    def dims(self):
+        return [self.n_channels, self.n_samples]
+
+    def N1(self):
+        return self.n_channels
+
+    def N2(self):
+        return self.n_samples
+
+    def dt(self):
+        return self.dtype
+
+    def epoch_offsets(self):
+        """
+        Sample offsets at which each of the concatenated inputs starts.
+        """
+        return list(self._segment_starts)
+
+    def _segment(self, seg_idx):
+        if self._segment_data[seg_idx] is None:
+            segment = self.segments[seg_idx]
+            self._segment_data[seg_idx] = np.memmap(segment['path'], dtype=self.dtype, mode='r', \
+                    offset=segment['offset'], shape=(self.n_channels, segment['length']), order='F')
+        return self._segment_data[seg_idx]
+
+    def read_samples(self, t1, t2):
+        """
+        Read samples [t1, t2) on all channels.
+        """
+        t1 = max(0, t1)
+        t2 = min(self.n_samples, t2)
+        samples = np.empty((self.n_channels, max(0, t2 - t1)), dtype=self.dtype)
+        if t2 <= t1:
+            return samples
+
+        first_segment = np.searchsorted(self._segment_starts, t1, side='right') - 1
+        for seg_idx in range(first_segment, len(self.segments)):
+            seg_start = self.segments[seg_idx]['sample_offset']
+            if seg_start >= t2:
+                break
+            seg_end = seg_start + self.segments[seg_idx]['length']
+            copy_start = max(t1, seg_start)
+            copy_end = min(t2, seg_end)
+            if copy_end > copy_start:
+                samples[:, copy_start-t1:copy_end-t1] = \
+                        self._segment(seg_idx)[:, copy_start-seg_start:copy_end-seg_start]
+        return samples
+
+    def readChunk(self, i1=0, i2=0, i3=-1, N1=None, N2=1, N3=1):
+        if N1 is None:
+            N1 = self.n_channels
+        return self.read_samples(i2, i2+N2)[i1:i1+N1, :]
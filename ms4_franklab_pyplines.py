@@ -4,7 +4,9 @@ import os
 import json
 import subprocess
 import ms4_franklab_proc2py as p2p
+import mda_stream
 import math
+from concurrent.futures import ThreadPoolExecutor
 
 # This script calls the helper functions defined in p2p that in turn, call MS processors
 # This should be a collection of common processing steps that are standard across the lab, altho params can be changed flexibly
@@ -25,27 +27,43 @@ FEATURES_FILE = '/features.out'
 CLIPS_FILE = '/marks.mda'
 FIRINGS_FILENAME = '/firings_raw.mda'
 PRE_FILENAME = '/pre.mda.prv'
+MAX_SEGMENT_WORKERS = 4
+CONCAT_MODE_STREAM = 'stream'
+CONCAT_MODE_VIRTUAL = 'virtual'
+CONCAT_MODE_PROCESSOR = 'processor'
 
 #before anything else, must concat all eps together becuase ms4 no longer handles the prv list of mdas
-def concat_eps(*,dataset_dir, output_dir, prv_list, opts={}):
-    strstart = []
+# mode selects how the epochs are put together:
+#   stream: copy the epochs into raw.mda in large chunks (mda_stream.concat_timeseries)
+#   virtual: only write a manifest (raw.mda.concat.json) describing the concatenation,
+#       which can be read as a single timeseries with mda_stream.VirtualConcatMda.
+#       MountainSort processors can not read this, so it is meant for python-side readers.
+#   processor: run ms3.concat_timeseries through mountainlab
+def concat_eps(*,dataset_dir, output_dir, prv_list, mode=CONCAT_MODE_STREAM, opts={}):
+    epoch_files = []
     for prv_file in prv_list:
         try:
             with open(dataset_dir + '/' + prv_file) as f:
                 prv_entry = json.load(f)
-            strstart.append('timeseries_list:' + prv_entry['original_path'])
+            epoch_files.append(prv_entry['original_path'])
         except (FileNotFoundError, IOError) as err:
             print("Unable to read %s for concatenation." % prv_file)
             raise err
-    joined = ' '.join(strstart)
-    print(joined)
+    print(' '.join(epoch_files))
     
     concatenated_mda_filename = output_dir+CONCATENATED_EPOCHS_FILE
-    outpath = 'timeseries_out:' + concatenated_mda_filename
-
-    subprocess.call(['ml-run-process','ms3.concat_timeseries','--inputs', joined,'--outputs',outpath])
-    print('Epochs concatenated into RAW MDA!')
-    subprocess.call(['ml-prv-create', concatenated_mda_filename, concatenated_mda_filename + '.prv'])                    
+    if mode == CONCAT_MODE_VIRTUAL:
+        mda_stream.write_virtual_concat(epoch_files, concatenated_mda_filename + mda_stream.VIRTUAL_CONCAT_EXTENSION)
+        print('Epochs described in virtual RAW MDA!')
+    else:
+        if mode == CONCAT_MODE_PROCESSOR:
+            joined = ' '.join(['timeseries_list:' + epoch_file for epoch_file in epoch_files])
+            outpath = 'timeseries_out:' + concatenated_mda_filename
+            subprocess.call(['ml-run-process','ms3.concat_timeseries','--inputs', joined,'--outputs',outpath])
+        else:
+            mda_stream.concat_timeseries(epoch_files, concatenated_mda_filename)
+        print('Epochs concatenated into RAW MDA!')
+        subprocess.call(['ml-prv-create', concatenated_mda_filename, concatenated_mda_filename + '.prv'])                    
     # Parameters for reading the concatenated epochs
     params = {}
     params['samplerate'] = 30000
@@ -123,9 +141,45 @@ def ms4_sort_full(*,dataset_dir, output_dir, geom=[], adjacency_radius=-1,detect
     )
     
 
+def _sort_segment(*, segind, t1, t2, output_dir, geom, adjacency_radius, detect_threshold, detect_sign, samplerate, opts):
+    """
+    Extract a single segment from the preprocessed data, sort it and compute
+    cluster metrics for it. Returns the segment's timeseries and firings files.
+    """
+    print('Segment '+str(segind+1)+': t1='+str(t1)+', t2='+str(t2)+', t1_min='+str(t1/samplerate/60)+', t2_min='+str(t2/samplerate/60));
+
+    pre_outpath= output_dir+'/pre-'+str(segind+1)+'.mda'
+    p2p.pyms_extract_segment(
+        timeseries=output_dir+'/pre.mda.prv', 
+        timeseries_out=pre_outpath, 
+        t1=t1, 
+        t2=t2,
+        opts=opts)
+
+    firings_outpath=output_dir+'/firings-'+str(segind+1)+'.mda'
+    p2p.ms4alg(
+        timeseries=pre_outpath,
+        firings_out=firings_outpath,
+        geom=geom,
+        detect_sign=detect_sign,
+        adjacency_radius=adjacency_radius,
+        detect_threshold=detect_threshold,
+        opts=opts)
+
+    # Compute cluster metrics
+    p2p.compute_cluster_metrics(
+        timeseries=pre_outpath,
+        firings=firings_outpath,
+        metrics_out=output_dir+'/metrics_raw_'+str(segind+1)+'.json',
+        samplerate=samplerate,
+        opts=opts
+    )
+    return pre_outpath, firings_outpath
+
 # segs = sort by timesegments, then join any matching  clusters
 # Caitlin added dirnames as input to ms4_sort_on_segs and p2p.get_epoch_offsets to ensure that epochs are concatenated in the correct order
-def ms4_sort_on_segs(*,dirnames, dataset_dir, output_dir, geom=[], adjacency_radius=-1,detect_threshold=3,detect_sign=0,rm_segment_intermediates=True, opts={}):
+# Segments are independent until they are annealed, so up to n_workers of them are sorted at the same time.
+def ms4_sort_on_segs(*,dirnames, dataset_dir, output_dir, geom=[], adjacency_radius=-1,detect_threshold=3,detect_sign=0,rm_segment_intermediates=True, n_workers=MAX_SEGMENT_WORKERS, opts={}):
 
     # Fetch dataset parameters
     ds_params=p2p.read_dataset_params(dataset_dir)
@@ -135,47 +189,27 @@ def ms4_sort_on_segs(*,dirnames, dataset_dir, output_dir, geom=[], adjacency_rad
     sample_offsets, total_samples = p2p.get_epoch_offsets(dirnames=dirnames,dataset_dir=dataset_dir)
 
     #break up preprocesed data into segments and sort each 
-    firings_list=[]
-    timeseries_list=[]
-    for segind in range(len(sample_offsets)):
-        t1=math.floor(sample_offsets[segind]) 
-        if segind==len(sample_offsets)-1:
-            t2=total_samples-1
-        else:
-            t2=math.floor(sample_offsets[segind+1])-1 
-
-        segment_duration = t2-t1
-        print('Segment '+str(segind+1)+': t1='+str(t1)+', t2='+str(t2)+', t1_min='+str(t1/ds_params['samplerate']/60)+', t2_min='+str(t2/ds_params['samplerate']/60));
-
-        pre_outpath= output_dir+'/pre-'+str(segind+1)+'.mda'
-        p2p.pyms_extract_segment(
-            timeseries=output_dir+'/pre.mda.prv', 
-            timeseries_out=pre_outpath, 
-            t1=t1, 
-            t2=t2,
-            opts=opts)
-
-        firings_outpath=output_dir+'/firings-'+str(segind+1)+'.mda'
-        p2p.ms4alg(
-            timeseries=pre_outpath,
-            firings_out=firings_outpath,
-            geom=geom,
-            detect_sign=detect_sign,
-            adjacency_radius=adjacency_radius,
-            detect_threshold=detect_threshold,
-            opts=opts)
-
-        # Compute cluster metrics
-        p2p.compute_cluster_metrics(
-            timeseries=output_dir+'/pre-'+str(segind+1)+'.mda',
-            firings=output_dir+'/firings-'+str(segind+1)+'.mda',
-            metrics_out=output_dir+'/metrics_raw_'+str(segind+1)+'.json',
-            samplerate=ds_params['samplerate'],
-            opts=opts
-        )
-
-        firings_list.append(firings_outpath)
-        timeseries_list.append(pre_outpath)
+    segment_jobs=[]
+    with ThreadPoolExecutor(max_workers=max(1, min(n_workers, len(sample_offsets)))) as executor:
+        for segind in range(len(sample_offsets)):
+            t1=math.floor(sample_offsets[segind]) 
+            if segind==len(sample_offsets)-1:
+                t2=total_samples-1
+            else:
+                t2=math.floor(sample_offsets[segind+1])-1 
+
+            segment_jobs.append(executor.submit(_sort_segment, segind=segind, t1=t1, t2=t2,
+                output_dir=output_dir, geom=geom, adjacency_radius=adjacency_radius,
+                detect_threshold=detect_threshold, detect_sign=detect_sign,
+                samplerate=ds_params['samplerate'], opts=opts))
+
+        # Wait for all the segments before annealing. Any failure is raised here.
+        firings_list=[]
+        timeseries_list=[]
+        for job in segment_jobs:
+            pre_outpath, firings_outpath = job.result()
+            firings_list.append(firings_outpath)
+            timeseries_list.append(pre_outpath)
 
     firings_out_final=output_dir+'/firings_raw.mda'
     # sample_offsets have to be converted into a string to be properly passed into the processor
@@ -0,0 +1,254 @@
+"""
+Dependency-graph executor for the sorting pipeline.
+
+Each stage (a pypline from ms4_franklab_pyplines, for example) declares the
+files it reads, the files it writes, the stages it depends on, and the
+processor name and parameters it runs with. These are hashed into a key for
+the stage. Keys of finished stages are recorded in a stamp file next to the
+outputs, and a stage is only rerun when its key no longer matches the recorded
+one (a parameter, an input file or an upstream stage changed) or when its
+outputs have gone missing. Stages that do not depend on each other are run
+concurrently.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+MODULE_IDENTIFIER = '[PipelineGraph] '
+STAGE_STAMP_FILENAME = '/pipeline_stages.json'
+
+# Input files smaller than this are hashed by content. Larger files (raw MDAs)
+# are identified by their size and modification time instead.
+CONTENT_HASH_SIZE_LIMIT = 16 * 1024 * 1024
+
+# Stage status values reported by PipelineGraph.run()
+STAGE_SKIPPED = 'skipped'
+STAGE_DONE = 'done'
+STAGE_FAILED = 'failed'
+STAGE_BLOCKED = 'blocked'
+
+def file_signature(path):
+    """
+    Get a signature for an input file that changes whenever its contents do.
+
+    PRV files are pointers to data files and already contain a checksum of the
+    data, which is used directly. Small files are hashed by content.
+    """
+    if not os.path.exists(path):
+        return 'missing'
+
+    if path.endswith('.prv'):
+        try:
+            with open(path, 'r') as f:
+                prv_data = json.load(f)
+            if 'original_checksum' in prv_data:
+                return 'prv:%s:%s'%(prv_data['original_checksum'], prv_data.get('original_size'))
+        except (ValueError, IOError):
+            pass
+
+    file_stat = os.stat(path)
+    if file_stat.st_size > CONTENT_HASH_SIZE_LIMIT:
+        return 'stat:%d:%d'%(file_stat.st_size, file_stat.st_mtime_ns)
+
+    content_hash = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            content_hash.update(block)
+    return 'sha1:' + content_hash.hexdigest()
+
+class PipelineStage(object):
+
+    """
+    A single step of the pipeline.
+    """
+
+    def __init__(self, name, processor, function, outputs, inputs=(), depends_on=(), \
+            params=None, intermediate=False):
+        """
+        :name: Unique name of the stage in the graph
+        :processor: Name of the pypline/processor run by this stage
+        :function: Callable (without arguments) that runs the stage
+        :outputs: Files written by the stage
+        :inputs: Files read by the stage that are not produced by other stages
+        :depends_on: Names of the stages whose outputs are read by this stage
+        :params: Parameters that affect the outputs of this stage
+        :intermediate: If set, missing outputs are only regenerated when a
+            stage that depends on them has to be rerun.
+        """
+        self.name = name
+        self.processor = processor
+        self.function = function
+        self.outputs = list(outputs)
+        self.inputs = list(inputs)
+        self.depends_on = list(depends_on)
+        self.params = dict() if params is None else dict(params)
+        self.intermediate = intermediate
+        self.key = None
+
+    def outputs_exist(self):
+        for output_file in self.outputs:
+            if not os.path.exists(output_file):
+                return False
+        return True
+
+class PipelineGraph(object):
+
+    """
+    Collection of pipeline stages, run in dependency order.
+    """
+
+    def __init__(self, output_dir, n_workers=2):
+        """
+        :output_dir: Directory in which the stamp file is kept
+        :n_workers: Maximum number of stages run simultaneously
+        """
+        self.stages = dict()
+        self.stage_order = list()
+        self.n_workers = max(1, n_workers)
+        self.stamp_file = output_dir + STAGE_STAMP_FILENAME
+        self._stamps = self._read_stamps()
+        self._stamp_lock = threading.Lock()
+
+    def add_stage(self, *args, **kwargs):
+        stage = PipelineStage(*args, **kwargs)
+        if stage.name in self.stages:
+            raise ValueError(MODULE_IDENTIFIER + 'Stage %s added twice.'%stage.name)
+        for dependency in stage.depends_on:
+            if dependency not in self.stages:
+                raise ValueError(MODULE_IDENTIFIER + 'Stage %s depends on unknown stage %s.'%(stage.name, dependency))
+        self.stages[stage.name] = stage
+        self.stage_order.append(stage.name)
+        return stage
+
+    def _read_stamps(self):
+        try:
+            with open(self.stamp_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, IOError, ValueError):
+            return dict()
+
+    def _write_stamps(self):
+        # Write to a temporary file first so that an interrupted write never
+        # leaves a partial stamp file behind.
+        tmp_stamp_file = self.stamp_file + '.tmp'
+        with open(tmp_stamp_file, 'w') as f:
+            json.dump(self._stamps, f, indent=4, separators=(',', ': '))
+        os.replace(tmp_stamp_file, self.stamp_file)
+
+    def _set_stamp(self, stage_name, key):
+        with self._stamp_lock:
+            if key is None:
+                self._stamps.pop(stage_name, None)
+            else:
+                self._stamps[stage_name] = key
+            self._write_stamps()
+
+    def _compute_keys(self):
+        # Stages are added after their dependencies, so keys can be computed in
+        # the order of addition.
+        for stage_name in self.stage_order:
+            stage = self.stages[stage_name]
+            key_description = {
+                    'processor': stage.processor,
+                    'params': stage.params,
+                    'inputs': [(input_file, file_signature(input_file)) for input_file in stage.inputs],
+                    'depends_on': [self.stages[dep].key for dep in stage.depends_on],
+                    'outputs': stage.outputs
+                    }
+            stage.key = hashlib.sha1(json.dumps(key_description, sort_keys=True, \
+                    default=str).encode('utf-8')).hexdigest()
+
+    def _plan(self, adopt_existing):
+        """
+        Work out the set of stages that need to be run.
+        """
+        dependents = dict([(stage_name, list()) for stage_name in self.stage_order])
+        for stage_name in self.stage_order:
+            for dependency in self.stages[stage_name].depends_on:
+                dependents[dependency].append(stage_name)
+
+        stages_to_run = set()
+        for stage_name in reversed(self.stage_order):
+            stage = self.stages[stage_name]
+            recorded = (self._stamps.get(stage_name) == stage.key)
+            if (not recorded) and adopt_existing and (stage_name not in self._stamps):
+                # Missing intermediate outputs (removed by clear_files, for
+                # example) are not needed as long as every stage that reads
+                # them is up to date. Dependents are planned first.
+                outputs_needed = (not stage.intermediate) or (not dependents[stage_name]) or \
+                        any([dep in stages_to_run for dep in dependents[stage_name]])
+                if stage.outputs_exist() or (not outputs_needed):
+                    print(MODULE_IDENTIFIER + 'Adopting existing outputs for stage %s.'%stage_name)
+                    self._set_stamp(stage_name, stage.key)
+                    recorded = True
+
+            if not recorded:
+                stages_to_run.add(stage_name)
+            elif not stage.outputs_exist():
+                if (not stage.intermediate) or \
+                        any([dep in stages_to_run for dep in dependents[stage_name]]):
+                    stages_to_run.add(stage_name)
+        return stages_to_run
+
+    def _run_stage(self, stage):
+        print(MODULE_IDENTIFIER + 'Running stage %s (%s).'%(stage.name, stage.processor))
+        # Forget the previous result before starting, so that an interrupted
+        # stage is never mistaken for a finished one.
+        self._set_stamp(stage.name, None)
+        stage.function()
+        if not stage.outputs_exist():
+            raise IOError(MODULE_IDENTIFIER + 'Stage %s did not produce its outputs.'%stage.name)
+        self._set_stamp(stage.name, stage.key)
+
+    def run(self, adopt_existing=False):
+        """
+        Run all the stages that are out of date.
+
+        :adopt_existing: Record outputs found on disk for stages that have never
+            been run through the graph as current (used when switching an
+            already sorted dataset over to the graph executor). Intermediate
+            outputs that have been cleared are adopted too, as long as the
+            stages that read them are.
+        :returns: Dictionary with the status of each stage.
+        """
+        self._compute_keys()
+        stages_to_run = self._plan(adopt_existing)
+
+        stage_status = dict()
+        for stage_name in self.stage_order:
+            if stage_name not in stages_to_run:
+                print(MODULE_IDENTIFIER + 'Stage %s is up to date.'%stage_name)
+                stage_status[stage_name] = STAGE_SKIPPED
+
+        running = dict()
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            while True:
+                # Stages are listed after their dependencies, so a single pass
+                # propagates failures all the way down the graph.
+                for stage_name in self.stage_order:
+                    if (stage_name in stage_status) or (stage_name in running.values()):
+                        continue
+                    dependency_status = [stage_status.get(dep) for dep in self.stages[stage_name].depends_on]
+                    if any([status in (STAGE_FAILED, STAGE_BLOCKED) for status in dependency_status]):
+                        print(MODULE_IDENTIFIER + 'Stage %s blocked by a failed dependency.'%stage_name)
+                        stage_status[stage_name] = STAGE_BLOCKED
+                    elif all([status is not None for status in dependency_status]):
+                        running[executor.submit(self._run_stage, self.stages[stage_name])] = stage_name
+
+                if not running:
+                    break
+
+                finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for job in finished:
+                    stage_name = running.pop(job)
+                    try:
+                        job.result()
+                        stage_status[stage_name] = STAGE_DONE
+                    except Exception as err:
+                        print(MODULE_IDENTIFIER + 'ERROR: Stage %s failed.'%stage_name)
+                        print(err)
+                        stage_status[stage_name] = STAGE_FAILED
+        return stage_status
@@ -1,94 +1,56 @@
 #!/usr/bin/python
 #Requires numpy to be installed. re and sys are defaults for python
-#assumes python 2.7
+import os
+import sys
 import numpy as np
-import re
 from sys import argv
-# Main function
-def readTrodesExtractedDataFile(filename):
-
-    with open(filename, 'rb') as f:
-        # Check if first line is start of settings block
-        if f.readline().decode('ascii').strip() != '<Start settings>':
-            raise Exception("Settings format not supported")
-        buff = ''
-        c = 0.0
-        fields = True
-        fieldsText = {}
-        for line in f:
-            # Read through block of settings
-            if(fields):
-                line = line.decode('ascii').strip()
-
-                # filling in fields dict
-                if line != '<End settings>':
-                    vals = line.split(': ')
-                    fieldsText.update({vals[0].lower(): vals[1]})
-
-                # End of settings block, signal end of fields
-                else:
-                    fields = False
-                    dt = parseFields(fieldsText['fields'])
-                    fieldsText['data'] = np.zeros([1], dtype = dt)
-
-            else:
-                # Holds the data in next line
-                dat = line
-                buff += dat
-                c += float(len(dat)) / float(dt.itemsize)
-                # data = np.frombuffer(buffer=dat, dtype=dt, count=c)
-                # merged = np.concatenate([fieldsText['data'], data])
-                # fieldsText.update({'data': merged})
 
-        # Reads rest of file at once, using dtype format generated by parseFields()
-        # dt = parseFields(fieldsText['fields'])
-        data = np.frombuffer(buffer=buff, dtype=dt, count=int(round(c)))
-        fieldsText.update({'data': data})
-        # fieldsText.update({'data': np.delete(fieldsText['data'], 0, axis = 0)})
-        return fieldsText
+# The settings block and the field string are parsed the same way as in version 3
+from readTrodesExtractedDataFile3 import readTrodesExtractedDataHeader, parseFields
 
+# Number of records read at a time
+DEFAULT_RECORDS_PER_BLOCK = 65536
 
-# Parses last fields parameter (<time uint32><...>) as a single string
-# Assumes it is formatted as <name number * type> or <name type>
-# Returns: np.dtype
-def parseFields(fieldstr):
-    # Returns np.dtype from field string
-    sep = re.split('\s', re.sub(r"\>\<|\>|\<", ' ', fieldstr).strip())
-    # print(sep)
-    typearr = []
-    # Every two elmts is fieldname followed by datatype
-    for i in range(0,sep.__len__(), 2):
-        fieldname = sep[i]
-        repeats = 1
-        ftype = 'uint32'
-
-        # Finds if a <num>* is included in datatype
-        if sep[i+1].__contains__('*'):
-            temptypes = re.split('\*', sep[i+1])
-
-            # Results in the correct assignment, whether str is num*dtype or dtype*num
-            ftype = temptypes[temptypes[0].isdigit()]
-            repeats = int(temptypes[temptypes[1].isdigit()])
-        else:
-            ftype = sep[i+1]
+# Generator over the records in the file, in blocks of (at most)
+# records_per_block records. Each block is a read-only numpy structured array
+# (dtype generated by parseFields()) backed by its own buffer, so files of any
+# size can be processed in constant memory.
+def iterTrodesExtractedDataFile(filename, records_per_block=DEFAULT_RECORDS_PER_BLOCK):
+    with open(filename, 'rb') as f:
+        fieldsText, dt = readTrodesExtractedDataHeader(f)
+        block_bytes = records_per_block * dt.itemsize
+        while True:
+            buff = f.read(block_bytes)
+            # A trailing partial record is dropped, as np.fromfile would do
+            n_records = len(buff) // dt.itemsize
+            if n_records == 0:
+                break
+            yield np.frombuffer(buff, dtype=dt, count=n_records)
 
-        try:
-            fieldtype = getattr(np, ftype)
-        except AttributeError:
-            print(ftype + " is not a valid field type.\n")
-            exit(1)
-        else:
-            typearr.append((str(fieldname), fieldtype, repeats))
-    return np.dtype(typearr)
+# Main function
+# Returns the same dictionary as readTrodesExtractedDataFile3: the settings
+# (lower case keys), the byte offset of the data, and the records in 'data'
+def readTrodesExtractedDataFile(filename, records_per_block=DEFAULT_RECORDS_PER_BLOCK):
+    with open(filename, 'rb') as f:
+        fieldsText, dt = readTrodesExtractedDataHeader(f)
+    n_records = (os.path.getsize(filename) - fieldsText['data_offset']) // dt.itemsize
 
+    # Fill a preallocated array block by block instead of growing a buffer
+    data = np.empty(n_records, dtype=dt)
+    n_filled = 0
+    for block in iterTrodesExtractedDataFile(filename, records_per_block):
+        data[n_filled:n_filled+len(block)] = block
+        n_filled += len(block)
+    fieldsText.update({'data': data[:n_filled]})
+    return fieldsText
 
 
 # Testing function here---------------------
 # fields = readTrodesExtractedDataFile('16ChannelRec.spikes_nt10.dat')
 # print(fields['data'])
 
-if argv.__len__() > 1:
-    np.set_printoptions(threshold='nan')
-    fields = readTrodesExtractedDataFile(argv[1])
-    print(fields['data'])
-
+if __name__ == "__main__":
+    if argv.__len__() > 1:
+        np.set_printoptions(threshold=sys.maxsize)
+        fields = readTrodesExtractedDataFile(argv[1])
+        print(fields['data'])
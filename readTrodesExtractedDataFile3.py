@@ -1,37 +1,57 @@
 #!/usr/bin/python
 #Requires numpy to be installed. re and sys are defaults for python
 #assumes python 2.7
+import os
 import numpy as np
 import re
 from sys import argv
+
+# Reads the settings block at the start of the file. The file is left
+# positioned at the first data record.
+# Returns: dict of settings (with the byte offset of the data in 'data_offset'), np.dtype of the records
+def readTrodesExtractedDataHeader(f):
+    # Check if first line is start of settings block
+    if f.readline().decode('ascii').strip() != '<Start settings>':
+        raise Exception("Settings format not supported")
+    fieldsText = {}
+    while True:
+        line = f.readline()
+        if not line:
+            raise Exception("Settings block not terminated")
+        # Read through block of settings
+        line = line.decode('ascii').strip()
+        # End of settings block, signal end of fields
+        if line == '<End settings>':
+            break
+        # filling in fields dict
+        vals = line.split(': ')
+        fieldsText.update({vals[0].lower(): vals[1]})
+    fieldsText['data_offset'] = f.tell()
+    dt = parseFields(fieldsText['fields'])
+    return fieldsText, dt
+
 # Main function
-def readTrodesExtractedDataFile(filename):
+# With use_mmap, the data is returned as a read-only np.memmap instead of being
+# read into memory. Slicing it (by sample range or record index) only reads
+# the parts of the file that are accessed.
+def readTrodesExtractedDataFile(filename, use_mmap=False):
     with open(filename, 'rb') as f:
-        # Check if first line is start of settings block
-        if f.readline().decode('ascii').strip() != '<Start settings>':
-            raise Exception("Settings format not supported")
-        fields = True
-        fieldsText = {}
-        for line in f:
-            # Read through block of settings
-            if(fields):
-                line = line.decode('ascii').strip()
-                # filling in fields dict
-                if line != '<End settings>':
-                    vals = line.split(': ')
-                    fieldsText.update({vals[0].lower(): vals[1]})
-                # End of settings block, signal end of fields
-                else:
-                    fields = False
-                    dt = parseFields(fieldsText['fields'])
-                    fieldsText['data'] = np.zeros([1], dtype = dt)
-                    break
-        # Reads rest of file at once, using dtype format generated by parseFields()
-        dt = parseFields(fieldsText['fields'])
-        data = np.fromfile(f, dt)
+        fieldsText, dt = readTrodesExtractedDataHeader(f)
+        if use_mmap:
+            n_records = (os.fstat(f.fileno()).st_size - fieldsText['data_offset']) // dt.itemsize
+            data = np.memmap(filename, dtype=dt, mode='r', offset=fieldsText['data_offset'], shape=(n_records,))
+        else:
+            # Reads rest of file at once, using dtype format generated by parseFields()
+            data = np.fromfile(f, dt)
         fieldsText.update({'data': data})
         return fieldsText
 
+# Reads records [start, stop) into memory without loading the rest of the file
+def readTrodesExtractedDataRecords(filename, start=0, stop=None):
+    fieldsText = readTrodesExtractedDataFile(filename, use_mmap=True)
+    fieldsText.update({'data': np.array(fieldsText['data'][start:stop])})
+    return fieldsText
+
 
 # Parses last fields parameter (<time uint32><...>) as a single string
 # Assumes it is formatted as <name number * type> or <name type>
@@ -0,0 +1,181 @@
+"""
+Split curated firings from MountainSort (sorted on all the epochs of a day
+merged together) into individual epochs, replacing sample numbers with Trodes
+timestamps. Runs without any GUI, so it can be used on headless compute nodes:
+
+    python3 separateCuratedSpikes.py --data-dir <sorted-data> --timestamp-dir <extracted-mda> --n-workers 8
+"""
+
+import os
+import re
+import sys
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from mountainlab_pytools import mdaio
+
+# Local imports
+import commandline
+import mda_stream
+
+MODULE_IDENTIFIER = "[SeparateCuratedSpikes] "
+TIMESTAMP_FILE_EXTENSION = '.timestamps.mda'
+DEFAULT_FIRINGS_FILE = 'firings.curated.mda'
+N_SEPARATION_WORKERS = 8
+
+def _naturalSortKey(path):
+    # Compare digit runs as numbers so that epoch 10 comes after epoch 9.
+    return [int(token) if token.isdigit() else token for token in re.split(r'(\d+)', path)]
+
+def findTimestampFiles(timestamp_dir):
+    """
+    Find all the spike timestamp files (*.timestamps.mda) under a directory.
+    Trodes names epochs (and the directories exportmda creates for them) in
+    recording order, so a natural sort of the paths gives the epoch order.
+
+    :timestamp_dir: Directory searched (recursively) for timestamp files
+    :returns: Timestamp files, in epoch order.
+    """
+    timestamp_files = list()
+    for dir_path, _, file_names in os.walk(timestamp_dir):
+        for file_name in file_names:
+            if file_name.endswith(TIMESTAMP_FILE_EXTENSION):
+                timestamp_files.append(os.path.join(dir_path, file_name))
+    return sorted(timestamp_files, key=_naturalSortKey)
+
+def _readMergedFirings(data_dir, tt_dir, firings_file):
+    try:
+        if firings_file not in os.listdir(data_dir+'/'+tt_dir):
+            print(MODULE_IDENTIFIER + 'Merged firings %s not  found for tetrode %s!'%(firings_file, tt_dir))
+            return
+        firings_file_location = '/'.join([data_dir, tt_dir, firings_file])
+        merged_firings = mdaio.readmda(firings_file_location)
+        print(MODULE_IDENTIFIER + 'Read merged firings file for tetrode %s!'%tt_dir)
+        return merged_firings
+    except (FileNotFoundError, IOError) as err:
+        print(MODULE_IDENTIFIER + 'Unable to read merged firings file for tetrode %s!'%tt_dir)
+        print(err)
+
+def getEpochOffsets(timestamp_files):
+    """
+    Get the sample offset at which each epoch starts in the merged recording,
+    using only the headers of the (ordered) timestamp files.
+
+    :returns: Cumulative sample offsets, with an additional entry for the end
+        of the last epoch.
+    """
+    epoch_lengths = [mda_stream.read_header(ts_file).dims[0] for ts_file in timestamp_files]
+    return np.concatenate(([0], np.cumsum(epoch_lengths))).astype('int64')
+
+def splitFiringsInEpochs(merged_firings, epoch_offsets):
+    """
+    Split merged firings (sorted by sample number) into epochs.
+
+    :epoch_offsets: Epoch offsets from getEpochOffsets
+    :returns: Firings for each epoch, with sample numbers relative to the start
+        of the epoch (None for epochs without spikes).
+    """
+    epoch_bounds = np.searchsorted(merged_firings[1], epoch_offsets, side='left')
+    epoch_firings = list()
+    for ep_idx in range(len(epoch_offsets)-1):
+        first_spike, last_spike = epoch_bounds[ep_idx], epoch_bounds[ep_idx+1]
+        if last_spike <= first_spike:
+            epoch_firings.append(None)
+            continue
+        epoch_spikes = np.array(merged_firings[:, first_spike:last_spike])
+        epoch_spikes[1] -= float(epoch_offsets[ep_idx])
+        epoch_firings.append(epoch_spikes)
+    return epoch_firings
+
+def separateSpikesInEpochs(data_dir, timestamp_files, firings_file=DEFAULT_FIRINGS_FILE, \
+        write_separated_spikes=True, n_workers=N_SEPARATION_WORKERS):
+    """
+    Takes curated spikes from MountainSort and combines this information with spike timestamps to create separate curated spikes for each epoch
+
+    :data_dir: Directory containing the sorted data for each tetrode
+    :timestamp_files: Spike timestamps file list, in epoch order
+    :firings_file: Curated firings file
+    :write_separated_spikes: If the separated spikes should be written back to the data directory.
+    :n_workers: Number of files read/written simultaneously
+    :returns: List of spikes for each epoch
+    """
+
+    # It is important here for the timestamp files to be in the same order as
+    # the curated firings as that is the only way for us to tell that the
+    # firings are being split up correctly.
+    print(MODULE_IDENTIFIER + 'Looking at spike timestamps in order')
+    print(timestamp_files)
+    epoch_offsets = getEpochOffsets(timestamp_files)
+    for ep_idx in range(len(timestamp_files)):
+        print(MODULE_IDENTIFIER + 'Epoch ' + str(ep_idx) + ': ' + str(epoch_offsets[ep_idx+1] - \
+                epoch_offsets[ep_idx]) + ' samples.')
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        tetrode_list = [tt_dir for tt_dir in sorted(os.listdir(data_dir)) \
+                if os.path.isdir(os.path.join(data_dir, tt_dir))]
+        merged_curated_firings = list(executor.map(lambda tt_dir: _readMergedFirings(data_dir, tt_dir, \
+                firings_file), tetrode_list))
+        separated_tetrodes = [tt_dir for tt_dir, tt_firings in zip(tetrode_list, merged_curated_firings) \
+                if tt_firings is not None]
+
+        # First splice up curated spikes into indiviual epochs
+        curated_firings = [splitFiringsInEpochs(tt_firings, epoch_offsets) for tt_firings in \
+                merged_curated_firings if tt_firings is not None]
+
+        print(MODULE_IDENTIFIER + 'Spikes separated in epochs. Substituting timestamps!')
+        # For each epoch replace the sample numbers with the corresponding
+        # timestamps. Timestamp files are memory-mapped, so only the pages
+        # that hold timestamps for spikes are read.
+        for ep_idx, ts_file in enumerate(timestamp_files):
+            epoch_timestamps = mda_stream.memmap_mda(ts_file).reshape(-1, order='F')
+            for tt_idx, tt_curated_firings in enumerate(curated_firings):
+                if tt_curated_firings[ep_idx] is None:
+                    continue
+                tt_curated_firings[ep_idx][1] = epoch_timestamps[np.array(tt_curated_firings[ep_idx][1], dtype=int)]
+            del epoch_timestamps
+
+        if write_separated_spikes:
+            write_jobs = dict()
+            for tt_idx, tet in enumerate(separated_tetrodes):
+                for ep_idx in range(len(timestamp_files)):
+                    if curated_firings[tt_idx][ep_idx] is not None:
+                        ep_firings_file_name = data_dir + '/' + tet + '/firings-' + \
+                                str(ep_idx+1) + '.curated.mda'
+                        write_jobs[executor.submit(mdaio.writemda64, curated_firings[tt_idx][ep_idx], \
+                                ep_firings_file_name)] = ep_firings_file_name
+
+            for job in as_completed(write_jobs):
+                try:
+                    job.result()
+                except OSError as exception:
+                    print(MODULE_IDENTIFIER + 'Unable to write timestamped firings %s!'%write_jobs[job])
+                    print(exception)
+
+    return curated_firings
+
+if __name__ == "__main__":
+    commandline_args = commandline.parse_commandline_arguments()
+    if not commandline_args.data_dir:
+        print(MODULE_IDENTIFIER + 'ERROR: Sorted data directory (--data-dir) is required.')
+        sys.exit(1)
+
+    if commandline_args.timestamp_files:
+        timestamp_files = commandline_args.timestamp_files
+    elif commandline_args.timestamp_dir:
+        timestamp_files = findTimestampFiles(commandline_args.timestamp_dir)
+    else:
+        timestamp_files = findTimestampFiles(commandline_args.data_dir)
+
+    if not timestamp_files:
+        print(MODULE_IDENTIFIER + 'ERROR: No timestamp files found.')
+        sys.exit(1)
+
+    n_workers = N_SEPARATION_WORKERS
+    if commandline_args.n_workers:
+        n_workers = commandline_args.n_workers
+
+    firings_file = DEFAULT_FIRINGS_FILE
+    if commandline_args.firings_file:
+        firings_file = commandline_args.firings_file
+
+    separateSpikesInEpochs(commandline_args.data_dir, timestamp_files, firings_file=firings_file, \
+            n_workers=n_workers)
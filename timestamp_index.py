@@ -0,0 +1,209 @@
+"""
+Compact index of a timestamp file (spike timestamps exported as MDA, or LFP
+timestamps extracted by Trodes).
+
+Timestamps advance by a fixed step for long stretches, with occasional gaps
+(dropped packets, paused recordings). The index stores these stretches as
+run-length encoded segments (start timestamp, start sample, length) along with
+the step, so converting between timestamps and sample numbers is a binary
+search over the segments instead of over every timestamp, and the gaps are
+explicit. The index is built once, in chunks, and kept next to the timestamp
+file.
+"""
+
+import os
+import json
+import uuid
+import numpy as np
+
+# Local imports
+import mda_stream
+import readTrodesExtractedDataFile3
+
+MODULE_IDENTIFIER = "[TimestampIndex] "
+INDEX_EXTENSION = '.index.json'
+INDEX_VERSION = 1
+INDEX_CHUNK_SAMPLES = 4 * 1024 * 1024
+
+def read_timestamps(timestamp_file):
+    """
+    Memory-map the timestamps in an MDA (exportmda) or Trodes extracted
+    (.dat) timestamp file.
+
+    :returns: 1D array of timestamps, read from disk as it is accessed.
+    """
+    if timestamp_file.endswith('.mda'):
+        return mda_stream.memmap_mda(timestamp_file).reshape(-1, order='F')
+
+    timestamp_records = readTrodesExtractedDataFile3.readTrodesExtractedDataFile(timestamp_file, \
+            use_mmap=True)['data']
+    timestamps = timestamp_records[timestamp_records.dtype.names[0]]
+    if timestamps.ndim == 2:
+        timestamps = timestamps[:, 0]
+    return timestamps
+
+def _nominal_step(first_timestamps):
+    # Most common spacing, so that a gap right at the start does not set the step.
+    timestamp_spacing = np.diff(np.asarray(first_timestamps, dtype='int64'))
+    if len(timestamp_spacing) == 0:
+        return 1
+    spacings, counts = np.unique(timestamp_spacing, return_counts=True)
+    return int(spacings[np.argmax(counts)])
+
+class TimestampIndex(object):
+
+    """
+    Run-length encoding of a strictly increasing timestamp array. Segment i
+    covers samples [segment_samples[i], segment_samples[i]+segment_lengths[i])
+    with timestamps segment_timestamps[i] + k * step.
+    """
+
+    def __init__(self, segment_timestamps, segment_samples, segment_lengths, step):
+        self.segment_timestamps = np.asarray(segment_timestamps, dtype='int64')
+        self.segment_samples = np.asarray(segment_samples, dtype='int64')
+        self.segment_lengths = np.asarray(segment_lengths, dtype='int64')
+        self.step = int(step)
+
+    @classmethod
+    def from_timestamps(cls, timestamps, chunk_size=INDEX_CHUNK_SAMPLES):
+        """
+        Build the index for an array (or memory-mapped file) of timestamps,
+        one chunk at a time.
+        """
+        n_samples = len(timestamps)
+        if n_samples == 0:
+            return cls([], [], [], 1)
+
+        step = _nominal_step(timestamps[:chunk_size])
+        segment_starts = [np.zeros(1, dtype='int64')]
+        for chunk_start in range(0, n_samples - 1, chunk_size):
+            # Chunks overlap by one sample so that every spacing is checked.
+            chunk = np.asarray(timestamps[chunk_start:chunk_start+chunk_size+1], dtype='int64')
+            timestamp_spacing = np.diff(chunk)
+            if (timestamp_spacing <= 0).any():
+                raise ValueError(MODULE_IDENTIFIER + 'Timestamps are not strictly increasing near sample %d.'%\
+                        (chunk_start + np.argmax(timestamp_spacing <= 0)))
+            segment_starts.append(np.flatnonzero(timestamp_spacing != step) + chunk_start + 1)
+
+        segment_samples = np.concatenate(segment_starts)
+        segment_lengths = np.diff(np.append(segment_samples, n_samples))
+        segment_timestamps = np.asarray(timestamps[segment_samples], dtype='int64')
+        return cls(segment_timestamps, segment_samples, segment_lengths, step)
+
+    def __len__(self):
+        if len(self.segment_samples) == 0:
+            return 0
+        return int(self.segment_samples[-1] + self.segment_lengths[-1])
+
+    def gaps(self):
+        """
+        :returns: Samples that follow a gap, and the time (in timestamps) that
+            is missing before each of them.
+        """
+        segment_ends = self.segment_timestamps[:-1] + (self.segment_lengths[:-1] - 1) * self.step
+        return self.segment_samples[1:], self.segment_timestamps[1:] - segment_ends - self.step
+
+    def samples_to_timestamps(self, samples):
+        """
+        Timestamps for the given sample numbers.
+        """
+        samples = np.asarray(samples, dtype='int64')
+        if ((samples < 0) | (samples >= len(self))).any():
+            raise IndexError(MODULE_IDENTIFIER + 'Sample out of range for %d timestamps.'%len(self))
+        segment_idx = np.searchsorted(self.segment_samples, samples, side='right') - 1
+        return self.segment_timestamps[segment_idx] + (samples - self.segment_samples[segment_idx]) * self.step
+
+    def timestamps_to_samples(self, timestamps, side='left'):
+        """
+        Sample numbers at which the given timestamps would be inserted to keep
+        the timestamps sorted. Same as np.searchsorted on the full timestamp
+        array.
+        """
+        timestamps = np.asarray(timestamps, dtype='float64')
+        if len(self) == 0:
+            return np.zeros(timestamps.shape, dtype='int64')[()]
+
+        segment_idx = np.searchsorted(self.segment_timestamps, timestamps, side='right') - 1
+        before_first = (segment_idx < 0)
+        segment_idx = np.where(before_first, 0, segment_idx)
+        steps_into_segment = (timestamps - self.segment_timestamps[segment_idx]) / self.step
+        if side == 'left':
+            segment_offsets = np.ceil(steps_into_segment)
+        else:
+            segment_offsets = np.floor(steps_into_segment) + 1
+        # Timestamps past the end of a segment (in a gap) go to the start of
+        # the next one.
+        segment_offsets = np.clip(segment_offsets, 0, self.segment_lengths[segment_idx]).astype('int64')
+        samples = np.where(before_first, 0, self.segment_samples[segment_idx] + segment_offsets)
+        # Scalar timestamps give scalar samples, as with np.searchsorted.
+        return samples[()]
+
+    def save(self, index_file, source_identity=None):
+        index_description = {
+                'version': INDEX_VERSION,
+                'source': source_identity,
+                'step': self.step,
+                'segments': [[int(ts), int(sample), int(length)] for ts, sample, length in \
+                        zip(self.segment_timestamps, self.segment_samples, self.segment_lengths)]
+                }
+        # Write to a temporary file first so that an interrupted write never
+        # leaves a partial index behind. The temporary file gets a unique
+        # name, as several viewers may index the same timestamps at once.
+        tmp_index_file = '%s.%s.tmp'%(index_file, uuid.uuid4().hex)
+        try:
+            with open(tmp_index_file, 'x') as f:
+                json.dump(index_description, f)
+            os.replace(tmp_index_file, index_file)
+        except BaseException:
+            if os.path.exists(tmp_index_file):
+                os.remove(tmp_index_file)
+            raise
+
+    @classmethod
+    def load(cls, index_file):
+        """
+        :returns: The stored index, and the identity of the timestamp file it
+            was built from.
+        """
+        with open(index_file, 'r') as f:
+            index_description = json.load(f)
+        if index_description.get('version') != INDEX_VERSION:
+            raise ValueError(MODULE_IDENTIFIER + 'Unsupported index version in %s.'%index_file)
+        segments = np.array(index_description['segments'], dtype='int64').reshape(-1, 3)
+        return cls(segments[:, 0], segments[:, 1], segments[:, 2], index_description['step']), \
+                index_description['source']
+
+def index_file_path(timestamp_file):
+    return timestamp_file + INDEX_EXTENSION
+
+def _source_identity(timestamp_file):
+    file_stat = os.stat(timestamp_file)
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+def load_timestamp_index(timestamp_file, write_index=True):
+    """
+    Get the index for a timestamp file. A stored index is used if it was built
+    from the current version of the file. Otherwise, the index is built from
+    the (memory-mapped) timestamps and stored next to the file.
+
+    :write_index: Store a newly built index
+    :returns: TimestampIndex
+    """
+    source_identity = _source_identity(timestamp_file)
+    index_file = index_file_path(timestamp_file)
+    try:
+        stored_index, stored_identity = TimestampIndex.load(index_file)
+        if stored_identity == source_identity:
+            return stored_index
+    except (FileNotFoundError, IOError, ValueError, KeyError):
+        pass
+
+    print(MODULE_IDENTIFIER + 'Indexing timestamps in %s'%timestamp_file)
+    timestamp_index = TimestampIndex.from_timestamps(read_timestamps(timestamp_file))
+    if write_index:
+        try:
+            timestamp_index.save(index_file, source_identity)
+        except OSError as err:
+            print(MODULE_IDENTIFIER + 'Unable to store timestamp index for %s.'%timestamp_file)
+            print(err)
+    return timestamp_index